@@ -0,0 +1,148 @@
+"""
+Admission control for upstream-bound work (OpenAI chat, OpenAI embeddings, Qdrant).
+
+Each upstream gets a concurrency limit and a bounded FIFO wait queue. When the
+queue is full callers are rejected immediately with 503; a single user holding
+more than their share of slots + queue entries is rejected with 429. Both carry
+a Retry-After estimate so clients back off instead of piling up in workers.
+
+Limits are configured per upstream with environment variables, e.g.
+ADMISSION_OPENAI_CHAT_CONCURRENCY, ADMISSION_OPENAI_CHAT_QUEUE,
+ADMISSION_OPENAI_CHAT_PER_USER, ADMISSION_OPENAI_CHAT_MAX_WAIT.
+"""
+import itertools
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict
+
+DEFAULT_LIMITS = {
+    # upstream: (concurrency, queue, per_user, max_wait_seconds)
+    "openai_chat": (8, 32, 2, 20.0),
+    "openai_embed": (4, 16, 2, 30.0),
+    "qdrant": (16, 64, 4, 5.0),
+}
+
+
+class Overloaded(Exception):
+    """Raised when an upstream's admission queue can't take another request."""
+
+    def __init__(self, upstream: str, status_code: int, retry_after: int, reason: str):
+        super().__init__(f"{upstream} overloaded: {reason}")
+        self.upstream = upstream
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class Limiter:
+    def __init__(self, name: str, concurrency: int, queue: int, per_user: int, max_wait: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.per_user = per_user
+        self.max_wait = max_wait
+
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiters = deque()
+        self._tickets = itertools.count()
+        self._user_load = defaultdict(int)
+        # Exponential moving average of how long a slot is held
+        self._avg_hold = 1.0
+
+        self.metrics = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_per_user": 0,
+            "rejected_timeout": 0,
+        }
+
+    def _retry_after(self) -> int:
+        backlog = len(self._waiters) + 1
+        return max(1, math.ceil(self._avg_hold * backlog / self.concurrency))
+
+    @contextmanager
+    def slot(self, user_id: str = None):
+        user = str(user_id) if user_id is not None else ""
+        with self._cond:
+            if user and self._user_load[user] >= self.per_user:
+                self.metrics["rejected_per_user"] += 1
+                raise Overloaded(self.name, 429, self._retry_after(), "per-user limit reached")
+
+            if self._active >= self.concurrency or self._waiters:
+                if len(self._waiters) >= self.queue:
+                    self.metrics["rejected_queue_full"] += 1
+                    raise Overloaded(self.name, 503, self._retry_after(), "queue full")
+
+                ticket = next(self._tickets)
+                self._waiters.append(ticket)
+                self._user_load[user] += 1
+                deadline = time.monotonic() + self.max_wait
+                # FIFO: only the head of the queue may take a freed slot
+                while self._waiters[0] != ticket or self._active >= self.concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiters.remove(ticket)
+                        self._user_load[user] -= 1
+                        self.metrics["rejected_timeout"] += 1
+                        self._cond.notify_all()
+                        raise Overloaded(self.name, 503, self._retry_after(), "timed out waiting for a slot")
+                    self._cond.wait(remaining)
+                self._waiters.popleft()
+            else:
+                self._user_load[user] += 1
+
+            self._active += 1
+            self.metrics["admitted"] += 1
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            held = time.monotonic() - started
+            with self._cond:
+                self._active -= 1
+                self._user_load[user] -= 1
+                if self._user_load[user] <= 0:
+                    del self._user_load[user]
+                self._avg_hold = 0.9 * self._avg_hold + 0.1 * held
+                self._cond.notify_all()
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {
+                "active": self._active,
+                "queue_depth": len(self._waiters),
+                "concurrency": self.concurrency,
+                "queue_limit": self.queue,
+                "avg_hold_seconds": round(self._avg_hold, 3),
+                **self.metrics,
+            }
+
+
+def _limit_from_env(name: str) -> Limiter:
+    concurrency, queue, per_user, max_wait = DEFAULT_LIMITS[name]
+    prefix = f"ADMISSION_{name.upper()}_"
+    return Limiter(
+        name,
+        concurrency=int(os.getenv(prefix + "CONCURRENCY", concurrency)),
+        queue=int(os.getenv(prefix + "QUEUE", queue)),
+        per_user=int(os.getenv(prefix + "PER_USER", per_user)),
+        max_wait=float(os.getenv(prefix + "MAX_WAIT", max_wait)),
+    )
+
+
+limiters: Dict[str, Limiter] = {name: _limit_from_env(name) for name in DEFAULT_LIMITS}
+
+
+def admit(upstream: str, user_id: str = None):
+    """Context manager holding one slot of the given upstream's limiter."""
+    return limiters[upstream].slot(user_id)
+
+
+def metrics() -> Dict[str, Dict]:
+    return {name: limiter.snapshot() for name, limiter in limiters.items()}
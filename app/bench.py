@@ -0,0 +1,961 @@
+#!/usr/bin/env python3
+"""
+Performance checks and benchmarks for StoryRAG.
+Run from the repo root:
+
+    python -m app.bench import-time
+    python -m app.bench markdown [--corpus DIR] [--files N] [--workers N]
+    python -m app.bench mmr [--chunks N] [--queries N] [--diversity D]
+    python -m app.bench local-index [--sizes 1000,10000,50000] [--queries N]
+    python -m app.bench cdc [--files N] [--edits N] [--paragraphs N]
+    python -m app.bench resilience [--requests N] [--threads N]
+    python -m app.bench embed-memory [--chunks N] [--legacy-chunks N]
+    python -m app.bench router [--sessions N] [--follow-ups N]
+    python -m app.bench shm-cache [--workers N] [--slots N] [--keys N]
+    python -m app.bench chat-memory [--redis] [--max-messages N]
+"""
+import argparse
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# Cumulative import time budgets (milliseconds) for modules on the request path.
+# app.main must stay cheap so workers boot fast; route modules are loaded lazily
+# (or once in the gunicorn master under --preload).
+IMPORT_BUDGETS_MS = {
+    "app.main": float(os.getenv("IMPORT_BUDGET_MAIN_MS", "600")),
+    "app.chat": float(os.getenv("IMPORT_BUDGET_CHAT_MS", "3000")),
+    "app.embed": float(os.getenv("IMPORT_BUDGET_EMBED_MS", "2000")),
+}
+
+
+def measure_import_ms(module: str) -> dict:
+    """
+    Import module in a fresh interpreter with -X importtime.
+    Returns {"total": cumulative ms of module, "children": {name: ms}} where
+    children are the module's direct imports.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    total = 0.0
+    children = {}
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if not match:
+            continue
+        depth = len(match.group(3)) // 2
+        ms = int(match.group(2)) / 1000
+        if depth == 0 and match.group(4) == module:
+            total = ms
+        elif depth == 1:
+            # Direct imports of a top-level module (the target's are listed before it)
+            children[match.group(4)] = ms
+    return {"total": total, "children": children}
+
+
+def bench_import_time(args):
+    failed = False
+    print(f"{'module':<12} {'ms':>8} {'budget':>8}")
+    for module, budget in IMPORT_BUDGETS_MS.items():
+        try:
+            timings = measure_import_ms(module)
+        except RuntimeError as e:
+            print(f"{module:<12} ❌ import failed: {e}")
+            failed = True
+            continue
+        total = timings["total"]
+        status = "✅" if total <= budget else "❌"
+        failed = failed or total > budget
+        print(f"{module:<12} {total:>8.1f} {budget:>8.0f} {status}")
+        if args.verbose:
+            heaviest = sorted(timings["children"].items(), key=lambda kv: kv[1], reverse=True)[:args.top]
+            for name, ms in heaviest:
+                print(f"    {name:<40} {ms:>8.1f}")
+    return 1 if failed else 0
+
+
+WORDS = (
+    "the castle dragon river queen sword shadow north ember wind stone oath "
+    "whisper crown forest tide lantern ash silver raven ancient harbor storm"
+).split()
+
+
+def synthetic_chapter(rng: random.Random, paragraphs: int = 40) -> str:
+    """A Markdown chapter using the syntax writers actually use in their notes."""
+    def sentence():
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+        i = rng.randrange(len(words))
+        words[i] = rng.choice([
+            f"**{words[i]}**", f"*{words[i]}*", f"_{words[i]}_", f"`{words[i]}`",
+            f"[{words[i]}](https://example.com/{words[i]})", f"{words[i]}&amp;co",
+            f"<b>{words[i]}</b>", words[i] + "_" + words[i], "\\*" + words[i],
+        ])
+        return " ".join(words).capitalize() + "."
+
+    blocks = [f"# Chapter {rng.choice(WORDS).title()}"]
+    for _ in range(paragraphs):
+        kind = rng.random()
+        if kind < 0.1:
+            blocks.append(f"## {rng.choice(WORDS).title()} {rng.choice(WORDS)}")
+        elif kind < 0.2:
+            blocks.append("\n".join(f"- {sentence()}" for _ in range(rng.randint(2, 5))))
+        elif kind < 0.25:
+            blocks.append("> " + sentence() + "\n> " + sentence())
+        elif kind < 0.27:
+            blocks.append("---")
+        else:
+            blocks.append(" ".join(sentence() for _ in range(rng.randint(3, 8))))
+    return "\n\n".join(blocks) + "\n"
+
+
+# Constructs the synthetic chapters don't cover, checked against the reference extractor
+MARKDOWN_EDGE_CASES = [
+    "<div>\n*not emphasis*\n</div>",
+    "para\n\n<div>\n*x* [l](u) &amp; # h\n\n**y**\n</div>\n\n*after*",
+    "<div>*a*</div> *b*",
+    "x\n<div>\n*c*\n</div>",
+    "<p>*p*</p>\n\n*q*",
+    "<div>\n<div>\n*n*\n</div>\n*m*\n</div>\n\n_z_",
+    "<div>\n`code`\n</div>",
+    "<div><!-- x -->*a*</div>",
+    "<div>\n*a*\n\n*b*",
+    "<p>a</p><p>*b*</p>\n*c*",
+    "<div>*a*</div><div>*b*</div>",
+    "<DIV>*u*</DIV>",
+    "  <div>\n*i*\n</div>",
+    "    <div>*a*</div>",
+    "> <div>*a*</div>",
+    "- item\n<div>*a*</div>",
+    "<details>\n<summary>*s*</summary>\n*d*\n</details>",
+    "<div>\n&lt;b&gt; &copy;\n</div>",
+    "<table><tr><td>*a*</td></tr></table>",
+    "<style>x{}</style>*b*",
+    "<hr>\n*h*",
+    "<div/>\n*a*",
+    "text <span>*em*</span> more",
+    "text <div>*a*</div> *c*",
+    "Text with a note[^1].\n\n[^1]: The note itself.",
+    "A[^n] b.\n\n[^n]: Note\n    continued.",
+    "x[^1]\n\n[^1]: <http://a.b> \"t\"",
+    "[a] [b]\n\n[a]: u",
+    "see [A]\n\n[a]: http://x",
+    "# Title\nFirst paragraph. Second sentence.\n\n- one\n- two\n\nLast line.",
+]
+
+
+def _load_corpus(args):
+    if args.corpus:
+        return [p.read_text(encoding="utf-8") for p in sorted(Path(args.corpus).rglob("*.md"))]
+    rng = random.Random(args.seed)
+    return [synthetic_chapter(rng) for _ in range(args.files)]
+
+
+def _extractor_mismatch(doc: str):
+    """Why the two extractors would chunk doc differently, or None if they agree."""
+    from app.chunking import cdc_chunk_texts, fixed_chunk_texts, markdown_to_text, normalize_text, reference_markdown_to_text
+
+    fast, reference = normalize_text(markdown_to_text(doc)), normalize_text(reference_markdown_to_text(doc))
+    if fast != reference:
+        return "normalised text differs"
+    # Small chunks so even the edge cases get several boundaries
+    for name, split in (("fixed", fixed_chunk_texts), ("cdc", cdc_chunk_texts)):
+        for size, overlap in ((8, 2), (500, 100)):
+            if split(markdown_to_text(doc), size, overlap) != split(reference_markdown_to_text(doc), size, overlap):
+                return f"{name} chunks differ at size {size}"
+    return None
+
+
+def bench_markdown(args):
+    from app.chunking import markdown_to_text, reference_markdown_to_text, chunk_documents
+
+    docs = _load_corpus(args)
+    total_mb = sum(len(d.encode("utf-8")) for d in docs) / 1e6
+    print(f"📚 {len(docs)} documents, {total_mb:.2f} MB")
+
+    # Equivalence: the normalised text the chunkers consume, and the fixed and CDC chunks cut from it
+    mismatches = 0
+    for i, doc in enumerate(docs):
+        reason = _extractor_mismatch(doc)
+        if reason:
+            mismatches += 1
+            if mismatches <= 3:
+                print(f"⚠️ Document {i}: {reason}")
+    print(f"{'equivalence':<24} {len(docs) - mismatches}/{len(docs)} documents identical")
+    edge_mismatches = [(c, _extractor_mismatch(c)) for c in MARKDOWN_EDGE_CASES]
+    edge_mismatches = [(c, reason) for c, reason in edge_mismatches if reason]
+    print(f"{'edge cases':<24} {len(MARKDOWN_EDGE_CASES) - len(edge_mismatches)}/{len(MARKDOWN_EDGE_CASES)} identical")
+    for case, reason in edge_mismatches:
+        print(f"⚠️ {reason}: {case!r}")
+    mismatches += len(edge_mismatches)
+
+    for name, fn in [("reference (html+bs4)", reference_markdown_to_text), ("fast extractor", markdown_to_text)]:
+        started = time.perf_counter()
+        for doc in docs:
+            fn(doc)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<24} {total_mb / elapsed:>8.2f} MB/s per core")
+
+    workers = args.workers or os.cpu_count() or 1
+    documents = [(f"users/bench/project/ch{i}.md", d) for i, d in enumerate(docs)]
+    started = time.perf_counter()
+    chunk_documents(documents, "bench", "project", 500, 100, workers=1)
+    single = time.perf_counter() - started
+    started = time.perf_counter()
+    chunk_documents(documents, "bench", "project", 500, 100, workers=workers, force_pool=True)
+    pooled = time.perf_counter() - started
+    print(f"{'parse+chunk, 1 process':<24} {total_mb / single:>8.2f} MB/s")
+    print(f"{f'parse+chunk, {workers} procs':<24} {total_mb / pooled:>8.2f} MB/s ({total_mb / pooled / workers:.2f} MB/s per core, incl. pool startup)")
+    return 1 if mismatches else 0
+
+
+def _overlapping_chunks(rng: random.Random, paragraphs: int, dim: int):
+    """
+    Chunks cut like the embed pipeline (overlapping word windows) plus
+    bag-of-words vectors, so overlapping windows get near-duplicate vectors.
+    """
+    import numpy as np
+
+    vocab = [f"w{i}" for i in range(2000)]
+    np_rng = np.random.default_rng(rng.randrange(2 ** 32))
+    word_vectors = {w: np_rng.normal(size=dim).astype(np.float32) for w in vocab}
+
+    texts = []
+    for _ in range(paragraphs):
+        words = [rng.choice(vocab) for _ in range(rng.randint(150, 400))]
+        for i in range(0, len(words), 60):
+            texts.append(words[i:i + 100])
+    vectors = np.stack([np.sum([word_vectors[w] for w in t], axis=0) for t in texts])
+    return texts, vectors, word_vectors
+
+
+def _mean_pairwise_jaccard(chunks) -> float:
+    sets = [set(c) for c in chunks]
+    pairs = [(a, b) for i, a in enumerate(sets) for b in sets[i + 1:]]
+    if not pairs:
+        return 0.0
+    return sum(len(a & b) / len(a | b) for a, b in pairs) / len(pairs)
+
+
+def bench_mmr(args):
+    import numpy as np
+    from app.mmr import mmr_select
+
+    rng = random.Random(args.seed)
+    texts, vectors, word_vectors = _overlapping_chunks(rng, args.chunks // 5, args.dim)
+    normed = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    print(f"📚 {len(texts)} chunks, dim {args.dim}")
+
+    results = {"top-k": [], "mmr": []}
+    for _ in range(args.queries):
+        source = rng.choice(texts)
+        query = np.sum([word_vectors[w] for w in rng.sample(source, min(20, len(source)))], axis=0)
+        query = query / np.linalg.norm(query)
+        scores = normed @ query
+
+        # The search itself is the same exact scan for both; time only what differs
+        fetched = np.argsort(-scores)[:args.fetch_k]
+        started = time.perf_counter()
+        top = fetched[:args.top_k]
+        results["top-k"].append((time.perf_counter() - started, top, float(scores[top].mean())))
+
+        started = time.perf_counter()
+        picked = fetched[mmr_select(query, vectors[fetched], args.top_k, args.diversity)]
+        results["mmr"].append((time.perf_counter() - started, picked, float(scores[picked].mean())))
+
+    # overlap = mean pairwise word Jaccard of the selected chunks (duplicate context)
+    print(f"{'strategy':<10} {'p50 ms':>8} {'p95 ms':>8} {'overlap':>8} {'relevance':>10}")
+    for name, runs in results.items():
+        latencies = sorted(r[0] * 1000 for r in runs)
+        overlap = sum(_mean_pairwise_jaccard([texts[i] for i in picked]) for _, picked, _ in runs) / len(runs)
+        relevance = sum(r[2] for r in runs) / len(runs)
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[int(len(latencies) * 0.95) - 1]
+        print(f"{name:<10} {p50:>8.3f} {p95:>8.3f} {overlap:>8.3f} {relevance:>10.3f}")
+    return 0
+
+
+def _edit_chapter(rng: random.Random, text: str):
+    """Apply one writer-style edit to a synthetic chapter; returns (kind, new_text)."""
+    blocks = text.rstrip("\n").split("\n\n")
+    prose = [i for i, b in enumerate(blocks) if b[:1].isalpha()] or [len(blocks) - 1]
+    new_sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 18))).capitalize() + "."
+    kind = rng.choice(["insert_sentence_top", "typo_fix", "insert_paragraph", "delete_paragraph", "append_paragraph"])
+    if kind == "insert_sentence_top":
+        i = prose[min(len(prose) - 1, rng.randrange(max(1, len(prose) // 5)))]
+        blocks[i] = new_sentence + " " + blocks[i]
+    elif kind == "typo_fix":
+        i = rng.choice(prose)
+        words = blocks[i].split(" ")
+        j = rng.randrange(len(words))
+        words[j] = rng.choice(WORDS) + words[j][-1:] if words[j][-1:] == "." else rng.choice(WORDS)
+        blocks[i] = " ".join(words)
+    elif kind == "insert_paragraph":
+        blocks.insert(rng.randrange(1, len(blocks) + 1), " ".join(new_sentence for _ in range(4)))
+    elif kind == "delete_paragraph" and len(prose) > 1:
+        del blocks[rng.choice(prose)]
+    else:
+        kind = "append_paragraph"
+        blocks.append(new_sentence)
+    return kind, "\n\n".join(blocks) + "\n"
+
+
+def bench_cdc(args):
+    """
+    Replay random edit sequences on synthetic chapters and count, after each
+    edit, how many chunk ids are new (i.e. would be re-embedded) per mode.
+    """
+    from app.chunking import chunk_document
+
+    modes = ("fixed", "cdc")
+    rng = random.Random(args.seed)
+    per_kind = {}  # kind -> {"edits": n, mode: [re-embedded, total chunks]}
+    sizes = {mode: [] for mode in modes}
+    for f in range(args.files):
+        key = f"users/u/p/ch{f}.md"
+        text = synthetic_chapter(rng, args.paragraphs)
+        ids = {mode: {c.id for c in chunk_document(key, text, "u", "p", args.chunk_size, args.chunk_overlap, mode)}
+               for mode in modes}
+        for _ in range(args.edits):
+            kind, text = _edit_chapter(rng, text)
+            stats = per_kind.setdefault(kind, {"edits": 0, **{m: [0, 0] for m in modes}})
+            stats["edits"] += 1
+            for mode in modes:
+                chunks = chunk_document(key, text, "u", "p", args.chunk_size, args.chunk_overlap, mode)
+                new_ids = {c.id for c in chunks}
+                stats[mode][0] += len(new_ids - ids[mode])
+                stats[mode][1] += len(new_ids)
+                sizes[mode].extend(len(c.text.split()) for c in chunks)
+                ids[mode] = new_ids
+
+    print(f"📚 {args.files} chapters x {args.edits} edits, chunk_size {args.chunk_size}, overlap {args.chunk_overlap}")
+    for mode in modes:
+        mean = sum(sizes[mode]) / len(sizes[mode])
+        std = (sum((x - mean) ** 2 for x in sizes[mode]) / len(sizes[mode])) ** 0.5
+        print(f"   {mode:<6} chunk words: mean {mean:.0f}, std {std:.0f}")
+
+    # re-embedded = chunks per edit whose id didn't exist before it (share of the file's chunks)
+    print(f"\n{'edit':<20} {'edits':>6} {'fixed re-emb':>16} {'cdc re-emb':>16}")
+    totals = {"edits": 0, **{m: [0, 0] for m in modes}}
+    for kind, stats in sorted(per_kind.items()) + [("all", totals)]:
+        if kind != "all":
+            totals["edits"] += stats["edits"]
+            for mode in modes:
+                totals[mode][0] += stats[mode][0]
+                totals[mode][1] += stats[mode][1]
+        cells = [f"{stats[m][0] / stats['edits']:.2f} ({100 * stats[m][0] / stats[m][1]:.0f}%)" for m in modes]
+        print(f"{kind:<20} {stats['edits']:>6} {cells[0]:>16} {cells[1]:>16}")
+    return 0
+
+
+def bench_resilience(args):
+    """
+    Chat requests in-process against the offline stand-ins with injected
+    faults, with the resilience layer off and on. "fallback" counts answers
+    that came from memory alone because retrieval was unavailable.
+    """
+    import logging
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+
+    root = tempfile.mkdtemp(prefix="storyrag-resilience-")
+    # Cached search results would hide the injected Qdrant faults
+    os.environ.update({"STORYRAG_OFFLINE": "true", "OFFLINE_REDIS": "fake", "OFFLINE_S3_DIR": root,
+                       "OFFLINE_CHAT_LATENCY_MS": str(args.chat_ms), "EMBEDDING_CACHE_BACKEND": "off",
+                       "SHM_CACHE_ENABLED": "false"})
+    # A few synthetic users share all the threads; don't let per-user admission caps reject them
+    for upstream in ("OPENAI_CHAT", "OPENAI_EMBED", "QDRANT"):
+        os.environ[f"ADMISSION_{upstream}_PER_USER"] = str(args.threads * 2)
+    logging.disable(logging.WARNING)
+    from app import offline, resilience
+    from app.chat import run_chat_query
+    from app.loadgen import synthetic_sessions
+
+    offline.ensure_corpus()
+    offline.seed()
+    rng = random.Random(args.seed)
+    requests = [r for session in synthetic_sessions(args.requests, rng, embed_ratio=0) for r in session][:args.requests]
+
+    scenarios = [
+        ("healthy", {}),
+        (f"slow tail ({args.slow_rate:.0%} @ {args.slow_ms}ms)",
+         {"QDRANT": {"slow_rate": args.slow_rate, "slow_ms": args.slow_ms}, "EMBED": {"slow_rate": args.slow_rate, "slow_ms": args.slow_ms}}),
+        ("qdrant down", {"QDRANT": {"error_rate": 1.0}}),
+    ]
+    print(f"💬 {len(requests)} chat requests per run, {args.threads} threads, offline LLM {args.chat_ms}ms")
+    print(f"{'scenario':<28} {'layer':<5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7} {'fallback':>9} {'hedged':>7}")
+    for name, faults in scenarios:
+        for enabled in (False, True):
+            for upstream in offline.FAULTS:
+                offline.FAULTS[upstream] = {"error_rate": 0.0, "slow_rate": 0.0, "slow_ms": 0.0, **faults.get(upstream, {})}
+            resilience.RESILIENCE_ENABLED = enabled
+            resilience.policies = {n: resilience._policy_from_env(n) for n in resilience.DEFAULT_POLICIES}
+
+            def one(request):
+                started = time.perf_counter()
+                try:
+                    _, debug_output = run_chat_query(request["user_id"], request["project_folder"], request["session_id"],
+                                                     request["question"], debug=True, retrieval="always")
+                    return time.perf_counter() - started, None, "Retrieval skipped" in debug_output
+                except Exception as e:
+                    return time.perf_counter() - started, e, False
+
+            with ThreadPoolExecutor(max_workers=args.threads) as pool:
+                results = list(pool.map(one, requests))
+            latencies = sorted(r[0] * 1000 for r in results if r[1] is None)
+            errors = sum(1 for r in results if r[1] is not None)
+            fallback = sum(1 for r in results if r[2])
+            hedged = sum(p.metrics["hedged"] for p in resilience.policies.values())
+            p50, p95 = _percentiles(latencies) if latencies else (0.0, 0.0)
+            p99 = latencies[max(int(len(latencies) * 0.99) - 1, 0)] if latencies else 0.0
+            print(f"{name:<28} {'on' if enabled else 'off':<5} {p50:>8.0f} {p95:>8.0f} {p99:>8.0f} {errors:>7} {fallback:>9} {hedged:>7}")
+    return 0
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+    return latencies[len(latencies) // 2], latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+
+
+def bench_local_index(args):
+    """
+    Search latency of the memory-mapped local index vs Qdrant on the same
+    points. Uses QDRANT_HOST when set; otherwise an in-process :memory:
+    client, which has no network hop and is not representative of a server.
+    """
+    import tempfile
+    import uuid
+
+    import numpy as np
+    from qdrant_client import QdrantClient
+    from qdrant_client.models import Distance, PointStruct, VectorParams
+
+    from app.local_index import LocalIndex
+    from app.tenancy import tenant_filter
+
+    if os.getenv("QDRANT_HOST"):
+        from app.clients import get_qdrant_client
+        client, target = get_qdrant_client(), os.getenv("QDRANT_HOST")
+    else:
+        client, target = QdrantClient(":memory:"), ":memory: (in-process, not representative)"
+    collection = f"bench_local_index_{uuid.uuid4().hex[:8]}"
+    rng = np.random.default_rng(args.seed)
+    print(f"🎯 Qdrant: {target}, dim {args.dim}, top_k {args.top_k}")
+    print(f"{'points':>8} {'backend':<8} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7}")
+
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            vectors = rng.standard_normal((size, args.dim), dtype=np.float32)
+            ids = [str(uuid.UUID(int=i + 1)) for i in range(size)]
+            payloads = [{"text": f"chunk {i}", "user_id": "bench", "project_folder": "bench",
+                         "filename": "bench.md", "source": "users/bench/bench/bench.md"} for i in range(size)]
+
+            if client.collection_exists(collection):
+                client.delete_collection(collection)
+            client.create_collection(collection, vectors_config=VectorParams(size=args.dim, distance=Distance.COSINE))
+            for start in range(0, size, 1000):
+                client.upsert(collection_name=collection, points=[
+                    PointStruct(id=ids[i], vector=vectors[i].tolist(), payload=payloads[i])
+                    for i in range(start, min(start + 1000, size))
+                ])
+
+            with tempfile.TemporaryDirectory() as root:
+                index = LocalIndex("bench", "bench", root=root)
+                index.upsert(ids, vectors, payloads)
+                queries = vectors[rng.integers(0, size, args.queries)] + rng.standard_normal((args.queries, args.dim), dtype=np.float32) * 0.5
+
+                local_ms, qdrant_ms, agree = [], [], 0
+                for query in queries:
+                    started = time.perf_counter()
+                    local_hits = index.search(query, args.top_k)
+                    local_ms.append((time.perf_counter() - started) * 1000)
+
+                    started = time.perf_counter()
+                    qdrant_hits = client.query_points(
+                        collection_name=collection, query=query.tolist(), query_filter=tenant_filter("bench", "bench"),
+                        limit=args.top_k, with_payload=True
+                    ).points
+                    qdrant_ms.append((time.perf_counter() - started) * 1000)
+                    agree += len({h.id for h in local_hits} & {str(h.id) for h in qdrant_hits})
+
+            # recall = share of Qdrant's top-k the exact local scan also returns
+            recall = agree / (args.queries * args.top_k)
+            for name, latencies in (("local", local_ms), ("qdrant", qdrant_ms)):
+                p50, p95 = _percentiles(latencies)
+                print(f"{size:>8} {name:<8} {p50:>8.3f} {p95:>8.3f} {recall:>7.3f}")
+    finally:
+        client.delete_collection(collection)
+    return 0
+
+
+class _SerializingQdrant:
+    """An in-memory QdrantClient whose upserts are only serialized, as the REST transport would."""
+
+    def __init__(self):
+        from qdrant_client import QdrantClient
+        self._client = QdrantClient(":memory:")
+        self.bytes_sent = 0
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def upsert(self, collection_name, points, **kwargs):
+        from qdrant_client.http.models import Batch, PointsBatch, PointsList
+        body = PointsBatch(batch=points) if isinstance(points, Batch) else PointsList(points=points)
+        self.bytes_sent += len(body.model_dump_json())
+
+
+def _legacy_embed_upload(chunks, client, collection):
+    """The embed -> upload path before float32 arrays: float lists, dict copies, then PointStructs."""
+    from qdrant_client.models import PointStruct
+    from app.clients import get_openai_client
+    from app.tenancy import ensure_tenant_collection
+
+    embedded = []
+    for i in range(0, len(chunks), 100):
+        batch = chunks[i:i+100]
+        response = get_openai_client().embeddings.create(input=[c.text for c in batch], model="bench")
+        for chunk, record in zip(batch, response.data):
+            embedded.append({"id": chunk.id, "embedding": record.embedding, "text": chunk.text, "metadata": chunk.metadata})
+    ensure_tenant_collection(client, collection, None, len(embedded[0]["embedding"]))
+    points = [PointStruct(id=c["id"], vector=c["embedding"], payload={"text": c["text"], **c["metadata"]}) for c in embedded]
+    client.upsert(collection_name=collection, points=points)
+
+
+def _embed_memory_run(pipeline, chunks, words, seed):
+    """Child process: build chunks, then report the pipeline's peak RSS above that."""
+    import resource
+    import uuid
+    import warnings
+
+    warnings.filterwarnings("ignore", message="Payload indexes have no effect")
+    os.environ.update({"STORYRAG_OFFLINE": "true", "OFFLINE_REDIS": "fake", "OFFLINE_EMBED_LATENCY_MS": "0",
+                       "EMBEDDING_CACHE_BACKEND": "off", "LOCAL_INDEX_SYNC": "false"})
+    from app.chunking import Chunk
+    from app.embed import embed_chunks, upload_to_qdrant
+
+    rng = random.Random(seed)
+    records = [Chunk(str(uuid.UUID(int=i + 1)), " ".join(rng.choices(WORDS, k=words)), "bench", "project",
+                     f"chapter{i // 50}.md", f"users/bench/project/chapter{i // 50}.md") for i in range(chunks)]
+    client = _SerializingQdrant()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    if pipeline == "legacy":
+        _legacy_embed_upload(records, client, "bench_embed_memory")
+    else:
+        upload_to_qdrant(records, embed_chunks(records, "bench"), client, "bench_embed_memory")
+    seconds = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    return (peak - before) * 1024, seconds, client.bytes_sent
+
+
+def bench_embed_memory(args):
+    """
+    Peak memory of embed_chunks + upload_to_qdrant (offline embeddings, upserts
+    serialized but not sent) over the memory of the chunks themselves. Each
+    run gets a fresh process. The legacy list/dict/PointStruct path needs
+    several GB at 100k chunks, so it runs at --legacy-chunks and is compared
+    per chunk.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    runs = [("legacy", min(args.legacy_chunks, args.chunks)), ("arrays", min(args.legacy_chunks, args.chunks)), ("arrays", args.chunks)]
+    print(f"🧮 Chunks of {args.words} words, 1536-dim embeddings")
+    print(f"{'pipeline':<8} {'chunks':>8} {'peak MB':>9} {'KB/chunk':>9} {'seconds':>8} {'sent MB':>8}")
+    for pipeline, chunks in runs:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            peak, seconds, sent = pool.submit(_embed_memory_run, pipeline, chunks, args.words, args.seed).result()
+        print(f"{pipeline:<8} {chunks:>8} {peak / 2**20:>9.0f} {peak / chunks / 1024:>9.1f} {seconds:>8.1f} {sent / 2**20:>8.0f}")
+    return 0
+
+
+# Follow-up messages and whether they need the project's context
+ROUTER_CASES = [
+    ("thanks!", False), ("ok", False), ("Thank you so much", False), ("perfect, thanks", False), ("haha love it", False),
+    ("make it shorter", False), ("Rewrite that in first person", False), ("can you make it darker?", False),
+    ("Expand on that", False), ("turn this into a poem", False), ("translate it to French", False),
+    ("make it more formal", False), ("put that in bullet points", False), ("Rephrase the last paragraph", False),
+    ("Make it about Corvin instead", True), ("Who is the raven queen?", True), ("What happens in chapter 3?", True),
+    ("Tell me about the dragon oath", True), ("Where does the silver harbor lie?", True),
+    ("Write a scene where the queen meets the raven", True), ("remind me what my notes say about the ember crown", True),
+    ("Describe the storm forest", True), ("How old is the lantern keeper?", True), ("continue", True),
+    ("make it about the dragon oath instead", True), ("put the ember crown in it", True),
+    ("rewrite it from the lantern keeper's point of view", True), ("continue that with the storm forest", True),
+    ("rewrite it from the queen's point of view", False), ("make it more about her sister", False),
+    ("yes", False), ("no", False),
+]
+# Replies to an answer that ends by offering more ("Want me to describe the castle?")
+ROUTER_OFFER_CASES = [
+    ("yes", True), ("sure", True), ("yeah, thanks", True), ("ok", True), ("yes please", True),
+    ("no", False), ("nope", False), ("no thanks", False), ("nah, never mind", False), ("make it shorter", False),
+]
+
+
+def bench_router(args):
+    """
+    Router decisions on labelled follow-ups, then chat sessions (a story
+    question followed by follow-ups) in-process against the offline
+    stand-ins with retrieval=always and retrieval=auto.
+    """
+    import logging
+    import tempfile
+    from types import SimpleNamespace
+
+    from app import query_router
+
+    history = [SimpleNamespace(role="user", content="Tell me about the harbor"),
+               SimpleNamespace(role="assistant", content="The silver harbor is ruled by the raven queen and her sister.")]
+    offer_history = history[:1] + [SimpleNamespace(
+        role="assistant", content="The silver harbor is ruled by the raven queen. Want me to describe the castle?")]
+    labelled = ([(m, needs, history) for m, needs in ROUTER_CASES]
+                + [(m, needs, offer_history) for m, needs in ROUTER_OFFER_CASES])
+    wrong = [(m, needs) for m, needs, h in labelled if query_router.classify(m, h).retrieve != needs]
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        for message, _, h in labelled:
+            query_router.classify(message, h)
+    per_call_us = (time.perf_counter() - started) / (args.repeat * len(labelled)) * 1e6
+    skippable = sum(1 for _, needs, _ in labelled if not needs)
+    print(f"🧭 {len(labelled)} labelled follow-ups ({skippable} skippable): {len(wrong)} misrouted, {per_call_us:.0f}µs per decision")
+    for message, needs in wrong:
+        print(f"   {'missed skip' if not needs else 'WRONG SKIP'}: {message!r}")
+
+    root = tempfile.mkdtemp(prefix="storyrag-router-")
+    os.environ.update({"STORYRAG_OFFLINE": "true", "OFFLINE_REDIS": "fake", "OFFLINE_S3_DIR": root,
+                       "OFFLINE_CHAT_LATENCY_MS": str(args.chat_ms), "EMBEDDING_CACHE_BACKEND": "off"})
+    logging.disable(logging.WARNING)
+    from app import offline
+    from app.chat import run_chat_query
+    from app.loadgen import synthetic_sessions
+
+    offline.ensure_corpus()
+    offline.seed()
+    rng = random.Random(args.seed)
+    sessions = []
+    for session in synthetic_sessions(args.sessions, rng, embed_ratio=0):
+        first = session[0]
+        follow_ups = [rng.choice(ROUTER_CASES)[0] for _ in range(args.follow_ups)]
+        sessions.append([first] + [{**first, "question": q} for q in follow_ups])
+
+    print(f"\n💬 {len(sessions)} sessions of 1 question + {args.follow_ups} follow-ups, offline LLM {args.chat_ms}ms")
+    print(f"{'retrieval':<10} {'p50 ms':>8} {'p95 ms':>8} {'follow-up p50':>14} {'skipped':>8}")
+    for mode in ("always", "auto"):
+        query_router.stats.update({"retrieve": 0, "skip": 0, "saved_ms": 0.0})
+        latencies, follow_up_latencies = [], []
+        for n, session in enumerate(sessions):
+            for i, request in enumerate(session):
+                started = time.perf_counter()
+                run_chat_query(request["user_id"], request["project_folder"], f"router-{mode}-{n}",
+                               request["question"], debug=False, retrieval=mode)
+                elapsed = (time.perf_counter() - started) * 1000
+                latencies.append(elapsed)
+                if i:
+                    follow_up_latencies.append(elapsed)
+        p50, p95 = _percentiles(latencies)
+        follow_up_p50, _ = _percentiles(follow_up_latencies)
+        print(f"{mode:<10} {p50:>8.1f} {p95:>8.1f} {follow_up_p50:>14.1f} {query_router.stats['skip']:>8}")
+    return 0
+
+
+def _shm_cache_worker(mode, directory, slots, dim, keys, requests, skew, seed):
+    """Child process: look up a Zipf-distributed question stream, storing misses. Returns (hits, get µs, put µs)."""
+    from collections import OrderedDict
+
+    import numpy as np
+
+    from app.shm_cache import SharedCache
+
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) ** skew for rank in range(keys)]
+    stream = rng.choices(range(keys), weights=weights, k=requests)
+    vector = np.ones(dim, dtype=np.float32).tobytes()
+    if mode == "shared":
+        cache = SharedCache("bench_vectors", slots, dim * 4, directory=directory)
+        get, put = cache.get, cache.put
+    else:
+        lru = OrderedDict()
+
+        def get(key):
+            value = lru.get(key)
+            if value is not None:
+                lru.move_to_end(key)
+            return value
+
+        def put(key, value):
+            lru[key] = value
+            if len(lru) > slots:
+                lru.popitem(last=False)
+
+    hits, get_seconds, put_seconds = 0, 0.0, 0.0
+    for k in stream:
+        key = f"question {k}"
+        started = time.perf_counter()
+        value = get(key)
+        get_seconds += time.perf_counter() - started
+        if value is not None:
+            hits += 1
+            continue
+        started = time.perf_counter()
+        put(key, vector)
+        put_seconds += time.perf_counter() - started
+    return hits, get_seconds / requests * 1e6, put_seconds / max(1, requests - hits) * 1e6
+
+
+def bench_shm_cache(args):
+    """
+    Query-vector hit rate with one in-process LRU per worker vs one
+    shared-memory cache for all workers, at the same slots per cache and at
+    the same host memory. Every worker draws its own Zipf question stream,
+    like requests spread over gunicorn workers.
+    """
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    directory = tempfile.mkdtemp(prefix="storyrag-shm-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    slot_mb = args.dim * 4 / 2**20
+    print(f"🗃️ {args.workers} workers x {args.requests} lookups over {args.keys} questions (Zipf {args.skew}), "
+          f"{args.slots} slots of {args.dim}-dim vectors")
+    print(f"{'cache':<10} {'slots':>7} {'hit rate':>9} {'get µs':>8} {'put µs':>8} {'host MB':>8}")
+    # Shared at the same slots (1/N the memory), then at the same host memory as N per-worker caches
+    for mode, slots in (("per-worker", args.slots), ("shared", args.slots), ("shared", args.slots * args.workers)):
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=get_context("spawn")) as pool:
+            results = list(pool.map(_shm_cache_worker, [mode] * args.workers, [directory] * args.workers,
+                                    [slots] * args.workers, [args.dim] * args.workers, [args.keys] * args.workers,
+                                    [args.requests] * args.workers, [args.skew] * args.workers,
+                                    [args.seed + w for w in range(args.workers)]))
+        hits = sum(r[0] for r in results)
+        get_us = sum(r[1] for r in results) / len(results)
+        put_us = sum(r[2] for r in results) / len(results)
+        copies = args.workers if mode == "per-worker" else 1
+        print(f"{mode:<10} {slots:>7} {hits / (args.workers * args.requests):>9.1%} {get_us:>8.1f} {put_us:>8.1f} "
+              f"{copies * slots * slot_mb:>8.0f}")
+    return 0
+
+
+def bench_chat_memory(args):
+    """
+    Behaviour checks for RedisChatMemory against fakeredis (or the configured
+    Redis with --redis): history order, the message cap, the token budget,
+    TTL refresh, the compact and compressed encodings, and reading
+    RedisChatStore entries.
+    Exits non-zero if any check fails.
+    """
+    import json
+    import uuid
+
+    from llama_index.core.llms import ChatMessage, MessageRole
+
+    from app import chat_memory
+    from app.chat_memory import RedisChatMemory
+
+    if args.redis:
+        from app.redis_client import get_redis
+        r = get_redis()
+        aredis = None
+    else:
+        import fakeredis
+        import fakeredis.aioredis
+        server = fakeredis.FakeServer()
+        r = fakeredis.FakeRedis(server=server)
+        aredis = fakeredis.aioredis.FakeRedis(server=server)
+
+    def memory(ttl=3600):
+        m = RedisChatMemory(f"bench-chat-memory:{uuid.uuid4().hex}", ttl=ttl, max_messages=args.max_messages)
+        m.redis = r
+        return m
+
+    def message(i, size=20):
+        role = MessageRole.USER if i % 2 == 0 else MessageRole.ASSISTANT
+        return ChatMessage(role=role, content=f"message {i} " + "x" * size)
+
+    results = []
+
+    def check(name, ok, detail=""):
+        results.append(ok)
+        print(f"{'✅' if ok else '❌'} {name}{f' ({detail})' if detail and not ok else ''}")
+
+    # append_and_get returns the history before the new message, oldest first, in one round trip
+    m = memory()
+    seen = [m.append_and_get(message(i)) for i in range(5)]
+    expected = [[f"message {j} " + "x" * 20 for j in range(i)] for i in range(5)]
+    check("append_and_get returns prior history in order", [[x.content for x in h] for h in seen] == expected)
+    check("append_and_get is one round trip", m.round_trips == 5, f"{m.round_trips} round trips for 5 calls")
+    check("roles survive the compact encoding",
+          [x.role for x in m.get()] == [MessageRole.USER, MessageRole.ASSISTANT] * 2 + [MessageRole.USER])
+
+    # The list is capped at max_messages, dropping the oldest
+    m = memory()
+    total = args.max_messages + 7
+    for i in range(total):
+        m.append(message(i))
+    kept = [x.content.split()[1] for x in m.get()]
+    check(f"capped at {args.max_messages} messages", r.llen(m.key) == args.max_messages and
+          kept == [str(i) for i in range(total - args.max_messages, total)], f"{r.llen(m.key)} stored")
+
+    # The prompt history is the newest messages within the token budget; storage keeps max_messages
+    from llama_index.core.utils import get_tokenizer
+    tokenize = get_tokenizer()
+    m = memory()
+    m.token_limit = 30
+    for i in range(args.max_messages):
+        m.append(message(i))
+    history = m.append_and_get(message(args.max_messages))
+    used = sum(len(tokenize(x.content)) for x in history)
+    newest = [x.content.split()[1] for x in history] == [str(i) for i in range(args.max_messages - len(history), args.max_messages)]
+    check("history trimmed to the token budget", history and used <= m.token_limit and newest
+          and len(history) < args.max_messages and history[0].role == MessageRole.USER
+          and r.llen(m.key) == args.max_messages,
+          f"{len(history)} messages, {used} tokens")
+
+    # Every write pushes the expiry back out to the full TTL
+    m = memory(ttl=600)
+    m.append(message(0))
+    r.expire(m.key, 5)
+    m.append_and_get(message(1))
+    ttl_after_read_write = r.ttl(m.key)
+    r.expire(m.key, 5)
+    m.append(message(2))
+    check("TTL refreshed on every write", ttl_after_read_write > 590 and r.ttl(m.key) > 590,
+          f"ttl {ttl_after_read_write}s / {r.ttl(m.key)}s")
+
+    # Short messages are compact JSON; long ones are zlib-compressed and read back intact
+    m = memory()
+    long_text = "The raven queen rules the silver harbor. " * 100
+    m.append(ChatMessage(role=MessageRole.USER, content="short"))
+    m.append(ChatMessage(role=MessageRole.ASSISTANT, content=long_text))
+    short_raw, long_raw = r.lrange(m.key, 0, -1)
+    check("short messages stored as compact JSON", json.loads(short_raw) == {"r": "u", "c": "short"}, repr(short_raw))
+    if chat_memory.CHAT_MEMORY_COMPRESS:
+        check("long messages stored compressed", long_raw[:1] == b"z" and len(long_raw) < len(long_text) // 4,
+              f"{len(long_raw)} bytes for {len(long_text)} chars")
+    check("compressed messages read back intact", m.get()[1].content == long_text)
+
+    # Sessions written by RedisChatStore (before this module) stay readable and appendable
+    m = memory()
+    legacy = [ChatMessage(role=MessageRole.USER, content="hello"), ChatMessage(role=MessageRole.ASSISTANT, content="hi there")]
+    if aredis is not None:
+        from llama_index.storage.chat_store.redis import RedisChatStore
+        store = RedisChatStore(redis_client=r, aredis_client=aredis, ttl=3600)
+        for msg in legacy:
+            store.add_message(m.key, msg)
+    else:
+        for msg in legacy:
+            r.rpush(m.key, json.dumps({"role": msg.role.value, "additional_kwargs": {},
+                                       "blocks": [{"block_type": "text", "text": msg.content}]}))
+    r.rpush(m.key, json.dumps({"role": "user", "content": "older format", "additional_kwargs": {}}))
+    history = m.append_and_get(ChatMessage(role=MessageRole.USER, content="new"))
+    check("legacy RedisChatStore entries readable",
+          [(x.role, x.content) for x in history] == [(x.role, x.content) for x in legacy] + [(MessageRole.USER, "older format")])
+    check("new messages append after legacy ones", [x.content for x in m.get()][-1] == "new")
+
+    # Round-trip cost
+    m = memory()
+    started = time.perf_counter()
+    for i in range(args.requests):
+        m.append_and_get(message(i, size=300))
+    per_call_ms = (time.perf_counter() - started) / args.requests * 1000
+    print(f"⏱️ append_and_get: {per_call_ms:.3f}ms per call ({'configured Redis' if args.redis else 'fakeredis'})")
+    return 0 if all(results) else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="StoryRAG benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("import-time", help="Check import times against budgets")
+    p.add_argument("--verbose", action="store_true", help="Show the heaviest top-level imports")
+    p.add_argument("--top", type=int, default=10)
+    p.set_defaults(func=bench_import_time)
+
+    p = sub.add_parser("markdown", help="Markdown extraction equivalence and throughput")
+    p.add_argument("--corpus", default=None, help="Directory of .md files (default: synthetic chapters)")
+    p.add_argument("--files", type=int, default=200)
+    p.add_argument("--workers", type=int, default=None)
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_markdown)
+
+    p = sub.add_parser("mmr", help="MMR reranking latency and overlap vs plain top-k")
+    p.add_argument("--chunks", type=int, default=5000)
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--dim", type=int, default=256)
+    p.add_argument("--top-k", type=int, default=5)
+    p.add_argument("--fetch-k", type=int, default=20)
+    p.add_argument("--diversity", type=float, default=0.3)
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_mmr)
+
+    p = sub.add_parser("local-index", help="Local memory-mapped index vs Qdrant search latency")
+    p.add_argument("--sizes", default="1000,10000,50000", help="Comma-separated corpus sizes")
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--dim", type=int, default=1536)
+    p.add_argument("--top-k", type=int, default=5)
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_local_index)
+
+    p = sub.add_parser("cdc", help="Chunks re-embedded after edits: fixed windows vs content-defined")
+    p.add_argument("--files", type=int, default=50)
+    p.add_argument("--edits", type=int, default=20)
+    p.add_argument("--paragraphs", type=int, default=120)
+    p.add_argument("--chunk-size", type=int, default=500)
+    p.add_argument("--chunk-overlap", type=int, default=100)
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_cdc)
+
+    p = sub.add_parser("resilience", help="Chat latency under injected faults with hedging/breakers off and on")
+    p.add_argument("--requests", type=int, default=300)
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--slow-rate", type=float, default=0.02)
+    p.add_argument("--slow-ms", type=int, default=1500)
+    p.add_argument("--chat-ms", type=int, default=20, help="Offline LLM latency")
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_resilience)
+
+    p = sub.add_parser("embed-memory", help="Peak memory of the embed -> upsert path on a large project")
+    p.add_argument("--chunks", type=int, default=100000)
+    p.add_argument("--legacy-chunks", type=int, default=10000)
+    p.add_argument("--words", type=int, default=100, help="Words per chunk text")
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_embed_memory)
+
+    p = sub.add_parser("router", help="Retrieval router decisions and chat latency with it on and off")
+    p.add_argument("--sessions", type=int, default=40)
+    p.add_argument("--follow-ups", type=int, default=3)
+    p.add_argument("--chat-ms", type=int, default=20, help="Offline LLM latency")
+    p.add_argument("--repeat", type=int, default=200, help="Repetitions when timing decisions")
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_router)
+
+    p = sub.add_parser("shm-cache", help="Query-vector hit rate: per-worker caches vs one shared-memory cache")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--slots", type=int, default=1024)
+    p.add_argument("--keys", type=int, default=20000, help="Distinct questions")
+    p.add_argument("--requests", type=int, default=20000, help="Lookups per worker")
+    p.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of question popularity")
+    p.add_argument("--dim", type=int, default=1536)
+    p.add_argument("--seed", type=int, default=7)
+    p.set_defaults(func=bench_shm_cache)
+
+    p = sub.add_parser("chat-memory", help="RedisChatMemory behaviour checks against fakeredis or Redis")
+    p.add_argument("--redis", action="store_true", help="Use the configured Redis instead of fakeredis")
+    p.add_argument("--max-messages", type=int, default=10)
+    p.add_argument("--requests", type=int, default=500, help="Calls when timing append_and_get")
+    p.set_defaults(func=bench_chat_memory)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,27 @@
 import os
 from dotenv import load_dotenv
-from qdrant_client import QdrantClient
-from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
-from llama_index.core.query_engine import RetrieverQueryEngine
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.core.retrievers import VectorIndexRetriever
-from llama_index.llms.openai import OpenAI
 from llama_index.core.settings import Settings
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
-from llama_index.core.memory import ChatMemoryBuffer
 from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.storage.chat_store.redis import RedisChatStore
-from llama_index.core.prompts import ChatPromptTemplate
+from app.retrieval import search_project, nodes_to_json, nodes_from_json
+from app import generations
+from app import shm_cache
+from app import singleflight
+from app import resilience
+from app import query_router
+from app.admission import admit
+from app.mmr import mmr_rerank
+from app.chat_memory import RedisChatMemory
+from app.clients import get_qdrant_client, get_llm, get_embed_model
 import re
 from typing import List, Dict, Any
 import logging
+import time
 import json
 from datetime import datetime
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
 def calculate_metadata_score(question: str, metadata: Dict[str, Any]) -> float:
     """
     Calculate a bonus score based on metadata relevance to the question.
@@ -84,79 +86,127 @@ def combine_scores(vector_score: float, metadata_score: float, vector_weight: fl
     # Combine scores, ensuring we don't exceed 1.0
     return min(base_score + metadata_bonus, 1.0)
 
-def run_chat_query(user_id: str, project_folder: str, session_id: str, question: str, debug: bool = True, system_prompt: str = None, score_threshold: float = 0.5) -> str:
-    # 1) Load secrets uvicorn app.main:app --host 0.0.0.0 --port 8000
-    qdrant_api_key = os.getenv("QDRANT_API_KEY")
-    qdrant_host    = os.getenv("QDRANT_HOST")
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    redis_host     = os.getenv("REDIS_HOST", "localhost")
-    redis_port     = int(os.getenv("REDIS_PORT", "6379"))
-    redis_password = os.getenv("REDIS_PASSWORD2", "")
-    collection_name = "splitter"
-
-    # 2) Redis-backed memory buffer
-    chat_store = RedisChatStore(
-        redis_url=f"redis://default:{redis_password}@{redis_host}:{redis_port}",
-        ttl=3600
+QUERY_EMBEDDING_MODEL = "text-embedding-3-small"
+
+def _admitted_call(upstream: str, user_id: str, fn):
+    """
+    Admit once, then run fn with hedging and a timeout. The admission queue
+    wait isn't part of the attempt timeout, hedges share the caller's slot,
+    and abandoned attempts never sit in the admission queue.
+    """
+    with admit(upstream, user_id):
+        return resilience.call(upstream, fn)
+
+def _query_vector(question: str, user_id: str):
+    """Query embedding from the host's shared-memory cache, else one (singleflighted) embedding call."""
+    vector = shm_cache.get_vector(QUERY_EMBEDDING_MODEL, question)
+    if vector is not None:
+        return vector
+    vector = singleflight.do(
+        singleflight.make_key("query_embedding", QUERY_EMBEDDING_MODEL, question),
+        lambda: _admitted_call("openai_embed", user_id, lambda: Settings.embed_model.get_query_embedding(question)),
+        shared=True
     )
-    memory = ChatMemoryBuffer.from_defaults(
-        chat_store=chat_store,
-        chat_store_key=session_id
+    shm_cache.put_vector(QUERY_EMBEDDING_MODEL, question, vector)
+    return vector
+
+def _cached_search(qdrant_client, question: str, user_id: str, project_folder: str, top_k: int, mmr: bool):
+    """
+    Search results from the host's shared-memory cache, keyed by the project's
+    index version so any update, rebuild or Redis flush misses. MMR results
+    need vectors and aren't cached, nor is anything while the version can't
+    be read.
+    """
+    key = None
+    if not mmr:
+        generation, changes, epoch = generations.version(user_id, project_folder)
+        if epoch:
+            key = f"{user_id}|{project_folder}|{epoch}|{generation}|{changes}|{top_k}|{question}"
+    if key is not None:
+        raw = shm_cache.get_result(key)
+        if raw is not None:
+            return None, nodes_from_json(raw)
+    query_vector = _query_vector(question, user_id)
+    candidates = singleflight.do(
+        singleflight.make_key("search", user_id, project_folder, question, top_k, mmr),
+        lambda: _admitted_call("qdrant", user_id, lambda: search_project(qdrant_client, query_vector, user_id, project_folder,
+                                                                         top_k=top_k, with_vectors=mmr))
     )
+    if key is not None:
+        shm_cache.put_result(key, nodes_to_json(candidates))
+    return query_vector, candidates
 
-    # 3) Add user message to memory
-    memory.put(ChatMessage(role=MessageRole.USER, content=question))
+def run_chat_query(user_id: str, project_folder: str, session_id: str, question: str, debug: bool = True, system_prompt: str = None, score_threshold: float = 0.5,
+                   top_k: int = 5, mmr: bool = False, mmr_diversity: float = 0.3, fetch_k: int = 20,
+                   retrieval: str = None) -> str:
+    # 1) Run with: uvicorn app.main:app --host 0.0.0.0 --port 8000
+    # 2) Redis-backed memory (pooled connection, capped + compact history)
+    memory = RedisChatMemory(session_id)
 
-    # 4) Qdrant VectorStore
-    qdrant_client = QdrantClient(url=qdrant_host, api_key=qdrant_api_key)
-    vector_store  = QdrantVectorStore(client=qdrant_client, collection_name=collection_name)
+    # 3) Read the history and add the user message in one round trip
+    history = memory.append_and_get(ChatMessage(role=MessageRole.USER, content=question))
 
-    # 5) LLM + Embeddings
-    Settings.llm = OpenAI(
-        api_key=openai_api_key,
-        model="gpt-3.5-turbo",
-        temperature=0.3
-    )
-    Settings.embed_model = OpenAIEmbedding(
-        model="text-embedding-3-small",
-        api_key=openai_api_key
-    )
+    # 4) Qdrant client (collection / shard key are resolved per tenant at search time)
+    qdrant_client = get_qdrant_client()
 
-    # 6) Retriever with filters
-    index = VectorStoreIndex.from_vector_store(vector_store)
-    retriever = VectorIndexRetriever(
-        index=index,
-        similarity_top_k=5,
-        filters=MetadataFilters(filters=[
-            MetadataFilter(key="user_id", value=str(user_id)),
-            MetadataFilter(key="project_folder", value=project_folder),
-        ])
-    )
+    # 5) LLM + Embeddings (built once per worker process)
+    Settings.llm = get_llm()
+    Settings.embed_model = get_embed_model()
 
-    candidates = retriever.retrieve(question)
+    # 6) Tenant-routed retrieval filtered to this user's project
+    # Concurrent identical questions share one embedding call (across workers)
+    # and one search (within this worker). Both are hedged and time-limited; if
+    # either upstream is unavailable we answer from chat memory alone. Query
+    # vectors and (non-MMR) results are also cached in shared memory for every
+    # worker on the host.
+    # The router skips retrieval for acknowledgements and edits of the last
+    # answer (retrieval=always|never overrides it).
+    route = query_router.route(question, history, retrieval)
+    retrieval_error = None
+    candidates = []
+    retrieval_started = time.perf_counter()
+    if route.retrieve:
+        try:
+            # With MMR, over-fetch candidates with their vectors and pick a diverse top_k
+            search_k = max(fetch_k, top_k) if mmr else top_k
+            query_vector, candidates = _cached_search(qdrant_client, question, user_id, project_folder, search_k, mmr)
+            if mmr:
+                candidates = mmr_rerank(query_vector, candidates, top_k, mmr_diversity)
+        except resilience.Unavailable as e:
+            logger.warning(f"Retrieval unavailable for {user_id}/{project_folder}, answering from memory: {e}")
+            retrieval_error = e
+            candidates = []
+    retrieval_seconds = time.perf_counter() - retrieval_started if retrieval_error is None else None
+    saved_ms = query_router.record(route, retrieval_seconds)
+    if route.retrieve:
+        logger.info(f"Router: retrieve for session {session_id} ({route.reason})")
+    else:
+        logger.info(f"Router: skipped retrieval for session {session_id} ({route.reason}), saved ~{saved_ms:.0f}ms")
     # Use the passed score threshold instead of hardcoded value
 
+    # Score each candidate once; the debug dump and the filter share the result
+    scored = [(c, combine_scores(c.score, calculate_metadata_score(question, c.node.metadata))) for c in candidates]
+
     debug_output = ""
+    if debug and not route.retrieve:
+        debug_output += f"\n🧭 Router: no retrieval needed ({route.reason}), saved ~{saved_ms:.0f}ms\n"
+    if debug and retrieval_error is not None:
+        debug_output += f"\n⚠️ Retrieval skipped ({retrieval_error})\n"
     if debug:
         debug_output += f"\n🔍 Retrieved {len(candidates)} candidates (chunks) with score threshold: {score_threshold}\n"
-        for i, c in enumerate(candidates):
-            content_preview = c.node.get_content()[:100] + "..." if len(c.node.get_content()) > 100 else c.node.get_content()
-            combined_score = combine_scores(c.score, calculate_metadata_score(question, c.node.metadata))
+        for i, (c, combined_score) in enumerate(scored):
+            content = c.node.get_content()
+            content_preview = content[:100] + "..." if len(content) > 100 else content
             debug_output += f"Chunk {i+1} | Score: {combined_score:.3f} | Filename: {c.node.metadata.get('filename', 'N/A')}\n"
             debug_output += f"Content Preview: {content_preview}\n\n"
 
     # Filter candidates using combined scores
-    filtered_candidates = []
-    for c in candidates:
-        metadata_score = calculate_metadata_score(question, c.node.metadata)
-        combined_score = combine_scores(c.score, metadata_score)
-        if combined_score >= score_threshold:
-            filtered_candidates.append(c)
-    
+    filtered_candidates = [c for c, combined_score in scored if combined_score >= score_threshold]
+    context_str = "\n\n".join([node.get_content() for node in filtered_candidates])
+
     if debug:
         debug_output += f"\n✅ After filtering with threshold {score_threshold}: {len(filtered_candidates)} candidates remain\n"
         if filtered_candidates:
-            context_str = "\n\n".join([node.get_content() for node in filtered_candidates])
             full_prompt = f"System: {system_prompt}\nContext: {context_str}\nUser: {question}"
             debug_output += f"\n📝 Full Prompt to LLM:\n{full_prompt}\n"
         else:
@@ -177,20 +227,22 @@ def run_chat_query(user_id: str, project_folder: str, session_id: str, question:
         messages = [ChatMessage(role=MessageRole.SYSTEM, content=system_prompt)]
         
         # Add chat history
-        for msg in memory.get():
+        for msg in history:
             messages.append(ChatMessage(role=MessageRole(msg.role.lower()), content=msg.content))
         
         # Add current question
         messages.append(ChatMessage(role=MessageRole.USER, content=question))
 
         llm = Settings.llm
-        llm_response = llm.chat(messages=messages)
+        with admit("openai_chat", user_id):
+            llm_response = llm.chat(messages=messages)
 
         assistant_text = getattr(llm_response, "content", None)
         if not assistant_text:
             assistant_text = getattr(getattr(llm_response, "message", {}), "content", "")
 
-        memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=assistant_text))
+        memory.append(ChatMessage(role=MessageRole.ASSISTANT, content=assistant_text))
+        debug_output += _redis_report(memory, session_id, debug)
 
         return assistant_text, debug_output
 
@@ -206,14 +258,13 @@ def run_chat_query(user_id: str, project_folder: str, session_id: str, question:
         )
 
     # 9) Use filtered candidates directly instead of query engine
-    # Create context from filtered candidates
-    context_str = "\n\n".join([node.get_content() for node in filtered_candidates])
-    
+    # (context_str was built from them above)
+
     # Create messages with system prompt and context
     messages = [ChatMessage(role=MessageRole.SYSTEM, content=system_prompt)]
     
     # Add chat history
-    for msg in memory.get():
+    for msg in history:
         messages.append(ChatMessage(role=MessageRole(msg.role.lower()), content=msg.content))
     
     # Add current question with context
@@ -221,18 +272,28 @@ def run_chat_query(user_id: str, project_folder: str, session_id: str, question:
     messages.append(ChatMessage(role=MessageRole.USER, content=context_message))
 
     llm = Settings.llm
-    llm_response = llm.chat(messages=messages)
+    with admit("openai_chat", user_id):
+        llm_response = llm.chat(messages=messages)
 
     assistant_text = getattr(llm_response, "content", None)
     if not assistant_text:
         assistant_text = getattr(getattr(llm_response, "message", {}), "content", "")
 
-    memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=assistant_text))
+    memory.append(ChatMessage(role=MessageRole.ASSISTANT, content=assistant_text))
+    debug_output += _redis_report(memory, session_id, debug)
 
     return assistant_text, debug_output
 
 
-def print_chat_history(memory: ChatMemoryBuffer, session_id: str):
+def _redis_report(memory: RedisChatMemory, session_id: str, debug: bool) -> str:
+    redis_ms = memory.redis_seconds * 1000
+    logger.info(f"Chat memory for session {session_id}: {redis_ms:.1f}ms in Redis over {memory.round_trips} round trips")
+    if debug:
+        return f"\n⏱️ Redis: {redis_ms:.1f}ms over {memory.round_trips} round trips\n"
+    return ""
+
+
+def print_chat_history(memory: RedisChatMemory, session_id: str):
     print(f"\n🧠 Chat History for Session `{session_id}`:\n" + "-" * 40)
     for msg in memory.get():
         role_str = getattr(msg.role, 'value', str(msg.role)).upper()
@@ -0,0 +1,123 @@
+"""
+Redis chat memory with one round trip per operation.
+
+Replaces RedisChatStore + ChatMemoryBuffer on the chat path: connections come
+from the shared pool in app.redis_client, reading the history and appending
+the user's message is a single MULTI/EXEC pipeline, and messages are stored
+as compact JSON ({"r": "u", "c": ...}), zlib-compressed above a size
+threshold. The list is capped at CHAT_HISTORY_MAX_MESSAGES and its TTL is
+refreshed on every write. That cap only bounds storage: the history handed
+to the prompt is the newest messages that fit in CHAT_HISTORY_TOKEN_LIMIT
+tokens, as ChatMemoryBuffer did.
+
+Entries written by RedisChatStore (plain message JSON under the same
+session key) are still readable.
+"""
+import json
+import os
+import time
+import zlib
+from typing import List
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.utils import get_tokenizer
+
+from app.redis_client import get_redis
+
+CHAT_MEMORY_TTL = int(os.getenv("CHAT_MEMORY_TTL", "3600"))
+CHAT_HISTORY_MAX_MESSAGES = int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", "40"))
+# ChatMemoryBuffer's DEFAULT_TOKEN_LIMIT
+CHAT_HISTORY_TOKEN_LIMIT = int(os.getenv("CHAT_HISTORY_TOKEN_LIMIT", "3000"))
+CHAT_MEMORY_COMPRESS = os.getenv("CHAT_MEMORY_COMPRESS", "true").lower() == "true"
+CHAT_MEMORY_COMPRESS_MIN_BYTES = int(os.getenv("CHAT_MEMORY_COMPRESS_MIN_BYTES", "512"))
+
+_ROLE_CODES = {
+    MessageRole.USER: "u",
+    MessageRole.ASSISTANT: "a",
+    MessageRole.SYSTEM: "s",
+}
+_CODE_ROLES = {code: role for role, code in _ROLE_CODES.items()}
+
+
+def encode_message(message: ChatMessage) -> bytes:
+    role = _ROLE_CODES.get(message.role, message.role.value)
+    raw = json.dumps({"r": role, "c": message.content or ""}, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    if CHAT_MEMORY_COMPRESS and len(raw) >= CHAT_MEMORY_COMPRESS_MIN_BYTES:
+        return b"z" + zlib.compress(raw)
+    return raw
+
+
+def decode_message(raw: bytes) -> ChatMessage:
+    if raw[:1] == b"z":
+        raw = zlib.decompress(raw[1:])
+    data = json.loads(raw)
+    if "r" in data:
+        role = _CODE_ROLES.get(data["r"]) or MessageRole(data["r"])
+        return ChatMessage(role=role, content=data["c"])
+    # Legacy RedisChatStore entry
+    content = data.get("content")
+    if content is None:
+        content = "".join(block.get("text", "") for block in data.get("blocks", []))
+    return ChatMessage(role=MessageRole(data["role"]), content=content)
+
+
+def trim_to_token_limit(messages: List[ChatMessage], token_limit: int) -> List[ChatMessage]:
+    """The newest messages whose contents fit in token_limit tokens, never starting with an assistant reply."""
+    tokenize = get_tokenizer()
+    total, start = 0, len(messages)
+    while start > 0:
+        total += len(tokenize(messages[start - 1].content or ""))
+        if total > token_limit:
+            break
+        start -= 1
+    while start < len(messages) and messages[start].role == MessageRole.ASSISTANT:
+        start += 1
+    return messages[start:]
+
+
+class RedisChatMemory:
+    """Capped, TTL'd chat history for one session. redis_seconds/round_trips track time spent in Redis."""
+
+    def __init__(self, session_id: str, ttl: int = CHAT_MEMORY_TTL, max_messages: int = CHAT_HISTORY_MAX_MESSAGES,
+                 token_limit: int = CHAT_HISTORY_TOKEN_LIMIT):
+        self.key = session_id
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.token_limit = token_limit
+        self.redis = get_redis()
+        self.redis_seconds = 0.0
+        self.round_trips = 0
+
+    def _execute(self, pipe):
+        started = time.perf_counter()
+        try:
+            return pipe.execute()
+        finally:
+            self.redis_seconds += time.perf_counter() - started
+            self.round_trips += 1
+
+    def _append_commands(self, pipe, message: ChatMessage):
+        pipe.rpush(self.key, encode_message(message))
+        pipe.ltrim(self.key, -self.max_messages, -1)
+        pipe.expire(self.key, self.ttl)
+
+    def append_and_get(self, message: ChatMessage) -> List[ChatMessage]:
+        """
+        Return the history before this message, trimmed to token_limit, and
+        append it, in one round trip.
+        """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.lrange(self.key, -self.max_messages, -1)
+        self._append_commands(pipe, message)
+        history = self._execute(pipe)[0]
+        return trim_to_token_limit([decode_message(raw) for raw in history], self.token_limit)
+
+    def append(self, message: ChatMessage):
+        pipe = self.redis.pipeline(transaction=True)
+        self._append_commands(pipe, message)
+        self._execute(pipe)
+
+    def get(self) -> List[ChatMessage]:
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lrange(self.key, -self.max_messages, -1)
+        return [decode_message(raw) for raw in self._execute(pipe)[0]]
@@ -0,0 +1,354 @@
+"""
+Markdown-to-text extraction and chunking for the embed pipeline.
+
+markdown_to_text() strips Markdown syntax directly instead of rendering HTML
+with `markdown` and re-parsing it with BeautifulSoup. It produces the same
+whitespace-separated tokens as the reference path (which is all the chunker
+looks at), in a single regex pass per block. MARKDOWN_EXTRACTOR=reference
+switches back to the HTML round trip.
+
+Both chunkers see the extracted text as one whitespace-normalised line
+(normalize_text), so line and paragraph layout, which the two extractors
+render differently, never changes a chunk. CHUNKING_MODE picks how it is
+split: "fixed" word windows, or "cdc" (content-defined) chunks whose
+boundaries fall after sentences selected by a rolling hash, so an edit only
+changes the chunks around it instead of shifting every later window.
+
+This module only depends on the standard library so process-pool workers
+start quickly.
+"""
+import hashlib
+import html
+import os
+import re
+import uuid
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List, Tuple
+
+MARKDOWN_EXTRACTOR = os.getenv("MARKDOWN_EXTRACTOR", "fast")
+# Imports with at least this much Markdown are parsed in a process pool; below
+# it, spawning the pool costs more than it saves (~4 MB/s per core in-process)
+PARALLEL_PARSE_MIN_BYTES = int(os.getenv("PARALLEL_PARSE_MIN_BYTES", str(4 * 1024 * 1024)))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
+CHUNKING_MODE = os.getenv("CHUNKING_MODE", "fixed")
+# Content-defined chunking: the rolling hash covers this many sentences, and
+# sentences longer than CDC_MAX_UNIT_WORDS are cut into pieces of that size
+CDC_WINDOW = int(os.getenv("CDC_WINDOW", "2"))
+CDC_MAX_UNIT_WORDS = int(os.getenv("CDC_MAX_UNIT_WORDS", "60"))
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+_CODE_SPAN = re.compile(r"(`+)(.+?)(?<!`)\1(?!`)", re.S)
+_SPAN_PLACEHOLDER = "\x00{}\x00"
+_PLACEHOLDER = re.compile(r"\x00(\d+)\x00")
+_REF_DEF = re.compile(r"^ {0,3}\[([^\]]+)\]:[ \t]*<?\S+>?(?:[ \t]+(?:\"[^\"]*\"|'[^']*'|\([^)]*\)))?[ \t]*$", re.M)
+_HR = re.compile(r"^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$", re.M)
+_SETEXT = re.compile(r"^(?=[^\n]*\S)([^\n]*)\n {0,3}(?:=+|-+)[ \t]*$", re.M)
+_ATX = re.compile(r"^ {0,3}#{1,6}[ \t]*(.*?)(?:[ \t]+#+)?[ \t]*$", re.M)
+_BLOCKQUOTE = re.compile(r"^(?: {0,3}>[ ]?)+", re.M)
+_LIST_MARKER = re.compile(r"^([ \t]*)(?:[*+-]|\d+\.)[ \t]+", re.M)
+_IMAGE = re.compile(r"!\[[^\]]*\](?:\([^)]*\)|\[[^\]]*\])")
+_LINK = re.compile(r"\[([^\]]*)\]\((?:[^()]|\([^)]*\))*\)")
+_REF_LINK = re.compile(r"\[([^\]]+)\]\s?\[([^\]]*)\]")
+# [id] on its own, e.g. a footnote marker [^1] whose "[^1]: note" parsed as a reference definition
+_SHORT_REF = re.compile(r"\[([^\]]+)\]")
+_AUTOLINK = re.compile(r"<((?:https?|ftp)://[^>\s]+|[^>\s@]+@[^>\s@]+)>")
+_COMMENT = re.compile(r"<!--.*?-->", re.S)
+_TAG = re.compile(r"</?[A-Za-z][A-Za-z0-9-]*(?:\s[^<>]*)?/?>")
+# Block-level tags Python-Markdown passes through raw: Markdown inside them is literal
+_BLOCK_TAGS = (
+    "address article aside blockquote body canvas center colgroup dd details div dl dt fieldset figcaption "
+    "figure footer form group h1 h2 h3 h4 h5 h6 header hgroup html iframe legend li main map math menu nav "
+    "noscript object ol option output p pre progress script section style summary table tbody td textarea "
+    "tfoot th thead tr ul video"
+).split()
+_HTML_BLOCK_START = re.compile(r"^ {0,3}(?=<(?:%s)[\s/>])" % "|".join(_BLOCK_TAGS), re.M | re.I)
+_HTML_BLOCK_OPEN = re.compile(r"[ \t]*<(%s)(?=[\s/>])[^>]*?(/?)>" % "|".join(_BLOCK_TAGS), re.I)
+_SCRIPT_STYLE = re.compile(r"<(script|style)\b[^>]*>.*?</\1\s*>", re.S | re.I)
+_ESCAPE = re.compile(r"\\([\\`*_{}\[\]()#+\-.!>])")
+_STRONG_EM = re.compile(r"(\*\*\*|___)(?=\S)(.+?)(?<=\S)\1")
+_STRONG = re.compile(r"(\*\*|(?<!\w)__)(?=\S)(.+?)(?<=\S)(?:\*\*|__(?!\w))")
+_EM_STAR = re.compile(r"(?<!\*)\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?!\*)")
+_EM_UNDERSCORE = re.compile(r"(?<![\w_])_(?=[^\s_])(.+?)(?<=[^\s_])_(?![\w_])")
+
+
+def markdown_to_text(text: str) -> str:
+    """Plain text of a Markdown document, token-equivalent to markdown() + BeautifulSoup.get_text()."""
+    if MARKDOWN_EXTRACTOR == "reference":
+        return reference_markdown_to_text(text)
+
+    text = text.replace("\r\n", "\n").replace("\t", "    ")
+
+    # Code spans are literal: pull them out before any other inline rule runs
+    spans = []
+
+    def _keep(match):
+        spans.append(match.group(2))
+        return _SPAN_PLACEHOLDER.format(len(spans) - 1)
+
+    text = _protect_indented_code(text, spans)
+    text = _protect_html_blocks(text, spans)
+    # Escaped backticks never open a code span
+    text = text.replace("\\`", "\x01")
+    text = _CODE_SPAN.sub(_keep, text)
+
+    ref_ids = {m.group(1).lower() for m in _REF_DEF.finditer(text)}
+    text = _REF_DEF.sub("", text)
+    text = _COMMENT.sub("", text)
+
+    # Block structure
+    text = _SETEXT.sub(r"\1", text)
+    text = _HR.sub("", text)
+    text = _BLOCKQUOTE.sub("", text)
+    text = _ATX.sub(r"\1", text)
+    text = _LIST_MARKER.sub(r"\1", text)
+
+    # Inline structure
+    text = _IMAGE.sub("", text)
+    text = _LINK.sub(r"\1", text)
+    text = _REF_LINK.sub(
+        lambda m: m.group(1) if (m.group(2) or m.group(1)).lower() in ref_ids else m.group(0), text
+    )
+    if ref_ids:
+        text = _SHORT_REF.sub(lambda m: m.group(1) if m.group(1).lower() in ref_ids else m.group(0), text)
+    text = _AUTOLINK.sub(r"\1", text)
+    text = _TAG.sub("", text)
+    text = _ESCAPE.sub(lambda m: "\x02%d\x02" % ord(m.group(1)), text)
+    text = _STRONG_EM.sub(r"\2", text)
+    text = _STRONG.sub(r"\2", text)
+    text = _EM_STAR.sub(r"\1", text)
+    text = _EM_UNDERSCORE.sub(r"\1", text)
+
+    text = re.sub(r"\x02(\d+)\x02", lambda m: chr(int(m.group(1))), text)
+    text = html.unescape(text)
+    text = _PLACEHOLDER.sub(lambda m: spans[int(m.group(1))], text)
+    return text.replace("\x01", "`")
+
+
+def _protect_indented_code(text: str, spans: List[str]) -> str:
+    """Replace indented code block lines with placeholders (their content is literal)."""
+    if "\n    " not in text and not text.startswith("    "):
+        return text
+    out = []
+    prev_blank = True
+    in_code = False
+    in_list = False
+    for line in text.split("\n"):
+        blank = not line.strip()
+        if line.startswith("    ") and not blank and (in_code or (prev_blank and not in_list)):
+            in_code = True
+            spans.append(line[4:])
+            out.append(_SPAN_PLACEHOLDER.format(len(spans) - 1))
+        else:
+            if not blank:
+                in_code = False
+                if _LIST_MARKER.match(line) and not line.startswith("    "):
+                    in_list = True
+                elif prev_blank and not line.startswith(" "):
+                    in_list = False
+            out.append(line)
+        prev_blank = blank
+    return "\n".join(out)
+
+
+def _html_block_end(text: str, start: int, tag: str) -> int:
+    """End of the element opened at start (nested same-name tags counted); unclosed runs to the end."""
+    depth = 0
+    for match in re.finditer(r"<(/?)%s(?=[\s/>])[^>]*?(/?)>" % tag, text[start:], re.I):
+        if match.group(1):
+            depth -= 1
+        elif not match.group(2):
+            depth += 1
+        if depth <= 0:
+            return start + match.end()
+    return len(text)
+
+
+def _protect_html_blocks(text: str, spans: List[str]) -> str:
+    """
+    Replace raw block-level HTML (a block tag opening a line, through its
+    closing tag and any block tags following it on the same line) with
+    placeholders holding its text content, as BeautifulSoup would return it.
+    """
+    if "<" not in text:
+        return text
+    out = []
+    pos = 0
+    while True:
+        start = _HTML_BLOCK_START.search(text, pos)
+        if start is None:
+            break
+        end = start.end()
+        pieces = []
+        while True:
+            opening = _HTML_BLOCK_OPEN.match(text, end)
+            if opening is None or opening.group(2) or opening.group(1).lower() == "hr":
+                break
+            block_end = _html_block_end(text, opening.start(1) - 1, opening.group(1).lower())
+            pieces.append(text[opening.start(1) - 1:block_end])
+            end = block_end
+        if not pieces:
+            # Void or self-closing tag: nothing raw, tag stripping handles it
+            out.append(text[pos:end + 1])
+            pos = end + 1
+            continue
+        out.append(text[pos:start.end()])
+        for piece in pieces:
+            piece = _TAG.sub("", _COMMENT.sub("", _SCRIPT_STYLE.sub("", piece)))
+            spans.append(html.unescape(piece) + "\n")
+            out.append(_SPAN_PLACEHOLDER.format(len(spans) - 1))
+        pos = end
+    out.append(text[pos:])
+    return "".join(out)
+
+
+def reference_markdown_to_text(text: str) -> str:
+    """The original extraction: render HTML, then strip it with BeautifulSoup."""
+    from markdown import markdown
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(markdown(text), "html.parser").get_text()
+
+
+def hash_to_uuid(text):
+    return str(uuid.UUID(hashlib.sha256(text.encode("utf-8")).hexdigest()[0:32]))
+
+
+class Chunk:
+    """
+    One chunk of a source file. Slotted: a large import holds hundreds of
+    thousands of these, and the metadata strings are shared by every chunk
+    of the same file instead of living in a dict per chunk.
+    """
+    __slots__ = ("id", "text", "user_id", "project_folder", "filename", "source", "generation")
+
+    def __init__(self, id: str, text: str, user_id: str, project_folder: str, filename: str, source: str,
+                 generation: int = 0):
+        self.id = id
+        self.text = text
+        self.user_id = user_id
+        self.project_folder = project_folder
+        self.filename = filename
+        self.source = source
+        # Index generation the chunk is written to (app.generations)
+        self.generation = generation
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    @property
+    def metadata(self) -> Dict[str, str]:
+        return {"user_id": self.user_id, "project_folder": self.project_folder,
+                "filename": self.filename, "source": self.source}
+
+    def payload(self) -> Dict:
+        """The Qdrant payload: text, metadata and index generation."""
+        return {"text": self.text, **self.metadata, "generation": self.generation}
+
+
+def normalize_text(text: str) -> str:
+    """The extracted text as the chunkers see it: tokens separated by single spaces."""
+    return " ".join(text.split())
+
+
+def fixed_chunk_texts(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """Overlapping windows of chunk_size words every chunk_size - chunk_overlap words."""
+    words = text.split()
+    return [" ".join(words[i:i + chunk_size]) for i in range(0, len(words), chunk_size - chunk_overlap)]
+
+
+def _sentence_units(text: str) -> List[List[str]]:
+    """The words of each sentence, long sentences cut into CDC_MAX_UNIT_WORDS pieces."""
+    units = []
+    for sentence in _SENTENCE_BREAK.split(normalize_text(text)):
+        words = sentence.split()
+        units.extend(words[i:i + CDC_MAX_UNIT_WORDS] for i in range(0, len(words), CDC_MAX_UNIT_WORDS))
+    return units
+
+
+def cdc_chunk_texts(text: str, chunk_size: int, chunk_overlap: int) -> List[str]:
+    """
+    Content-defined chunks averaging about chunk_size words.
+    Once a chunk has chunk_size / 2 words, it ends after any sentence whose
+    hash (over the last CDC_WINDOW sentences) hits the boundary mask, and
+    chunks never exceed 1.5 x chunk_size words. Boundaries depend only on
+    nearby words (not on line or paragraph breaks, which differ between
+    extractors), so they re-synchronise shortly after an edit.
+    Each chunk starts with whole trailing sentences of the previous one, up to
+    chunk_overlap words.
+    """
+    min_words, max_words = chunk_size // 2, chunk_size * 3 // 2
+    # Sentences average ~15 words, so this puts the expected boundary near chunk_size
+    divisor = max(1, (chunk_size - min_words) // 15)
+
+    texts, current, current_words, recent = [], [], 0, []
+    overlap = []
+
+    def close():
+        nonlocal current, current_words, overlap
+        texts.append(" ".join(word for unit in overlap + current for word in unit))
+        overlap, kept = [], 0
+        for unit in reversed(current):
+            if kept + len(unit) > chunk_overlap:
+                break
+            overlap.insert(0, unit)
+            kept += len(unit)
+        current, current_words = [], 0
+
+    for words in _sentence_units(text):
+        if current and current_words + len(words) > max_words:
+            close()
+        current.append(words)
+        current_words += len(words)
+        recent = (recent + [" ".join(words)])[-CDC_WINDOW:]
+        if current_words >= min_words:
+            h = zlib.crc32("\n".join(recent).encode("utf-8"))
+            if h % divisor == 0:
+                close()
+    if current:
+        close()
+    return texts
+
+
+def chunk_document(key: str, text: str, user_id: str, project_folder: str,
+                   chunk_size: int, chunk_overlap: int, mode: str = None) -> List[Chunk]:
+    """Extract plain text from one Markdown file and split it into chunks (see CHUNKING_MODE)."""
+    plain = normalize_text(markdown_to_text(text))
+    split = cdc_chunk_texts if (mode or CHUNKING_MODE) == "cdc" else fixed_chunk_texts
+    parts = key.split("/")
+    file_project_folder = parts[2] if len(parts) > 3 else "root"
+    filename = parts[-1]
+    user_id = str(user_id)
+
+    chunks = []
+    for chunk_text in split(plain, chunk_size, chunk_overlap):
+        if chunk_text.strip():
+            chunk_id = hash_to_uuid(f"{user_id}|{project_folder}|{chunk_text}")
+            chunks.append(Chunk(chunk_id, chunk_text, user_id, file_project_folder, filename, key))
+    return chunks
+
+
+def _chunk_document_args(args: Tuple) -> List[Chunk]:
+    return chunk_document(*args)
+
+
+def chunk_documents(documents: List[Tuple[str, str]], user_id: str, project_folder: str,
+                    chunk_size: int, chunk_overlap: int, workers: int = None,
+                    force_pool: bool = False) -> List[List[Chunk]]:
+    """
+    Chunk many (key, markdown_text) documents, preserving order.
+    Large imports are spread over a spawn-based process pool (safe to start
+    from threaded gunicorn workers); small ones stay in-process.
+    """
+    workers = workers or PARSE_WORKERS
+    jobs = [(key, text, user_id, project_folder, chunk_size, chunk_overlap) for key, text in documents]
+    total_bytes = sum(len(text) for _, text in documents)
+    if workers <= 1 or (total_bytes < PARALLEL_PARSE_MIN_BYTES and not force_pool):
+        return [_chunk_document_args(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        return list(pool.map(_chunk_document_args, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
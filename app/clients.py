@@ -0,0 +1,77 @@
+"""
+Fork-safe, lazily created upstream clients.
+
+Nothing here connects or imports the heavy SDKs at import time. Each getter
+builds its client on first use and caches it per process id, so a client
+created in the gunicorn master under --preload is never shared with the
+forked workers: each worker builds its own on first use (or in warmup).
+With STORYRAG_OFFLINE=true they return the stand-ins from app.offline.
+"""
+import os
+import threading
+
+from dotenv import load_dotenv
+
+from app import offline
+
+load_dotenv()
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get(name, factory):
+    key = (name, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = factory()
+                _clients[key] = client
+    return client
+
+
+def get_openai_client():
+    def factory():
+        if offline.ENABLED:
+            return offline.OfflineOpenAI()
+        from openai import OpenAI
+        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _get("openai", factory)
+
+
+def get_s3_client():
+    def factory():
+        if offline.ENABLED:
+            return offline.LocalS3()
+        import boto3
+        return boto3.client("s3")
+    return _get("s3", factory)
+
+
+def get_qdrant_client():
+    def factory():
+        if offline.ENABLED:
+            return offline.make_qdrant_client()
+        from qdrant_client import QdrantClient
+        return QdrantClient(url=os.getenv("QDRANT_HOST"), api_key=os.getenv("QDRANT_API_KEY"))
+    return _get("qdrant", factory)
+
+
+def get_llm():
+    def factory():
+        if offline.ENABLED:
+            return offline.make_llm()
+        from llama_index.llms.openai import OpenAI
+        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), model="gpt-3.5-turbo", temperature=0.3)
+    return _get("llm", factory)
+
+
+def get_embed_model():
+    def factory():
+        if offline.ENABLED:
+            return offline.make_embed_model()
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        return OpenAIEmbedding(model="text-embedding-3-small", api_key=os.getenv("OPENAI_API_KEY"))
+    return _get("embed_model", factory)
@@ -1,20 +1,26 @@
 import os
+import time
+import base64
 import hashlib
 import uuid
 from pathlib import Path
-from markdown import markdown
-from bs4 import BeautifulSoup
+import numpy as np
 from tqdm import tqdm
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
-from qdrant_client.http.models import Filter, FieldCondition, MatchValue
+from qdrant_client.models import Distance, VectorParams, Batch
+from qdrant_client.http.models import Filter, FieldCondition, MatchValue, FilterSelector
 from dotenv import load_dotenv
 import sys
-import requests
-import boto3
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 from qdrant_client.models import PayloadSchemaType
-from openai import OpenAI
+from app.clients import get_openai_client, get_s3_client, get_qdrant_client
+from app.admission import admit, Overloaded
+from app import embedding_cache
+from app.chunking import chunk_documents, hash_to_uuid
+from app.tenancy import route_tenant, tenant_filter, ensure_tenant_collection, ensure_metadata_indexes
+from app import generations
+from app import local_index
 
 # === ENVIRONMENT SETUP ===
 load_dotenv()
@@ -31,12 +37,29 @@ REGION = "us-east-1"
 USER_POOL_ID = "us-east-1_3GBn9c4Qm"
 AUDIENCE = os.getenv("COGNITO_CLIENT_ID")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-s3_client = boto3.client("s3")
+S3_FETCH_WORKERS = int(os.getenv("S3_FETCH_WORKERS", "8"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "256"))
 
 #=== HELPERS ===
-def hash_to_uuid(text):
-    return str(uuid.UUID(hashlib.sha256(text.encode("utf-8")).hexdigest()[0:32]))
+def _shard_kwargs(shard_key):
+    # Only pass shard_key_selector when the tenant layout uses custom sharding
+    return {"shard_key_selector": shard_key} if shard_key is not None else {}
+
+def _read_s3_text(bucket_name, key):
+    """The object's text, or None if it no longer exists (deleted after it was listed or announced)."""
+    from botocore.exceptions import ClientError
+    try:
+        s3_response = get_s3_client().get_object(Bucket=bucket_name, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        raise
+    return s3_response["Body"].read().decode("utf-8")
+
+def _read_s3_texts(bucket_name, keys):
+    # Downloads are I/O bound: fetch them concurrently; missing objects come back as None
+    with ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS) as pool:
+        return list(pool.map(lambda key: _read_s3_text(bucket_name, key), keys))
 
 def load_and_chunk_markdown_from_s3(bucket_name, user_id, project_folder=None, debug=False):
     chunks = []
@@ -46,54 +69,30 @@ def load_and_chunk_markdown_from_s3(bucket_name, user_id, project_folder=None, d
 
     if debug:
         print(f"\n🔍 Listing objects in s3://{bucket_name}/{prefix}")
-    response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix)
+    response = get_s3_client().list_objects_v2(Bucket=bucket_name, Prefix=prefix)
     
     if debug:
         print(f"📁 Found {len(response.get('Contents', []))} objects in S3")
-    
-    for obj in response.get("Contents", []):
-        key = obj["Key"]
-        if not key.endswith(".md"):
-            continue
 
-        if debug:
-            print(f"\n📄 Processing file: {key}")
-        s3_response = s3_client.get_object(Bucket=bucket_name, Key=key)
-        text = s3_response["Body"].read().decode("utf-8")
+    keys = [obj["Key"] for obj in response.get("Contents", []) if obj["Key"].endswith(".md")]
+
+    texts = _read_s3_texts(bucket_name, keys)
+    keys, texts = [k for k, t in zip(keys, texts) if t is not None], [t for t in texts if t is not None]
 
-        html = markdown(text)
-        plain = BeautifulSoup(html, "html.parser").get_text()
-        words = plain.split()
+    # Parsing and hashing are CPU bound: large imports go through a process pool
+    per_file = chunk_documents(list(zip(keys, texts)), user_id, project_folder, CHUNK_SIZE, CHUNK_OVERLAP)
 
+    for key, file_chunks in zip(keys, per_file):
         if debug:
-            print(f"📝 Found {len(words)} words in {key}")
-        
-        for i in range(0, len(words), CHUNK_SIZE - CHUNK_OVERLAP):
-            chunk_text = " ".join(words[i:i + CHUNK_SIZE])
-            if chunk_text.strip():
-                chunk_id_input = f"{user_id}|{project_folder}|{chunk_text}"
-                chunk_id = hash_to_uuid(chunk_id_input)
-                parts = key.split("/")
-                file_project_folder = parts[2] if len(parts) > 3 else "root"
-                filename = parts[-1]
-
-                chunks.append({
-                    "id": chunk_id,
-                    "text": chunk_text,
-                    "metadata": {
-                        "user_id": str(user_id),
-                        "project_folder": file_project_folder,
-                        "filename": filename,
-                        "source": key
-                    }
-                })
+            print(f"📄 {key}: {len(file_chunks)} chunks")
+        chunks.extend(file_chunks)
     
     if debug:
         print(f"\n📦 Generated {len(chunks)} chunks from all files")
     return chunks
 
 # === STEP 2: Filter Out Already Uploaded Chunks ===
-def filter_new_chunks(client, collection_name, chunks, debug=False):
+def filter_new_chunks(client, collection_name, chunks, debug=False, shard_key=None):
     new_chunks = []
     if debug:
         print(f"\n🔍 Checking {len(chunks)} chunks against existing database...")
@@ -102,9 +101,14 @@ def filter_new_chunks(client, collection_name, chunks, debug=False):
     existing_ids = set()
     for i in range(0, len(chunks), 100):
         batch = chunks[i:i+100]
-        batch_ids = [chunk["id"] for chunk in batch]
+        batch_ids = [chunk.id for chunk in batch]
         try:
-            results = client.retrieve(collection_name=collection_name, ids=batch_ids, with_vectors=False)
+            results = client.retrieve(
+                collection_name=collection_name,
+                ids=batch_ids,
+                with_vectors=False,
+                **_shard_kwargs(shard_key)
+            )
             existing_ids.update(result.id for result in results)
         except Exception as e:
             if debug:
@@ -114,27 +118,54 @@ def filter_new_chunks(client, collection_name, chunks, debug=False):
         print(f"📊 Found {len(existing_ids)} existing chunks in database")
     
     # Filter chunks that don't exist
-    new_chunks = [chunk for chunk in chunks if chunk["id"] not in existing_ids]
+    new_chunks = [chunk for chunk in chunks if chunk.id not in existing_ids]
     if debug:
         print(f"✨ Found {len(new_chunks)} new chunks to add")
     
     return new_chunks
 
 # === STEP 3: Embed New Chunks ===
-def embed_chunks(chunks, model_name="text-embedding-3-small", debug=False):
-    texts = [chunk["text"] for chunk in chunks]
-    embedded_chunks = []
-
+def _decode_embedding(data) -> np.ndarray:
+    # encoding_format="base64" returns little-endian float32 bytes; decode
+    # them straight into an array instead of a list of Python floats
+    if isinstance(data, str):
+        return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+    return np.asarray(data, dtype=np.float32)
+
+def embed_chunks(chunks, model_name="text-embedding-3-small", debug=False, user_id=None, stats=None):
+    """
+    Embed chunk texts, reusing vectors from the content-addressed cache.
+    Only texts that are neither cached nor repeated earlier in this run go to
+    OpenAI. Returns a float32 matrix with one row per chunk. If a stats dict
+    is passed, it gets the number of embeddings reused.
+    """
+    texts = [chunk.text for chunk in chunks]
+    # Cached rows are decoded straight into the result matrix
+    vectors, found = embedding_cache.lookup(model_name, texts)
+
+    # Unique texts that still need an embedding
+    pending = {}
+    for idx in np.flatnonzero(~found):
+        pending.setdefault(texts[idx], []).append(idx)
+    pending_texts = list(pending)
+
+    reused = len(texts) - len(pending_texts)
+    if stats is not None:
+        stats["embeddings_reused"] = reused
     if debug:
-        print("📦 Sending chunks to OpenAI for embedding...")
+        print(f"♻️ Reusing {reused} cached embeddings, sending {len(pending_texts)} chunks to OpenAI...")
 
-    for i in tqdm(range(0, len(texts), 100), desc="🔌 Embedding with OpenAI"):
-        batch = texts[i:i+100]
+    for i in tqdm(range(0, len(pending_texts), 100), desc="🔌 Embedding with OpenAI"):
+        batch = pending_texts[i:i+100]
 
         for attempt in range(5):
             try:
-                response = client.embeddings.create(input=batch, model=model_name)
+                with admit("openai_embed", user_id):
+                    response = get_openai_client().embeddings.create(input=batch, model=model_name, encoding_format="base64")
                 break
+            except Overloaded:
+                # Let the caller see the 429/503 instead of retrying into a full queue
+                raise
             except Exception as e:
                 if debug:
                     print(f"⚠️ Attempt {attempt+1} failed: {e}")
@@ -142,83 +173,44 @@ def embed_chunks(chunks, model_name="text-embedding-3-small", debug=False):
         else:
             raise RuntimeError("❌ Failed to embed after 5 retries.")
 
-        embeddings = [record.embedding for record in response.data]
-
-        for j, vector in enumerate(embeddings):
-            chunk = chunks[i + j]
-            embedded_chunks.append({
-                "id": chunk["id"],
-                "embedding": vector,
-                "text": chunk["text"],
-                "metadata": chunk["metadata"]
-            })
-
-    return embedded_chunks
-
+        embeddings = [_decode_embedding(record.embedding) for record in response.data]
+        embedding_cache.store(model_name, batch, embeddings)
 
-def ensure_metadata_indexes(client, collection_name, debug=False):
-    required_indexes = {
-        "user_id": PayloadSchemaType.KEYWORD,
-        "project_folder": PayloadSchemaType.KEYWORD,
-        "filename": PayloadSchemaType.KEYWORD,
-    }
+        if vectors is None:
+            vectors = np.empty((len(chunks), len(embeddings[0])), dtype=np.float32)
+        for text, vector in zip(batch, embeddings):
+            vectors[pending[text]] = vector
 
-    existing_indexes = client.get_collection(collection_name).payload_schema
+    if vectors is None:
+        vectors = np.empty((0, 0), dtype=np.float32)
+    return vectors
 
-    for field, schema in required_indexes.items():
-        if field not in existing_indexes:
-            if debug:
-                print(f"🔧 Creating index on: {field}")
-            client.create_payload_index(
-                collection_name=collection_name,
-                field_name=field,
-                field_schema=schema
-            )
 
 # === STEP 4: Upload to Qdrant Cloud ===
-def upload_to_qdrant(embedded_chunks, client, collection_name, debug=False):
-    vector_dim = len(embedded_chunks[0]["embedding"])
-
-    if not client.collection_exists(collection_name=collection_name):
-        client.create_collection(
-            collection_name=collection_name,
-            vectors_config=VectorParams(size=vector_dim, distance=Distance.COSINE)
-        )
-
-    # 🆕 Ensure proper metadata indexes exist
-    ensure_metadata_indexes(client, collection_name, debug)
-
-    points = [
-        PointStruct(
-            id=chunk["id"],
-            vector=chunk["embedding"],
-            payload={
-                "text": chunk["text"],
-                **chunk["metadata"]
-            }
+def upload_to_qdrant(chunks, vectors, client, collection_name, debug=False, shard_key=None):
+    """
+    Upsert chunks with their rows of the vectors matrix, UPSERT_BATCH_SIZE
+    points per request. Only one batch is converted for the wire at a time.
+    """
+    # Create the collection / shard key for this tenant and its metadata indexes
+    ensure_tenant_collection(client, collection_name, shard_key, vectors.shape[1], debug)
+
+    for i in range(0, len(chunks), UPSERT_BATCH_SIZE):
+        batch = chunks[i:i+UPSERT_BATCH_SIZE]
+        points = Batch(
+            ids=[chunk.id for chunk in batch],
+            vectors=vectors[i:i+UPSERT_BATCH_SIZE].tolist(),
+            payloads=[chunk.payload() for chunk in batch]
         )
-        for chunk in embedded_chunks
-    ]
-
-    client.upsert(collection_name=collection_name, points=points)
+        with admit("qdrant"):
+            client.upsert(collection_name=collection_name, points=points, **_shard_kwargs(shard_key))
 
-def get_existing_vectors(client, collection_name, user_id, project_folder=None, debug=False):
+def get_existing_vectors(client, collection_name, user_id, project_folder=None, debug=False, shard_key=None):
     """
     Get all existing vectors for a user/project from Qdrant.
     Handles pagination to get all vectors.
     """
-    filter_conditions = [
-        FieldCondition(key="user_id", match=MatchValue(value=str(user_id)))
-    ]
-    
-    if project_folder:
-        filter_conditions.append(
-            FieldCondition(key="project_folder", match=MatchValue(value=project_folder))
-        )
-    
-    filter = Filter(
-        must=filter_conditions
-    )
+    filter = tenant_filter(user_id, project_folder)
     
     if debug:
         print(f"\n🔍 Retrieving existing vectors for user {user_id}")
@@ -237,7 +229,8 @@ def get_existing_vectors(client, collection_name, user_id, project_folder=None,
             with_payload=True,
             with_vectors=False,
             limit=100,
-            offset=next_page_offset
+            offset=next_page_offset,
+            **_shard_kwargs(shard_key)
         )
         
         points, next_page_offset = response
@@ -254,7 +247,7 @@ def get_existing_vectors(client, collection_name, user_id, project_folder=None,
     
     return all_points
 
-def cleanup_deleted_files(client, collection_name, user_id, project_folder=None, debug=False):
+def cleanup_deleted_files(client, collection_name, user_id, project_folder=None, debug=False, shard_key=None):
     """
     Remove vectors for files that no longer exist in S3.
     Returns information about deleted files.
@@ -267,14 +260,14 @@ def cleanup_deleted_files(client, collection_name, user_id, project_folder=None,
     if debug:
         print(f"\n🔍 Checking for deleted files in s3://{S3_BUCKET_NAME}/{prefix}")
     
-    response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=prefix)
+    response = get_s3_client().list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=prefix)
     existing_s3_files = {obj["Key"] for obj in response.get("Contents", []) if obj["Key"].endswith(".md")}
     
     if debug:
         print(f"📁 Found {len(existing_s3_files)} files in S3")
     
     # Get all vectors from Qdrant
-    existing_vectors = get_existing_vectors(client, collection_name, user_id, project_folder, debug)
+    existing_vectors = get_existing_vectors(client, collection_name, user_id, project_folder, debug, shard_key)
     
     # Find vectors to delete (files that exist in Qdrant but not in S3)
     vectors_to_delete = []
@@ -298,7 +291,8 @@ def cleanup_deleted_files(client, collection_name, user_id, project_folder=None,
             batch = vectors_to_delete[i:i+100]
             client.delete(
                 collection_name=collection_name,
-                points_selector=batch
+                points_selector=batch,
+                **_shard_kwargs(shard_key)
             )
         
         if debug:
@@ -317,22 +311,35 @@ def embed_s3_markdown(user_id: str, project_folder: str = None, debug: bool = Fa
     if debug:
         print(f"📂 Loading and chunking Markdown files from s3://{S3_BUCKET_NAME}/{user_id}/")
     chunks = load_and_chunk_markdown_from_s3(S3_BUCKET_NAME, user_id, project_folder, debug)
+    # Write to each project's active index generation
+    seen_generations = generations.assign(user_id, chunks)
 
-    client = QdrantClient(url=QDRANT_HOST, api_key=QDRANT_API_KEY)
+    client = get_qdrant_client()
+    collection_name, shard_key = route_tenant(user_id)
 
     # First, clean up any deleted files
     if debug:
         print("\n🧹 Cleaning up vectors for deleted files...")
-    cleanup_result = cleanup_deleted_files(client, COLLECTION_NAME, user_id, project_folder, debug)
+    if client.collection_exists(collection_name=collection_name):
+        cleanup_result = cleanup_deleted_files(client, collection_name, user_id, project_folder, debug, shard_key)
+    else:
+        cleanup_result = {"deleted_files": [], "deleted_vectors": 0}
 
     if debug:
         print("\n🧠 Filtering out already uploaded chunks...")
-    new_chunks = filter_new_chunks(client, COLLECTION_NAME, chunks, debug)
+    new_chunks = filter_new_chunks(client, collection_name, chunks, debug, shard_key)
 
     if not new_chunks and not cleanup_result["deleted_vectors"]:
+        if local_index.LOCAL_INDEX_SYNC:
+            # sync() only touches changed projects; make sure unchanged ones have a local index too
+            for project in seen_generations:
+                local_index.ensure_exported(client, user_id, project, debug)
         return {"message": "✅ No changes needed."}
 
     if not new_chunks:
+        local_index.sync(client, user_id, deleted_sources=cleanup_result["deleted_files"], debug=debug)
+        if generations.finish_update(user_id, seen_generations):
+            return embed_s3_markdown(user_id, project_folder, debug)
         return {
             "message": f"✅ Cleaned up {cleanup_result['deleted_vectors']} vectors from deleted files.",
             "deleted_files": cleanup_result["deleted_files"]
@@ -340,15 +347,120 @@ def embed_s3_markdown(user_id: str, project_folder: str = None, debug: bool = Fa
 
     if debug:
         print(f"🧠 Embedding {len(new_chunks)} new chunks...")
-    embedded = embed_chunks(new_chunks, EMBEDDING_MODEL, debug)
+    embed_stats = {}
+    vectors = embed_chunks(new_chunks, EMBEDDING_MODEL, debug, user_id, embed_stats)
 
     if debug:
-        print(f"⬆️ Uploading to Qdrant Cloud ({COLLECTION_NAME})...")
-    upload_to_qdrant(embedded, client, COLLECTION_NAME, debug)
+        print(f"♻️ Avoided {embed_stats.get('embeddings_reused', 0)} embedding calls via the cache")
+        print(f"⬆️ Uploading to Qdrant Cloud ({collection_name}, shard key: {shard_key})...")
+    upload_to_qdrant(new_chunks, vectors, client, collection_name, debug, shard_key)
+    local_index.sync(client, user_id, new_chunks, vectors, cleanup_result["deleted_files"], debug=debug)
+    if generations.finish_update(user_id, seen_generations):
+        # A rebuild switched generations while this ran; bring the new one up to date too
+        return embed_s3_markdown(user_id, project_folder, debug)
 
     return {
-        "message": f"✅ Uploaded {len(embedded)} chunks to Qdrant.",
+        "message": f"✅ Uploaded {len(new_chunks)} chunks to Qdrant.",
         "deleted_files": cleanup_result["deleted_files"],
         "deleted_vectors": cleanup_result["deleted_vectors"],
-        "new_chunks": len(embedded)
-    }
\ No newline at end of file
+        "new_chunks": len(new_chunks),
+        "embeddings_reused": embed_stats.get("embeddings_reused", 0)
+    }
+
+# === INCREMENTAL UPDATES ===
+def _source_point_ids(client, collection_name, user_id, key, shard_key=None, generation=None):
+    """IDs of every point that was chunked from one S3 object (in one generation, if given)."""
+    ids = []
+    next_page_offset = None
+    while True:
+        points, next_page_offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=tenant_filter(user_id, source=key, generation=generation),
+            with_payload=False,
+            with_vectors=False,
+            limit=256,
+            offset=next_page_offset,
+            **_shard_kwargs(shard_key)
+        )
+        ids.extend(point.id for point in points)
+        if not next_page_offset:
+            return ids
+
+def reindex_s3_objects(user_id: str, project_folder: str, updated_keys, deleted_keys, debug: bool = False):
+    """
+    Apply a batch of S3 changes for one project without rescanning its prefix:
+    updated keys are re-chunked and only their new chunks are embedded (stale
+    chunks of those files are removed), deleted keys lose all their points.
+    Writes go to the project's active index generation.
+    """
+    client = get_qdrant_client()
+    collection_name, shard_key = route_tenant(user_id)
+    collection_exists = client.collection_exists(collection_name=collection_name)
+    generation = generations.active(user_id, project_folder)
+    deleted_vectors = 0
+    stale_ids = {}
+
+    texts = _read_s3_texts(S3_BUCKET_NAME, updated_keys) if updated_keys else []
+    missing = [key for key, text in zip(updated_keys, texts) if text is None]
+    if missing:
+        # Deleted since its put event was sent: apply it as a delete rather than failing the batch
+        if debug:
+            print(f"👻 {len(missing)} updated objects no longer exist, deleting them instead")
+        updated_keys = [key for key, text in zip(updated_keys, texts) if text is not None]
+        texts = [text for text in texts if text is not None]
+        deleted_keys = list(deleted_keys) + missing
+
+    if collection_exists:
+        # Deleted files leave every generation, including one being rebuilt
+        for key in deleted_keys:
+            ids = _source_point_ids(client, collection_name, user_id, key, shard_key)
+            if ids:
+                with admit("qdrant"):
+                    client.delete(
+                        collection_name=collection_name,
+                        points_selector=FilterSelector(filter=tenant_filter(user_id, source=key)),
+                        **_shard_kwargs(shard_key)
+                    )
+                deleted_vectors += len(ids)
+            if debug:
+                print(f"🗑️ {key}: removed {len(ids)} vectors")
+
+    chunks = []
+    if updated_keys:
+        per_file = chunk_documents(list(zip(updated_keys, texts)), user_id, project_folder, CHUNK_SIZE, CHUNK_OVERLAP)
+        for key, file_chunks in zip(updated_keys, per_file):
+            for chunk in file_chunks:
+                chunk.id = generations.point_id(chunk.id, generation)
+                chunk.generation = generation
+            if collection_exists:
+                current_ids = {chunk.id for chunk in file_chunks}
+                stale = [pid for pid in _source_point_ids(client, collection_name, user_id, key, shard_key, generation)
+                         if str(pid) not in current_ids]
+                if stale:
+                    with admit("qdrant"):
+                        client.delete(collection_name=collection_name, points_selector=stale, **_shard_kwargs(shard_key))
+                    deleted_vectors += len(stale)
+                    stale_ids.setdefault(local_index._project_of(key), []).extend(str(pid) for pid in stale)
+                if debug:
+                    print(f"📄 {key}: {len(file_chunks)} chunks, {len(stale)} stale removed")
+            chunks.extend(file_chunks)
+
+    new_chunks = filter_new_chunks(client, collection_name, chunks, debug, shard_key) if collection_exists else chunks
+    embed_stats = {}
+    vectors = None
+    if new_chunks:
+        vectors = embed_chunks(new_chunks, EMBEDDING_MODEL, debug, user_id, embed_stats)
+        upload_to_qdrant(new_chunks, vectors, client, collection_name, debug, shard_key)
+    if collection_exists or new_chunks:
+        local_index.sync(client, user_id, new_chunks, vectors, deleted_keys, stale_ids, debug)
+    if generations.finish_update(user_id, {project_folder: generation}):
+        # A rebuild switched generations while this ran; apply the batch to the new one too
+        return reindex_s3_objects(user_id, project_folder, updated_keys, deleted_keys, debug)
+
+    return {
+        "updated_files": list(updated_keys),
+        "deleted_files": list(deleted_keys),
+        "new_chunks": len(new_chunks),
+        "deleted_vectors": deleted_vectors,
+        "embeddings_reused": embed_stats.get("embeddings_reused", 0)
+    }
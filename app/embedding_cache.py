@@ -0,0 +1,203 @@
+"""
+Content-addressed embedding cache.
+
+Embeddings are keyed by (model, sha256(chunk text)) so identical text in a
+copied project, a duplicated template or a forked draft is only embedded once,
+no matter which user or project it belongs to. Point IDs in Qdrant stay
+tenant-scoped; only the vectors are shared.
+
+EMBEDDING_CACHE_BACKEND selects the store:
+    local - append-only memory-mapped float32 file per model (one host; default)
+    redis - float32 bytes under emb:{model}:{hash} (shared by every host)
+    off   - no caching
+
+Every cached chunk costs dim * 4 bytes plus key overhead: about 6 KB for
+text-embedding-3-small (1536 dims), so 100k distinct chunks take ~600 MB.
+The Redis backend is opt-in for that reason. Point EMBEDDING_CACHE_REDIS_URL
+at a dedicated instance (maxmemory with allkeys-lru) rather than the one
+holding chat sessions and locks, which LRU eviction would otherwise drop
+and noeviction would turn into failed writes. Entries expire after
+EMBEDDING_CACHE_TTL either way.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from redis.exceptions import RedisError
+
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_BACKEND = os.getenv("EMBEDDING_CACHE_BACKEND", "local")
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "embedding_cache")
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+# Dedicated Redis for the redis backend; empty means the shared one from app.redis_client
+EMBEDDING_CACHE_REDIS_URL = os.getenv("EMBEDDING_CACHE_REDIS_URL", "")
+# Keys per MGET, so a large project isn't read back as one huge reply
+EMBEDDING_CACHE_MGET_BATCH = int(os.getenv("EMBEDDING_CACHE_MGET_BATCH", "512"))
+
+# (vectors, found): one float32 row per digest; rows where found is False are unset
+Lookup = Tuple[Optional[np.ndarray], np.ndarray]
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RedisEmbeddingStore:
+    def __init__(self, model: str):
+        self.model = model
+        self._redis = None
+
+    def _key(self, digest: str) -> str:
+        return f"emb:{self.model}:{digest}"
+
+    def _client(self):
+        if not EMBEDDING_CACHE_REDIS_URL:
+            return get_redis()
+        if self._redis is None:
+            import redis
+            self._redis = redis.Redis.from_url(EMBEDDING_CACHE_REDIS_URL, socket_timeout=5, socket_connect_timeout=2)
+        return self._redis
+
+    def get_many(self, digests: List[str]) -> Lookup:
+        r = self._client()
+        vectors = None
+        found = np.zeros(len(digests), dtype=bool)
+        for start in range(0, len(digests), EMBEDDING_CACHE_MGET_BATCH):
+            raw = r.mget([self._key(d) for d in digests[start:start + EMBEDDING_CACHE_MGET_BATCH]])
+            for i, value in enumerate(raw, start):
+                if value is None:
+                    continue
+                if vectors is None:
+                    vectors = np.empty((len(digests), len(value) // 4), dtype=np.float32)
+                if len(value) != vectors.shape[1] * 4:
+                    # Written with another dimension under the same model name; treat as a miss
+                    continue
+                vectors[i] = np.frombuffer(value, dtype=np.float32)
+                found[i] = True
+        return vectors, found
+
+    def put_many(self, digests: List[str], vectors: List[np.ndarray]):
+        pipe = self._client().pipeline(transaction=False)
+        for digest, vector in zip(digests, vectors):
+            pipe.set(self._key(digest), np.asarray(vector, dtype=np.float32).tobytes(), ex=EMBEDDING_CACHE_TTL)
+        pipe.execute()
+
+
+class LocalEmbeddingStore:
+    """
+    Append-only store: {model}.f32 holds float32 rows, {model}.idx holds one
+    "hash row dim" line per row. Writers take an flock so several workers on
+    a host can share the files; readers memory-map the vector file.
+    """
+
+    def __init__(self, directory: str, model: str):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        safe_model = model.replace("/", "_")
+        self.vec_path = Path(directory) / f"{safe_model}.f32"
+        self.idx_path = Path(directory) / f"{safe_model}.idx"
+        self.vec_path.touch(exist_ok=True)
+        self.idx_path.touch(exist_ok=True)
+        self.index: Dict[str, int] = {}
+        self.dim = None
+        self._idx_offset = 0
+        self._mmap = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        # Pick up rows appended by other processes since the last read
+        with open(self.idx_path, "rb") as f:
+            f.seek(self._idx_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            digest, row, dim = line.decode().split()
+            self.index[digest] = int(row)
+            self.dim = int(dim)
+        self._idx_offset += end
+
+    def _vectors(self) -> np.ndarray:
+        rows = self.vec_path.stat().st_size // (4 * self.dim)
+        if self._mmap is None or self._mmap.shape[0] < rows:
+            self._mmap = np.memmap(self.vec_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return self._mmap
+
+    def get_many(self, digests: List[str]) -> Lookup:
+        with self._lock:
+            self._refresh()
+            rows = np.array([self.index.get(d, -1) for d in digests], dtype=np.int64)
+            found = rows >= 0
+            if self.dim is None or not found.any():
+                return None, np.zeros(len(digests), dtype=bool)
+            vectors = np.empty((len(digests), self.dim), dtype=np.float32)
+            vectors[found] = self._vectors()[rows[found]]
+            return vectors, found
+
+    def put_many(self, digests: List[str], vectors: List[np.ndarray]):
+        with self._lock, open(self.idx_path, "ab") as idx_file:
+            fcntl.flock(idx_file, fcntl.LOCK_EX)
+            try:
+                self._refresh()
+                with open(self.vec_path, "ab") as vec_file:
+                    dim = len(vectors[0])
+                    row = vec_file.tell() // (4 * dim)
+                    lines = []
+                    for digest, vector in zip(digests, vectors):
+                        if digest in self.index:
+                            continue
+                        vec_file.write(np.asarray(vector, dtype=np.float32).tobytes())
+                        lines.append(f"{digest} {row} {dim}\n")
+                        row += 1
+                # Vectors are flushed before their index lines become visible
+                idx_file.write("".join(lines).encode())
+                idx_file.flush()
+            finally:
+                fcntl.flock(idx_file, fcntl.LOCK_UN)
+
+
+_stores = {}
+
+
+def get_store(model: str):
+    if EMBEDDING_CACHE_BACKEND == "off":
+        return None
+    if model not in _stores:
+        if EMBEDDING_CACHE_BACKEND == "local":
+            _stores[model] = LocalEmbeddingStore(EMBEDDING_CACHE_DIR, model)
+        else:
+            _stores[model] = RedisEmbeddingStore(model)
+    return _stores[model]
+
+
+def lookup(model: str, texts: List[str]) -> Lookup:
+    """
+    Cached vectors for texts as (matrix, found): the matrix has one float32
+    row per text and is None when nothing was cached. Cache errors count as
+    misses.
+    """
+    store = get_store(model)
+    missed = (None, np.zeros(len(texts), dtype=bool))
+    if store is None or not texts:
+        return missed
+    try:
+        return store.get_many([text_hash(t) for t in texts])
+    except (RedisError, OSError, ValueError) as e:
+        logger.warning(f"Embedding cache lookup failed: {e}")
+        return missed
+
+
+def store(model: str, texts: List[str], vectors: List) -> None:
+    cache = get_store(model)
+    if cache is None or not texts:
+        return
+    try:
+        cache.put_many([text_hash(t) for t in texts], vectors)
+    except (RedisError, OSError) as e:
+        logger.warning(f"Embedding cache store failed: {e}")
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Blue/green index generations per project.
+
+Every point carries a `generation` payload field (points written before this
+existed have none and count as generation 0), and Redis holds each project's
+active generation. Searches and incremental updates only touch the active
+generation.
+
+rebuild() re-chunks and re-embeds a project into a new generation with the
+current settings (CHUNK_SIZE, CHUNKING_MODE, EMBEDDING_MODEL), while chat
+keeps searching the old one. Point IDs of generation N > 0 are salted with N,
+so the rebuild never overwrites a live point. The rebuild is paced at
+REBUILD_POINTS_PER_SECOND and backs off while this worker's recent Qdrant
+search p95 is above REBUILD_MAX_SEARCH_P95_MS. The embedding cache means an
+unchanged model costs no OpenAI calls.
+
+Incremental updates bump a per-project change counter when they finish.
+Before switching, the rebuild re-syncs the new generation from S3. It then
+switches the active generation with one WATCHed SET, so the switch only
+happens if no update finished in between; otherwise it syncs again. An update
+that was still running at the switch sees the generation move when it
+finishes and runs again against the new one (embed.embed_s3_markdown,
+embed.reindex_s3_objects).
+
+After REBUILD_GC_DELAY seconds (longer than GENERATION_CACHE_SECONDS plus a
+search), every point of the project from generations older than the active
+one is deleted, REBUILD_GC_BATCH at a time. That includes generations left by
+earlier failed rebuilds. Newer generations are never touched. The rebuild
+lock is refreshed through the delay and every GC batch, and GC stops if the
+lock is lost.
+
+A new embedding model with a different dimension needs its own collection;
+generations share the tenant's collection.
+
+    python -m app.generations rebuild --user U --project P
+    python -m app.generations status --user U --project P
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Tuple
+
+from dotenv import load_dotenv
+from redis.exceptions import RedisError, WatchError
+
+from app.chunking import hash_to_uuid
+from app.redis_client import extend_lock, get_redis, release_lock
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# How long a worker may keep using a cached active generation
+GENERATION_CACHE_SECONDS = float(os.getenv("GENERATION_CACHE_SECONDS", "2"))
+REBUILD_BATCH_SIZE = int(os.getenv("REBUILD_BATCH_SIZE", "256"))
+REBUILD_POINTS_PER_SECOND = float(os.getenv("REBUILD_POINTS_PER_SECOND", "200"))
+REBUILD_MAX_SEARCH_P95_MS = float(os.getenv("REBUILD_MAX_SEARCH_P95_MS", "250"))
+# Longest a batch waits for live search latency to recover
+REBUILD_MAX_PAUSE = float(os.getenv("REBUILD_MAX_PAUSE", "30"))
+REBUILD_GC_DELAY = float(os.getenv("REBUILD_GC_DELAY", "60"))
+REBUILD_GC_BATCH = int(os.getenv("REBUILD_GC_BATCH", "1000"))
+# Sync passes before giving up on a project that never stops changing
+REBUILD_MAX_PASSES = int(os.getenv("REBUILD_MAX_PASSES", "5"))
+REBUILD_LOCK_TTL = int(os.getenv("REBUILD_LOCK_TTL", "600"))
+
+_cache: Dict[tuple, tuple] = {}
+
+
+class RebuildInProgress(Exception):
+    def __init__(self, user_id: str, project_folder: str):
+        super().__init__(f"A rebuild of {user_id}/{project_folder} is already running")
+
+
+def _key(kind: str, user_id: str, project_folder: Optional[str]) -> str:
+    return f"gen:{kind}:{user_id}:{project_folder or 'root'}"
+
+
+def version(user_id: str, project_folder: Optional[str], fresh: bool = False) -> Tuple[int, int, str]:
+    """
+    (active generation, change counter, epoch) of the project, cached for
+    GENERATION_CACHE_SECONDS. One of them moves whenever the searchable index
+    does, so cached search results can be keyed by it. The epoch is a random
+    ID created with the project's first lookup; a Redis flush resets the
+    counters but also the epoch. It is "" when Redis can't be read.
+    """
+    cache_key = (str(user_id), project_folder or "root")
+    cached = _cache.get(cache_key)
+    now = time.monotonic()
+    if cached and not fresh and now - cached[0] < GENERATION_CACHE_SECONDS:
+        return cached[1]
+    epoch_key = _key("epoch", user_id, project_folder)
+    try:
+        r = get_redis()
+        generation, changes, epoch = r.mget(_key("active", user_id, project_folder),
+                                            _key("changes", user_id, project_folder), epoch_key)
+        if epoch is None:
+            # First lookup since the project appeared (or Redis was flushed); the first writer wins
+            r.set(epoch_key, uuid.uuid4().hex, nx=True)
+            epoch = r.get(epoch_key)
+    except RedisError as e:
+        logger.warning(f"Could not read the active generation of {user_id}/{project_folder}: {e}")
+        return cached[1] if cached else (0, 0, "")
+    current = (int(generation or 0), int(changes or 0), (epoch or b"").decode())
+    _cache[cache_key] = (now, current)
+    return current
+
+
+def active(user_id: str, project_folder: Optional[str], fresh: bool = False) -> int:
+    """The project's active generation (0 before its first rebuild), cached for GENERATION_CACHE_SECONDS."""
+    return version(user_id, project_folder, fresh)[0]
+
+
+def point_id(chunk_id: str, generation: int) -> str:
+    """Generation 0 keeps the original chunk IDs; later generations get their own."""
+    return hash_to_uuid(f"{chunk_id}|g{generation}") if generation else chunk_id
+
+
+def assign(user_id: str, chunks: Iterable) -> Dict[str, int]:
+    """Point chunks at their project's active generation. Returns {project_folder: generation}."""
+    seen = {}
+    for chunk in chunks:
+        generation = seen.get(chunk.project_folder)
+        if generation is None:
+            generation = seen[chunk.project_folder] = active(user_id, chunk.project_folder)
+        chunk.id = point_id(chunk.id, generation)
+        chunk.generation = generation
+    return seen
+
+
+def finish_update(user_id: str, seen: Dict[str, int]) -> bool:
+    """
+    Record that an incremental update wrote to these generations. Returns True
+    if one of them stopped being active meanwhile, in which case the caller
+    should run the update again.
+    """
+    from app import local_index
+
+    moved = False
+    for project_folder, generation in seen.items():
+        try:
+            changes = get_redis().incr(_key("changes", user_id, project_folder))
+        except RedisError as e:
+            logger.warning(f"Could not record a change to {user_id}/{project_folder}: {e}")
+        else:
+            if local_index.LOCAL_INDEX_SYNC:
+                # This host's local index already has the update
+                local_index.record_update(user_id, project_folder, generation, changes)
+        if active(user_id, project_folder, fresh=True) != generation:
+            moved = True
+    return moved
+
+
+class Throttle:
+    """Paces a rebuild: at most points_per_second, and paused while live searches are slow."""
+
+    def __init__(self, points_per_second: float = REBUILD_POINTS_PER_SECOND,
+                 max_search_p95_ms: float = REBUILD_MAX_SEARCH_P95_MS):
+        self.interval = 1 / points_per_second if points_per_second > 0 else 0.0
+        self.max_search_p95 = max_search_p95_ms / 1000
+        self.next_at = time.monotonic()
+        self.paused_seconds = 0.0
+
+    def _search_p95(self) -> Optional[float]:
+        from app import resilience
+        return resilience.policies["qdrant"].latency_percentile(95)
+
+    def wait(self, points: int):
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(self.next_at, now) + points * self.interval
+
+        paused = 0.0
+        while paused < REBUILD_MAX_PAUSE:
+            p95 = self._search_p95()
+            if p95 is None or p95 <= self.max_search_p95:
+                break
+            time.sleep(1.0)
+            paused += 1.0
+        self.paused_seconds += paused
+
+
+# === REBUILD ===
+def _acquire_lock(user_id: str, project_folder: str) -> Optional[str]:
+    token = uuid.uuid4().hex
+    if get_redis().set(_key("rebuild", user_id, project_folder), token, nx=True, ex=REBUILD_LOCK_TTL):
+        return token
+    return None
+
+
+def _refresh_lock(user_id: str, project_folder: str, token: str):
+    if not extend_lock(get_redis(), _key("rebuild", user_id, project_folder), token, REBUILD_LOCK_TTL):
+        raise RuntimeError(f"Lost the rebuild lock for {user_id}/{project_folder}")
+
+
+def _release_lock(user_id: str, project_folder: str, token: str):
+    try:
+        release_lock(get_redis(), _key("rebuild", user_id, project_folder), token)
+    except RedisError:
+        pass
+
+
+def _sleep_holding_lock(seconds: float, user_id: str, project_folder: str, token: str):
+    """Sleep, refreshing the rebuild lock often enough that it can't expire meanwhile."""
+    deadline = time.monotonic() + seconds
+    while True:
+        _refresh_lock(user_id, project_folder, token)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, REBUILD_LOCK_TTL / 3))
+
+
+def _with_backoff(fn):
+    """Background work yields to live traffic: wait out admission rejections instead of failing."""
+    from app.admission import Overloaded
+    while True:
+        try:
+            return fn()
+        except Overloaded as e:
+            time.sleep(e.retry_after)
+
+
+def _generation_point_ids(client, collection_name, shard_key, user_id, project_folder, generation):
+    from app.tenancy import tenant_filter
+
+    kwargs = {"shard_key_selector": shard_key} if shard_key is not None else {}
+    ids = []
+    next_page_offset = None
+    while True:
+        points, next_page_offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=tenant_filter(user_id, project_folder, generation=generation),
+            with_payload=False,
+            with_vectors=False,
+            limit=REBUILD_GC_BATCH,
+            offset=next_page_offset,
+            **kwargs
+        )
+        ids.extend(str(point.id) for point in points)
+        if not next_page_offset:
+            return ids
+
+
+def _sync_generation(client, collection_name, shard_key, user_id, project_folder, generation, throttle, token, debug=False):
+    """Make one generation match S3: embed chunks it is missing, drop chunks S3 no longer has."""
+    from app.admission import admit
+    from app.embed import (
+        CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_MODEL, S3_BUCKET_NAME,
+        embed_chunks, filter_new_chunks, load_and_chunk_markdown_from_s3, upload_to_qdrant,
+    )
+
+    chunks = load_and_chunk_markdown_from_s3(S3_BUCKET_NAME, user_id, project_folder, debug)
+    for chunk in chunks:
+        chunk.id = point_id(chunk.id, generation)
+        chunk.generation = generation
+
+    exists = client.collection_exists(collection_name=collection_name)
+    new_chunks = filter_new_chunks(client, collection_name, chunks, debug, shard_key) if exists else chunks
+    reused = 0
+    for i in range(0, len(new_chunks), REBUILD_BATCH_SIZE):
+        batch = new_chunks[i:i+REBUILD_BATCH_SIZE]
+        throttle.wait(len(batch))
+        _refresh_lock(user_id, project_folder, token)
+        embed_stats = {}
+        vectors = _with_backoff(lambda: embed_chunks(batch, EMBEDDING_MODEL, debug, user_id, embed_stats))
+        reused += embed_stats.get("embeddings_reused", 0)
+        _with_backoff(lambda: upload_to_qdrant(batch, vectors, client, collection_name, debug, shard_key))
+        if debug:
+            print(f"🧱 Generation {generation}: {min(i + REBUILD_BATCH_SIZE, len(new_chunks))}/{len(new_chunks)} chunks")
+
+    # Files edited or deleted since an earlier pass left chunks S3 no longer has
+    stale = []
+    if exists or new_chunks:
+        current = {chunk.id for chunk in chunks}
+        stale = [pid for pid in _generation_point_ids(client, collection_name, shard_key, user_id, project_folder, generation)
+                 if pid not in current]
+    kwargs = {"shard_key_selector": shard_key} if shard_key is not None else {}
+    for i in range(0, len(stale), REBUILD_GC_BATCH):
+        batch = stale[i:i+REBUILD_GC_BATCH]
+        throttle.wait(len(batch))
+        with admit("qdrant"):
+            client.delete(collection_name=collection_name, points_selector=batch, **kwargs)
+
+    return {
+        "chunks": len(chunks),
+        "embedded": len(new_chunks),
+        "embeddings_reused": reused,
+        "stale_removed": len(stale),
+        "settings": {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "embedding_model": EMBEDDING_MODEL},
+    }
+
+
+def _swap(user_id: str, project_folder: str, generation: int, changes_seen: int) -> bool:
+    """Make generation active, unless an incremental update finished since changes_seen was read."""
+    r = get_redis()
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(_key("changes", user_id, project_folder))
+            if int(pipe.get(_key("changes", user_id, project_folder)) or 0) != changes_seen:
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.set(_key("active", user_id, project_folder), generation)
+            pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+
+def collect_garbage(client, user_id: str, project_folder: str, keep: int, throttle: Throttle = None,
+                    debug: bool = False, token: str = None) -> int:
+    """
+    Delete every point of the project from generations older than keep,
+    REBUILD_GC_BATCH at a time. Newer generations belong to a later rebuild
+    and are spared. With token, the rebuild lock is refreshed before every
+    batch, and losing it stops the collection.
+    """
+    from qdrant_client.http.models import FieldCondition, Filter, Range
+    from app.admission import admit
+    from app.tenancy import route_tenant, tenant_filter
+
+    collection_name, shard_key = route_tenant(user_id)
+    kwargs = {"shard_key_selector": shard_key} if shard_key is not None else {}
+    if not keep or not client.collection_exists(collection_name=collection_name):
+        # Nothing is older than generation 0
+        return 0
+    # Points without a generation field (generation 0) are collected too
+    doomed = Filter(must=tenant_filter(user_id, project_folder).must,
+                    must_not=[FieldCondition(key="generation", range=Range(gte=keep))])
+    deleted = 0
+    while True:
+        points, _ = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=doomed,
+            with_payload=False,
+            with_vectors=False,
+            limit=REBUILD_GC_BATCH,
+            **kwargs
+        )
+        if not points:
+            break
+        if throttle:
+            throttle.wait(len(points))
+        if token:
+            _refresh_lock(user_id, project_folder, token)
+        with admit("qdrant"):
+            client.delete(collection_name=collection_name, points_selector=[p.id for p in points], **kwargs)
+        deleted += len(points)
+        if debug:
+            print(f"🗑️ Collected {deleted} points older than generation {keep}")
+    return deleted
+
+
+def _rebuild(user_id: str, project_folder: str, token: str, debug: bool = False) -> Dict:
+    from app import local_index
+    from app.clients import get_qdrant_client
+    from app.tenancy import route_tenant
+
+    try:
+        started = time.monotonic()
+        client = get_qdrant_client()
+        collection_name, shard_key = route_tenant(user_id)
+        r = get_redis()
+        previous = active(user_id, project_folder, fresh=True)
+        generation = int(r.incr(_key("next", user_id, project_folder)))
+        if generation <= previous:
+            # The counter was lost; never reuse a generation number
+            generation = previous + 1
+            r.set(_key("next", user_id, project_folder), generation)
+        if debug:
+            print(f"🔁 Rebuilding {user_id}/{project_folder} as generation {generation} (active: {previous})")
+
+        throttle = Throttle()
+        totals = {"embedded": 0, "embeddings_reused": 0, "stale_removed": 0}
+        for passes in range(1, REBUILD_MAX_PASSES + 1):
+            changes_seen = int(r.get(_key("changes", user_id, project_folder)) or 0)
+            stats = _sync_generation(client, collection_name, shard_key, user_id, project_folder,
+                                     generation, throttle, token, debug)
+            for field in totals:
+                totals[field] += stats[field]
+            if _swap(user_id, project_folder, generation, changes_seen):
+                break
+        else:
+            raise RuntimeError(f"{user_id}/{project_folder} kept changing; generation {generation} was not activated")
+        version(user_id, project_folder, fresh=True)
+        logger.info(f"Generation {generation} of {user_id}/{project_folder} is active after {passes} passes")
+        if local_index.LOCAL_INDEX_SYNC:
+            local_index.export_project(client, user_id, project_folder, debug, replace=True)
+
+        info = {
+            "generation": generation,
+            "previous": previous,
+            "passes": passes,
+            "chunks": stats["chunks"],
+            **totals,
+            "settings": stats["settings"],
+            "build_seconds": round(time.monotonic() - started, 1),
+            "throttled_seconds": round(throttle.paused_seconds, 1),
+        }
+        r.set(_key("info", user_id, project_folder), json.dumps(info))
+
+        # Searches that resolved the old generation just before the switch are still running
+        _sleep_holding_lock(REBUILD_GC_DELAY, user_id, project_folder, token)
+        info["collected"] = collect_garbage(client, user_id, project_folder, generation, throttle, debug, token)
+        r.set(_key("info", user_id, project_folder), json.dumps(info))
+        return info
+    finally:
+        _release_lock(user_id, project_folder, token)
+
+
+def rebuild(user_id: str, project_folder: str, debug: bool = False, background: bool = False) -> Dict:
+    """
+    Rebuild a project into a new generation and switch to it. With
+    background=True it runs on a daemon thread and this returns immediately;
+    a worker that exits mid-rebuild leaves an inactive generation behind
+    for the next rebuild to collect.
+    """
+    token = _acquire_lock(user_id, project_folder)
+    if token is None:
+        raise RebuildInProgress(user_id, project_folder)
+    if not background:
+        return _rebuild(user_id, project_folder, token, debug)
+
+    def run():
+        try:
+            _rebuild(user_id, project_folder, token, debug)
+        except Exception:
+            logger.exception(f"Rebuild of {user_id}/{project_folder} failed")
+
+    threading.Thread(target=run, name=f"rebuild-{user_id}-{project_folder}", daemon=True).start()
+    return {"status": "started", "active": active(user_id, project_folder, fresh=True)}
+
+
+def status(user_id: str, project_folder: str) -> Dict:
+    r = get_redis()
+    info = r.get(_key("info", user_id, project_folder))
+    return {
+        "active": active(user_id, project_folder, fresh=True),
+        "rebuilding": bool(r.exists(_key("rebuild", user_id, project_folder))),
+        "last_rebuild": json.loads(info) if info else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Blue/green project index generations")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("rebuild", "Rebuild a project into a new generation and switch to it"),
+                            ("status", "Show a project's active generation")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--user", required=True)
+        p.add_argument("--project", required=True)
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print(json.dumps(rebuild(args.user, args.project, debug=True), indent=2))
+    else:
+        print(json.dumps(status(args.user, args.project), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings for production (used by start_server.py).
+
+    gunicorn -c app/gunicorn_conf.py app.main:app
+"""
+import multiprocessing
+import os
+
+
+def default_workers() -> int:
+    """WEB_CONCURRENCY if set, otherwise 2 x CPUs + 1 capped at MAX_WORKERS."""
+    if os.getenv("WEB_CONCURRENCY"):
+        return int(os.getenv("WEB_CONCURRENCY"))
+    return min(multiprocessing.cpu_count() * 2 + 1, int(os.getenv("MAX_WORKERS", "8")))
+
+
+workers = default_workers()
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# Import the app (and the route modules, see when_ready) once in the master
+# and fork workers from it. Clients are created per process after the fork.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+
+def when_ready(server):
+    if preload_app:
+        from app.warmup import preload_modules
+        preload_modules()
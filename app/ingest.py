@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Event-driven incremental reindexing.
+
+S3 object notifications (ObjectCreated:* / ObjectRemoved:*) for project
+Markdown files are posted to /events/s3. Changes are debounced and batched
+per project, then only the affected keys are re-chunked, re-embedded and
+upserted (or have their points deleted) via embed.reindex_s3_objects.
+
+Each gunicorn worker debounces the events it receives. A project's reindex
+runs under a Redis lock (ingest:lock:U:P), so batches for the same project
+from different workers run one after another instead of racing each other's
+stale-chunk deletes.
+
+A failed batch is put back in front of any newer events for the project and
+retried with exponential backoff (after retry_after when admission rejected
+it), up to INGEST_MAX_RETRIES times; rejections by admission don't count
+towards that limit. Objects deleted after their put event are applied as
+deletes.
+
+Local stand-in for S3 notifications:
+    python -m app.ingest emit users/U/P/chapter1.md [--deleted]
+    python -m app.ingest watch ./local_bucket
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import unquote_plus
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Wait this long after the last event for a project before reindexing it...
+INGEST_DEBOUNCE_SECONDS = float(os.getenv("INGEST_DEBOUNCE_SECONDS", "1.5"))
+# ...but never hold a project's changes back longer than this
+INGEST_MAX_DELAY_SECONDS = float(os.getenv("INGEST_MAX_DELAY_SECONDS", "10"))
+
+# Cross-worker project lock; held locks are extended every third of the TTL
+INGEST_LOCK_TTL = float(os.getenv("INGEST_LOCK_TTL", "60"))
+INGEST_LOCK_POLL = 0.2
+
+# Failed batches are retried after INGEST_RETRY_BASE * 2**n seconds, at most INGEST_RETRY_MAX
+INGEST_MAX_RETRIES = int(os.getenv("INGEST_MAX_RETRIES", "5"))
+INGEST_RETRY_BASE = float(os.getenv("INGEST_RETRY_BASE", "2"))
+INGEST_RETRY_MAX = float(os.getenv("INGEST_RETRY_MAX", "60"))
+
+stats = {"events": 0, "ignored": 0, "batches": 0, "retried_batches": 0, "failed_batches": 0, "lock_waits": 0}
+
+
+def parse_s3_event(payload: Dict) -> List[Tuple[str, str]]:
+    """
+    Extract (action, key) pairs from an S3 notification payload, where action
+    is "updated" or "deleted". Only project Markdown files are kept.
+    """
+    changes = []
+    for record in payload.get("Records", []):
+        event_name = record.get("eventName", "")
+        key = unquote_plus(record.get("s3", {}).get("object", {}).get("key", ""))
+        if not key.startswith("users/") or not key.endswith(".md"):
+            stats["ignored"] += 1
+            continue
+        if event_name.startswith("ObjectCreated"):
+            changes.append(("updated", key))
+        elif event_name.startswith("ObjectRemoved"):
+            changes.append(("deleted", key))
+        else:
+            stats["ignored"] += 1
+    return changes
+
+
+def project_for_key(key: str) -> Tuple[str, str]:
+    """users/{user_id}/{project}/file.md -> (user_id, project); root-level files have no project."""
+    parts = key.split("/")
+    return parts[1], (parts[2] if len(parts) > 3 else None)
+
+
+class ProjectLock:
+    """
+    Serializes one project's reindexes across workers with a Redis token
+    lock, extended by a heartbeat thread while held. Without Redis it
+    degrades to the caller's in-process lock only.
+    """
+
+    def __init__(self, user_id: str, project_folder: str, ttl: float = INGEST_LOCK_TTL):
+        self.key = f"ingest:lock:{user_id}:{project_folder or 'root'}"
+        self.ttl = ttl
+        self.token = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._redis = None
+
+    def __enter__(self):
+        from redis.exceptions import RedisError
+        from app.redis_client import get_redis
+        try:
+            r = get_redis()
+            waited = False
+            while not r.set(self.key, self.token, nx=True, px=int(self.ttl * 1000)):
+                if not waited:
+                    waited = True
+                    stats["lock_waits"] += 1
+                    logger.info(f"Waiting for another worker's reindex of {self.key[len('ingest:lock:'):]}")
+                time.sleep(INGEST_LOCK_POLL)
+        except RedisError as e:
+            logger.warning(f"Ingest lock unavailable, reindexing without it: {e}")
+            return self
+        self._redis = r
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        return self
+
+    def _heartbeat(self):
+        from redis.exceptions import RedisError
+        from app.redis_client import extend_lock
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not extend_lock(self._redis, self.key, self.token, self.ttl):
+                    logger.warning(f"Lost {self.key} during a reindex")
+                    return
+            except RedisError as e:
+                logger.warning(f"Could not extend {self.key}: {e}")
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._redis is not None:
+            from app.redis_client import release_lock
+            release_lock(self._redis, self.key, self.token)
+        return False
+
+
+class EventBatcher:
+    """
+    Debounces changes per (user_id, project). The latest action per key wins,
+    so a save followed by a delete only deletes. flush_fn(user_id, project,
+    updated_keys, deleted_keys) runs on a timer thread; if it raises, the
+    batch is requeued with backoff.
+    """
+
+    def __init__(self, flush_fn, debounce: float = INGEST_DEBOUNCE_SECONDS, max_delay: float = INGEST_MAX_DELAY_SECONDS):
+        self.flush_fn = flush_fn
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[str, str], Dict[str, str]] = {}
+        self._first_seen: Dict[Tuple[str, str], float] = {}
+        self._timers: Dict[Tuple[str, str], threading.Timer] = {}
+        # One reindex at a time per project; later batches wait their turn
+        self._project_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        # Consecutive failures per project (admission rejections excluded)
+        self._failures: Dict[Tuple[str, str], int] = {}
+        # New events don't cut a retry's backoff short
+        self._not_before: Dict[Tuple[str, str], float] = {}
+
+    def add(self, changes: List[Tuple[str, str]]):
+        with self._lock:
+            for action, key in changes:
+                project = project_for_key(key)
+                self._pending.setdefault(project, {})[key] = action
+                self._first_seen.setdefault(project, time.monotonic())
+                self._schedule(project)
+        stats["events"] += len(changes)
+
+    def _schedule(self, project, delay: float = None):
+        timer = self._timers.pop(project, None)
+        if timer:
+            timer.cancel()
+        now = time.monotonic()
+        if delay is None:
+            waited = now - self._first_seen[project]
+            delay = max(0.0, min(self.debounce, self.max_delay - waited))
+            delay = max(delay, self._not_before.get(project, now) - now)
+        else:
+            self._not_before[project] = now + delay
+        timer = threading.Timer(delay, self._flush, args=(project,))
+        timer.daemon = True
+        self._timers[project] = timer
+        timer.start()
+
+    def _flush(self, project):
+        with self._lock:
+            changes = self._pending.pop(project, {})
+            self._first_seen.pop(project, None)
+            self._timers.pop(project, None)
+            self._not_before.pop(project, None)
+            project_lock = self._project_locks.setdefault(project, threading.Lock())
+        if not changes:
+            return
+        updated = sorted(k for k, action in changes.items() if action == "updated")
+        deleted = sorted(k for k, action in changes.items() if action == "deleted")
+        user_id, project_folder = project
+        try:
+            with project_lock, ProjectLock(user_id, project_folder):
+                result = self.flush_fn(user_id, project_folder, updated, deleted)
+        except Exception as e:
+            self._retry(project, changes, e)
+            return
+        with self._lock:
+            self._failures.pop(project, None)
+        stats["batches"] += 1
+        logger.info(f"Reindexed {user_id}/{project_folder}: {result}")
+
+    def _retry(self, project, changes: Dict[str, str], error: Exception):
+        from app.admission import Overloaded
+        user_id, project_folder = project
+        with self._lock:
+            if isinstance(error, Overloaded):
+                failures = self._failures.get(project, 0)
+                delay = error.retry_after
+            else:
+                failures = self._failures[project] = self._failures.get(project, 0) + 1
+                delay = min(INGEST_RETRY_MAX, INGEST_RETRY_BASE * 2 ** (failures - 1))
+            if failures > INGEST_MAX_RETRIES:
+                self._failures.pop(project, None)
+                stats["failed_batches"] += 1
+                logger.error(f"Incremental reindex failed for {user_id}/{project_folder}, giving up on "
+                             f"{len(changes)} changes after {INGEST_MAX_RETRIES} retries: {error}")
+                return
+            # Events that arrived during the failed run are newer and win
+            pending = self._pending.setdefault(project, {})
+            for key, action in changes.items():
+                pending.setdefault(key, action)
+            self._first_seen.setdefault(project, time.monotonic())
+            self._schedule(project, delay)
+        stats["retried_batches"] += 1
+        logger.warning(f"Incremental reindex failed for {user_id}/{project_folder}, retrying in {delay:.1f}s: {error}")
+
+    def flush_all(self):
+        """Flush every pending project now (used on shutdown)."""
+        with self._lock:
+            projects = list(self._pending)
+            for timer in self._timers.values():
+                timer.cancel()
+        for project in projects:
+            self._flush(project)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(len(keys) for keys in self._pending.values())
+
+
+def _reindex(user_id, project_folder, updated, deleted):
+    from app.embed import reindex_s3_objects
+    return reindex_s3_objects(user_id, project_folder, updated, deleted)
+
+
+_batcher = None
+
+
+def get_batcher() -> EventBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = EventBatcher(_reindex)
+    return _batcher
+
+
+# === LOCAL STAND-IN ===
+def build_s3_event(keys: List[str], deleted: bool = False, bucket: str = None) -> Dict:
+    """An S3 notification payload shaped like the ones AWS sends for s3Service.js uploads."""
+    bucket = bucket or os.getenv("S3_BUCKET_NAME", "story-rag")
+    now = datetime.now(timezone.utc).isoformat()
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventTime": now,
+                "eventName": "ObjectRemoved:Delete" if deleted else "ObjectCreated:Put",
+                "s3": {"bucket": {"name": bucket}, "object": {"key": key}},
+            }
+            for key in keys
+        ]
+    }
+
+
+def emit(url: str, keys: List[str], deleted: bool = False):
+    import requests
+    response = requests.post(f"{url}/events/s3", json=build_s3_event(keys, deleted), timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+
+def watch(url: str, root: str, interval: float = 0.5):
+    """Poll a local directory laid out like the bucket (users/U/P/*.md) and emit events for changes."""
+    root_path = Path(root)
+    seen = {}
+    print(f"👀 Watching {root_path} (Ctrl+C to stop)")
+    while True:
+        current = {str(p.relative_to(root_path)): p.stat().st_mtime for p in root_path.rglob("*.md")}
+        changed = [k for k, mtime in current.items() if seen.get(k) != mtime]
+        removed = [k for k in seen if k not in current]
+        if seen and changed:
+            print(f"⬆️ {len(changed)} changed: {emit(url, changed)}")
+        if removed:
+            print(f"🗑️ {len(removed)} removed: {emit(url, removed, deleted=True)}")
+        seen = current
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emit S3-style object events to the StoryRAG API")
+    parser.add_argument("--url", default="http://localhost:8000")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("emit", help="Send one event for the given keys")
+    p.add_argument("keys", nargs="+")
+    p.add_argument("--deleted", action="store_true")
+
+    p = sub.add_parser("watch", help="Emit events for changes under a local directory")
+    p.add_argument("root")
+    p.add_argument("--interval", type=float, default=0.5)
+
+    args = parser.parse_args()
+    if args.command == "emit":
+        print(json.dumps(emit(args.url, args.keys, args.deleted), indent=2))
+    else:
+        try:
+            watch(args.url, args.root, args.interval)
+        except KeyboardInterrupt:
+            print("\n👋 Stopped")
+
+
+if __name__ == "__main__":
+    main()
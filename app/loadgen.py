@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Replay-based load generator.
+
+Replays recorded chat traffic (questions and session ids pulled from the
+per-project logs by logging_utils.get_queries) or synthetic chat/embed
+traffic against the API, and reports throughput, error rate and latency
+percentiles.
+
+    python -m app.loadgen record --logs 'logs/*.log' -o traffic.jsonl
+    python -m app.loadgen run [--trace traffic.jsonl] [--workers N | --url URL] [--rate R] [--concurrency C] [--think S]
+    python -m app.loadgen saturate [--trace traffic.jsonl] --workers N [--start R] [--factor F] [--slo-ms MS]
+
+Sessions arrive as a Poisson process at --rate per second (--rate 0: --concurrency
+virtual users loop over them back to back); each session sends its requests in
+order with exponentially distributed think times. Latency is measured from when
+a request was due, so time spent waiting for a free connection counts.
+
+Without --url an offline server is started the way production runs:
+gunicorn with app/gunicorn_conf.py (preload and warmup hooks included) and
+--workers passed as WEB_CONCURRENCY, STORYRAG_OFFLINE=true (see app.offline)
+and one fakeredis TCP server shared by all workers.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SHED_STATUSES = (429, 503)
+
+
+# === TRAFFIC ===
+def record(log_patterns: List[str], output: str) -> int:
+    """Turn per-project logs (logs/user_U_project_P.log) into a replayable trace, in timestamp order."""
+    from app.logging_utils import get_queries
+
+    entries = []
+    for pattern in log_patterns:
+        for path in glob.glob(pattern):
+            match = re.match(r"user_(.+)_project_(.+)\.log$", os.path.basename(path))
+            if not match:
+                continue
+            user_id, project_folder = match.groups()
+            for query in get_queries(path):
+                entries.append({"endpoint": "chat", "user_id": user_id, "project_folder": project_folder, **query})
+    entries.sort(key=lambda e: e["timestamp"])
+    with open(output, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+    return len(entries)
+
+
+def load_sessions(trace: str) -> List[List[Dict]]:
+    """Group a trace into sessions: chat requests by session id (in order), each embed on its own."""
+    sessions: Dict[str, List[Dict]] = {}
+    with open(trace, encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            request.setdefault("endpoint", "chat")
+            key = request.get("session_id") if request["endpoint"] == "chat" else f"embed-{n}"
+            sessions.setdefault(key, []).append(request)
+    return list(sessions.values())
+
+
+def synthetic_sessions(count: int, rng: random.Random, embed_ratio: float = 0.02) -> List[List[Dict]]:
+    """Sessions of 1-5 questions built from words of the offline corpus, plus occasional embed runs."""
+    from app import offline
+
+    projects = offline.projects()
+    if not projects:
+        raise RuntimeError(f"No projects under {offline.OFFLINE_S3_DIR}/users; run with an offline server first")
+    vocab = {}
+    for user_id, project_folder in projects:
+        text = " ".join(p.read_text(encoding="utf-8") for p in (Path(offline.OFFLINE_S3_DIR) / "users" / user_id / project_folder).glob("*.md"))
+        vocab[(user_id, project_folder)] = re.findall(r"[a-z]{3,}", text.lower()) or ["story"]
+
+    sessions = []
+    for n in range(count):
+        user_id, project_folder = rng.choice(projects)
+        if rng.random() < embed_ratio:
+            sessions.append([{"endpoint": "embed", "user_id": user_id, "project_folder": project_folder}])
+            continue
+        words = vocab[(user_id, project_folder)]
+        sessions.append([
+            {"endpoint": "chat", "user_id": user_id, "project_folder": project_folder, "session_id": f"synthetic-{n}",
+             "question": "What happens with the " + " ".join(rng.choice(words) for _ in range(6)) + "?"}
+            for _ in range(rng.randint(1, 5))
+        ])
+    return sessions
+
+
+# === LOAD ===
+async def run_load(url: str, sessions: List[List[Dict]], rate: float, concurrency: int, think: float,
+                   duration: float, seed: int = 7, timeout: float = 60.0, chat_params: Dict = None) -> Dict:
+    import httpx
+
+    rng = random.Random(seed)
+    results = []  # (endpoint, status or None, latency seconds)
+    semaphore = asyncio.Semaphore(concurrency)
+    replay = {"n": 0}
+    started = time.perf_counter()
+    deadline = started + duration
+
+    async def send(client, request, session_id):
+        due = time.perf_counter()
+        if request["endpoint"] == "embed":
+            path, params = "/embed", {"user_id": request["user_id"], "project_folder": request["project_folder"]}
+        else:
+            path = "/chat"
+            params = {"user_id": request["user_id"], "project_folder": request["project_folder"],
+                      "session_id": session_id, "question": request["question"], **(chat_params or {})}
+        async with semaphore:
+            try:
+                response = await client.post(path, params=params)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = None
+        results.append((request["endpoint"], status, time.perf_counter() - due))
+
+    async def run_session(client, session):
+        # Each replay gets its own session id so histories don't pile up across replays
+        replay["n"] += 1
+        session_id = f"{session[0].get('session_id', 'embed')}-lg{replay['n']}"
+        for i, request in enumerate(session):
+            if time.perf_counter() >= deadline:
+                return
+            if i and think > 0:
+                await asyncio.sleep(rng.expovariate(1.0 / think))
+            await send(client, request, session_id)
+
+    async def virtual_user(client, offset):
+        i = offset
+        while time.perf_counter() < deadline:
+            await run_session(client, sessions[i % len(sessions)])
+            i += concurrency
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+        if rate > 0:
+            tasks, i = [], 0
+            while time.perf_counter() < deadline:
+                tasks.append(asyncio.ensure_future(run_session(client, sessions[i % len(sessions)])))
+                i += 1
+                await asyncio.sleep(rng.expovariate(rate))
+            await asyncio.gather(*tasks)
+        else:
+            await asyncio.gather(*(virtual_user(client, n) for n in range(concurrency)))
+
+    return summarize(results, time.perf_counter() - started)
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(results, elapsed: float) -> Dict:
+    summary = {"elapsed_s": elapsed, "endpoints": {}}
+    for endpoint in sorted({r[0] for r in results}) + ["all"]:
+        rows = [r for r in results if endpoint == "all" or r[0] == endpoint]
+        ok = [r for r in rows if r[1] is not None and r[1] < 400]
+        shed = sum(1 for r in rows if r[1] in SHED_STATUSES)
+        latencies = sorted(r[2] * 1000 for r in ok)
+        summary["endpoints"][endpoint] = {
+            "requests": len(rows),
+            "ok": len(ok),
+            "shed": shed,
+            "errors": len(rows) - len(ok) - shed,
+            "error_rate": (len(rows) - len(ok)) / len(rows) if rows else 0.0,
+            "throughput": len(ok) / elapsed if elapsed else 0.0,
+            **{f"p{int(q * 100)}_ms": _percentile(latencies, q) for q in (0.5, 0.9, 0.95, 0.99)},
+            "max_ms": latencies[-1] if latencies else 0.0,
+        }
+    return summary
+
+
+def print_summary(summary: Dict):
+    print(f"{'endpoint':<8} {'reqs':>6} {'ok/s':>7} {'err%':>6} {'shed':>5} {'p50':>7} {'p90':>7} {'p95':>7} {'p99':>7} {'max':>7}")
+    for endpoint, s in summary["endpoints"].items():
+        print(f"{endpoint:<8} {s['requests']:>6} {s['throughput']:>7.2f} {s['error_rate'] * 100:>6.1f} {s['shed']:>5} "
+              f"{s['p50_ms']:>7.0f} {s['p90_ms']:>7.0f} {s['p95_ms']:>7.0f} {s['p99_ms']:>7.0f} {s['max_ms']:>7.0f}")
+
+
+# === OFFLINE SERVER ===
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve_fakeredis(port: int):
+    import fakeredis
+    fakeredis.TcpFakeServer(("127.0.0.1", port)).serve_forever()
+
+
+class OfflineServer:
+    """The production gunicorn setup with the offline stand-ins and a shared fakeredis TCP server, for the duration of a run."""
+
+    def __init__(self, workers: int, env: Dict[str, str] = None, log_path: str = "loadgen_server.log"):
+        self.workers = workers
+        self.log_path = log_path
+        self.env = env or {}
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self):
+        from app import offline
+
+        offline.ensure_corpus()
+        # In its own process so it doesn't compete with the load generator for the GIL
+        redis_port = _free_port()
+        self.redis_process = multiprocessing.get_context("spawn").Process(target=_serve_fakeredis, args=(redis_port,), daemon=True)
+        self.redis_process.start()
+
+        env = {**os.environ, "STORYRAG_OFFLINE": "true", "OFFLINE_REDIS": "server",
+               "REDIS_HOST": "127.0.0.1", "REDIS_PORT": str(redis_port), "REDIS_PASSWORD2": "",
+               "OFFLINE_S3_DIR": str(Path(offline.OFFLINE_S3_DIR).resolve()),
+               "WEB_CONCURRENCY": str(self.workers), **self.env}
+        # Same config as start_server.py's production mode; only the bind address differs
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "app/gunicorn_conf.py", "-b", f"127.0.0.1:{self.port}",
+               "--log-level", "warning", "app.main:app"]
+        print(f"🚀 Offline server on {self.url} ({self.workers} workers, log: {self.log_path})")
+        self.log = open(self.log_path, "w")
+        self.process = subprocess.Popen(cmd, cwd=REPO_ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self._wait_ready()
+        return self
+
+    def _wait_ready(self, timeout: float = 120.0):
+        import httpx
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Server exited with {self.process.returncode}, see {self.log_path}")
+            try:
+                if httpx.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.25)
+        raise RuntimeError("Server did not become healthy")
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.redis_process.terminate()
+        self.log.close()
+
+
+# === COMMANDS ===
+def _sessions(args) -> List[List[Dict]]:
+    rng = random.Random(args.seed)
+    sessions = load_sessions(args.trace) if args.trace else synthetic_sessions(args.sessions, rng, args.embed_ratio)
+    rng.shuffle(sessions)
+    return sessions
+
+
+def _chat_params(args) -> Dict:
+    return {"score_threshold": args.score_threshold, "top_k": args.top_k}
+
+
+def cmd_run(args):
+    def go(url):
+        sessions = _sessions(args)
+        print(f"📼 {len(sessions)} sessions, rate {args.rate}/s, concurrency {args.concurrency}, think {args.think}s, {args.duration}s")
+        summary = asyncio.run(run_load(url, sessions, args.rate, args.concurrency, args.think, args.duration,
+                                       args.seed, args.timeout, _chat_params(args)))
+        print_summary(summary)
+        if args.json:
+            Path(args.json).write_text(json.dumps(summary, indent=2))
+
+    if args.url:
+        go(args.url)
+    else:
+        with OfflineServer(args.workers) as server:
+            go(server.url)
+    return 0
+
+
+def cmd_saturate(args):
+    """
+    Step the session arrival rate up by --factor until p95 exceeds the SLO,
+    the error rate exceeds --max-error, or throughput stops growing.
+    """
+    def go(url):
+        sessions = _sessions(args)
+        rate, best, previous = args.start, None, 0.0
+        print(f"{'rate':>7} {'ok/s':>7} {'err%':>6} {'p50':>7} {'p95':>7} {'p99':>7}")
+        while rate <= args.max_rate:
+            summary = asyncio.run(run_load(url, sessions, rate, args.concurrency, args.think, args.duration,
+                                           args.seed, args.timeout, _chat_params(args)))
+            s = summary["endpoints"]["all"]
+            print(f"{rate:>7.2f} {s['throughput']:>7.2f} {s['error_rate'] * 100:>6.1f} {s['p50_ms']:>7.0f} {s['p95_ms']:>7.0f} {s['p99_ms']:>7.0f}")
+            if s["p95_ms"] > args.slo_ms or s["error_rate"] > args.max_error:
+                break
+            if previous and s["throughput"] < previous * 1.05:
+                best = (rate, s)
+                break
+            best, previous = (rate, s), s["throughput"]
+            rate *= args.factor
+        if best:
+            print(f"\n📈 Saturation point: {best[0]:.2f} sessions/s -> {best[1]['throughput']:.2f} ok req/s, p95 {best[1]['p95_ms']:.0f}ms")
+        else:
+            print(f"\n⚠️ Already over the SLO at {args.start} sessions/s")
+
+    if args.url:
+        go(args.url)
+    else:
+        with OfflineServer(args.workers) as server:
+            go(server.url)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay chat/embed traffic against the StoryRAG API")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("record", help="Build a trace from per-project query logs")
+    p.add_argument("--logs", nargs="+", default=["logs/*.log"])
+    p.add_argument("-o", "--output", default="traffic.jsonl")
+
+    for name, help_text in (("run", "Replay traffic once and report"), ("saturate", "Find the saturation point")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--trace", default=None, help="JSONL trace (default: synthetic traffic over the offline corpus)")
+        p.add_argument("--sessions", type=int, default=500, help="Synthetic sessions to generate")
+        p.add_argument("--embed-ratio", type=float, default=0.02, help="Share of synthetic sessions that are embed runs")
+        p.add_argument("--url", default=None, help="Target a running server instead of starting an offline one")
+        p.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "2")))
+        p.add_argument("--concurrency", type=int, default=32, help="Max requests in flight")
+        p.add_argument("--think", type=float, default=1.0, help="Mean think time between a session's requests (s)")
+        p.add_argument("--duration", type=float, default=30.0, help="Seconds per run")
+        p.add_argument("--timeout", type=float, default=60.0)
+        p.add_argument("--score-threshold", type=float, default=0.5)
+        p.add_argument("--top-k", type=int, default=5)
+        p.add_argument("--seed", type=int, default=7)
+        if name == "run":
+            p.add_argument("--rate", type=float, default=2.0, help="Session arrivals per second (0: closed loop)")
+            p.add_argument("--json", default=None, help="Also write the summary here")
+        else:
+            p.add_argument("--start", type=float, default=0.5, help="First arrival rate (sessions/s)")
+            p.add_argument("--factor", type=float, default=1.5)
+            p.add_argument("--max-rate", type=float, default=200.0)
+            p.add_argument("--slo-ms", type=float, default=2000.0, help="p95 latency objective")
+            p.add_argument("--max-error", type=float, default=0.01)
+
+    args = parser.parse_args()
+    if args.command == "record":
+        print(f"📼 Recorded {record(args.logs, args.output)} requests to {args.output}")
+        return
+    sys.exit((cmd_run if args.command == "run" else cmd_saturate)(args) or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+"""
+Embedded local retrieval backend.
+
+Each project is stored under LOCAL_INDEX_DIR/<user>/<project>/ as a set of
+append-only segments:
+    seg-000001.f32           float32 rows, L2-normalised (cosine = dot product)
+    seg-000001.payload.json  columnar payloads: ids, text, filename, source
+    manifest.json            dim, segment list, deleted ids per segment,
+                             and the generations.version() it matches
+Vectors are memory-mapped and searched with an exact vectorised scan, which
+for projects of a few thousand chunks beats a network hop to Qdrant.
+
+RETRIEVAL_BACKEND=local makes chat search this index instead of Qdrant.
+embed_s3_markdown, incremental reindexing and rebuilds keep the index of the
+host that ran them in sync and advance its recorded version. Every host
+compares that version with the project's current one before searching and
+re-exports from Qdrant when they differ, so a write handled by another host
+(or a Redis flush) is picked up within GENERATION_CACHE_SECONDS.
+
+    python -m app.local_index export --user U --project P
+"""
+import argparse
+import fcntl
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "qdrant")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "local_index")
+LOCAL_INDEX_SYNC = os.getenv("LOCAL_INDEX_SYNC", "true" if RETRIEVAL_BACKEND == "local" else "false").lower() == "true"
+# Merge segments once there are this many, or once this share of rows is deleted
+LOCAL_INDEX_MAX_SEGMENTS = int(os.getenv("LOCAL_INDEX_MAX_SEGMENTS", "8"))
+LOCAL_INDEX_MAX_DELETED_RATIO = float(os.getenv("LOCAL_INDEX_MAX_DELETED_RATIO", "0.25"))
+
+PAYLOAD_FIELDS = ("text", "filename", "source")
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9._-]", "_", str(name)) or "_"
+
+
+class LocalHit:
+    """Shaped like a Qdrant ScoredPoint so retrieval.hit_to_node can convert it."""
+    __slots__ = ("id", "score", "payload", "vector")
+
+    def __init__(self, id, score, payload, vector=None):
+        self.id = id
+        self.score = score
+        self.payload = payload
+        self.vector = vector
+
+
+class _Segment:
+    def __init__(self, directory: Path, name: str, dim: int):
+        self.name = name
+        self.vectors = np.memmap(directory / f"{name}.f32", dtype=np.float32, mode="r").reshape(-1, dim)
+        with open(directory / f"{name}.payload.json", encoding="utf-8") as f:
+            self.payload = json.load(f)
+        self.row_of = {pid: row for row, pid in enumerate(self.payload["ids"])}
+
+
+class LocalIndex:
+    def __init__(self, user_id: str, project_folder: str, root: str = None):
+        self.user_id = str(user_id)
+        self.project_folder = project_folder
+        self.directory = Path(root or LOCAL_INDEX_DIR) / _safe_name(user_id) / _safe_name(project_folder or "root")
+        self._segments: Dict[str, _Segment] = {}
+        self._manifest = None
+        self._manifest_mtime = None
+        self._lock = threading.Lock()
+
+    # --- manifest / segments ---
+    def exists(self) -> bool:
+        return (self.directory / "manifest.json").exists()
+
+    def _load_manifest(self) -> Dict:
+        path = self.directory / "manifest.json"
+        try:
+            mtime = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return {"dim": None, "next": 1, "segments": []}
+        if mtime != self._manifest_mtime:
+            with open(path, encoding="utf-8") as f:
+                self._manifest = json.load(f)
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def _write_manifest(self, manifest: Dict):
+        tmp = self.directory / "manifest.json.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self.directory / "manifest.json")
+
+    def _segment(self, name: str, dim: int) -> _Segment:
+        segment = self._segments.get(name)
+        if segment is None:
+            segment = _Segment(self.directory, name, dim)
+            self._segments[name] = segment
+        return segment
+
+    def version(self) -> Optional[list]:
+        """The [generation, changes, epoch] this index was last brought up to, if known."""
+        return self._load_manifest().get("version")
+
+    def set_version(self, version, expected=None):
+        """Record the index as matching version; with expected, only if it currently matches that."""
+        with self._lock:
+            lock_file = self._write_lock()
+            try:
+                manifest = dict(self._load_manifest())
+                if expected is not None and manifest.get("version") != list(expected):
+                    return
+                manifest["version"] = list(version)
+                self._write_manifest(manifest)
+            finally:
+                lock_file.close()
+
+    def _write_lock(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.directory / ".lock", "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    # --- writes ---
+    def upsert(self, ids: List[str], vectors, payloads: List[Dict], replace: bool = False):
+        """
+        Add points as a new segment; older copies of the same ids are marked
+        deleted. With replace, every existing point goes in the same manifest
+        write, so readers switch from the old contents to the new at once.
+        """
+        if not ids:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        ids = [str(pid) for pid in ids]
+
+        with self._lock:
+            lock_file = self._write_lock()
+            try:
+                manifest = dict(self._load_manifest())
+                replaced = []
+                if replace:
+                    replaced = [e["name"] for e in manifest["segments"]]
+                    manifest["segments"] = []
+                    manifest["dim"] = int(vectors.shape[1])
+                else:
+                    manifest["dim"] = manifest["dim"] or int(vectors.shape[1])
+                    self._mark_deleted(manifest, set(ids))
+
+                name = f"seg-{manifest['next']:06d}"
+                vectors.tofile(self.directory / f"{name}.f32")
+                columns = {"ids": ids}
+                for field in PAYLOAD_FIELDS:
+                    columns[field] = [p.get(field, "") for p in payloads]
+                with open(self.directory / f"{name}.payload.json", "w", encoding="utf-8") as f:
+                    json.dump(columns, f, separators=(",", ":"), ensure_ascii=False)
+
+                manifest["segments"] = manifest["segments"] + [{"name": name, "rows": len(ids), "deleted": []}]
+                manifest["next"] += 1
+                self._write_manifest(manifest)
+                self._remove_segments(replaced)
+                self._maybe_compact(manifest)
+            finally:
+                lock_file.close()
+
+    def clear(self):
+        """Drop every point in one manifest write."""
+        with self._lock:
+            if not self.exists():
+                return
+            lock_file = self._write_lock()
+            try:
+                manifest = dict(self._load_manifest())
+                replaced = [e["name"] for e in manifest["segments"]]
+                manifest["segments"] = []
+                self._write_manifest(manifest)
+                self._remove_segments(replaced)
+            finally:
+                lock_file.close()
+
+    def delete_ids(self, ids: Iterable[str]):
+        ids = {str(pid) for pid in ids}
+        self._delete(lambda segment: ids & segment.row_of.keys())
+
+    def delete_sources(self, sources: Iterable[str]):
+        sources = set(sources)
+        self._delete(lambda segment: {
+            pid for pid, source in zip(segment.payload["ids"], segment.payload["source"]) if source in sources
+        })
+
+    def _delete(self, select):
+        with self._lock:
+            if not self.exists():
+                return
+            lock_file = self._write_lock()
+            try:
+                manifest = dict(self._load_manifest())
+                segments = []
+                for entry in manifest["segments"]:
+                    doomed = select(self._segment(entry["name"], manifest["dim"]))
+                    segments.append({**entry, "deleted": sorted(set(entry["deleted"]) | doomed)})
+                manifest["segments"] = segments
+                self._write_manifest(manifest)
+                self._maybe_compact(manifest)
+            finally:
+                lock_file.close()
+
+    def _mark_deleted(self, manifest: Dict, ids: set):
+        segments = []
+        for entry in manifest["segments"]:
+            hits = ids & self._segment(entry["name"], manifest["dim"]).row_of.keys()
+            segments.append({**entry, "deleted": sorted(set(entry["deleted"]) | hits)} if hits else entry)
+        manifest["segments"] = segments
+
+    def _maybe_compact(self, manifest: Dict):
+        rows = sum(e["rows"] for e in manifest["segments"])
+        deleted = sum(len(e["deleted"]) for e in manifest["segments"])
+        if len(manifest["segments"]) <= LOCAL_INDEX_MAX_SEGMENTS and deleted <= rows * LOCAL_INDEX_MAX_DELETED_RATIO:
+            return
+        # Rewrite live rows into one segment (caller holds the write lock)
+        vectors, columns = [], {"ids": [], **{field: [] for field in PAYLOAD_FIELDS}}
+        for entry in manifest["segments"]:
+            segment = self._segment(entry["name"], manifest["dim"])
+            dead = set(entry["deleted"])
+            live = [row for row, pid in enumerate(segment.payload["ids"]) if pid not in dead]
+            vectors.append(np.asarray(segment.vectors[live]))
+            for field in columns:
+                values = segment.payload[field]
+                columns[field].extend(values[row] for row in live)
+
+        old = [e["name"] for e in manifest["segments"]]
+        if columns["ids"]:
+            name = f"seg-{manifest['next']:06d}"
+            np.concatenate(vectors).astype(np.float32).tofile(self.directory / f"{name}.f32")
+            with open(self.directory / f"{name}.payload.json", "w", encoding="utf-8") as f:
+                json.dump(columns, f, separators=(",", ":"), ensure_ascii=False)
+            segments = [{"name": name, "rows": len(columns["ids"]), "deleted": []}]
+        else:
+            segments = []
+        manifest = {**manifest, "next": manifest["next"] + 1, "segments": segments}
+        self._write_manifest(manifest)
+        self._remove_segments(old)
+
+    def _remove_segments(self, names: List[str]):
+        # Readers that still map these files keep them alive until they reload the manifest
+        for stale in names:
+            self._segments.pop(stale, None)
+            for suffix in (".f32", ".payload.json"):
+                (self.directory / f"{stale}{suffix}").unlink(missing_ok=True)
+
+    # --- reads ---
+    def count(self) -> int:
+        manifest = self._load_manifest()
+        return sum(e["rows"] - len(e["deleted"]) for e in manifest["segments"])
+
+    def search(self, query_vector, top_k: int = 5, with_vectors: bool = False) -> List[LocalHit]:
+        """Exact cosine top-k over every live row of the project."""
+        with self._lock:
+            manifest = self._load_manifest()
+            segments = [(entry, self._segment(entry["name"], manifest["dim"])) for entry in manifest["segments"]]
+        if not segments:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        best = []  # (score, segment, row)
+        for entry, segment in segments:
+            scores = segment.vectors @ query
+            if entry["deleted"]:
+                scores[[segment.row_of[pid] for pid in entry["deleted"] if pid in segment.row_of]] = -np.inf
+            k = min(top_k, len(scores))
+            rows = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+            best.extend((float(scores[row]), segment, int(row)) for row in rows if scores[row] > -np.inf)
+
+        best.sort(key=lambda item: item[0], reverse=True)
+        hits = []
+        for score, segment, row in best[:top_k]:
+            payload = {field: segment.payload[field][row] for field in PAYLOAD_FIELDS}
+            payload["user_id"] = self.user_id
+            payload["project_folder"] = self.project_folder or "root"
+            vector = segment.vectors[row].tolist() if with_vectors else None
+            hits.append(LocalHit(segment.payload["ids"][row], score, payload, vector))
+        return hits
+
+
+_indexes: Dict[tuple, LocalIndex] = {}
+
+
+def get_index(user_id: str, project_folder: Optional[str]) -> LocalIndex:
+    project_folder = project_folder or "root"
+    key = (str(user_id), project_folder, os.getpid())
+    if key not in _indexes:
+        _indexes[key] = LocalIndex(user_id, project_folder)
+    return _indexes[key]
+
+
+def export_project(client, user_id: str, project_folder: str, debug: bool = False, replace: bool = False) -> int:
+    """
+    Copy a project's active generation from Qdrant into its local index.
+    With replace, the previous contents are swapped out in one manifest write
+    (used when app.generations switches generations).
+    """
+    from app import generations
+    from app.tenancy import route_tenant, tenant_filter
+
+    collection_name, shard_key = route_tenant(user_id)
+    kwargs = {"shard_key_selector": shard_key} if shard_key is not None else {}
+    index = get_index(user_id, project_folder)
+    # Read before the scroll: a write landing during it leaves the index marked as behind
+    version = generations.version(user_id, project_folder, fresh=True)
+    generation = version[0]
+    ids, vectors, payloads = [], [], []
+    exported = 0
+    next_page_offset = None
+    while True:
+        points, next_page_offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=tenant_filter(user_id, project_folder, generation=generation),
+            with_payload=True,
+            with_vectors=True,
+            limit=1000,
+            offset=next_page_offset,
+            **kwargs
+        )
+        if points and replace:
+            ids.extend(p.id for p in points)
+            vectors.append(np.asarray([p.vector for p in points], dtype=np.float32))
+            payloads.extend(p.payload for p in points)
+        elif points:
+            index.upsert([p.id for p in points], [p.vector for p in points], [p.payload for p in points])
+        exported += len(points)
+        if not next_page_offset:
+            break
+    if ids:
+        index.upsert(ids, np.concatenate(vectors), payloads, replace=True)
+    elif replace:
+        # Nothing left in Qdrant
+        index.clear()
+    if version[2]:
+        index.set_version(version)
+    if debug:
+        print(f"📦 Exported {exported} points (generation {generation}) to {index.directory}")
+    return exported
+
+
+_export_locks: Dict[tuple, threading.Lock] = {}
+
+
+def ensure_exported(client, user_id: str, project_folder: Optional[str], debug: bool = False) -> LocalIndex:
+    """
+    The project's local index, (re-)exported from Qdrant first if it doesn't
+    match the project's current generations.version(): it has none yet, or
+    another host wrote to the project, or Redis was flushed. If Redis can't
+    be read, an existing index is used as it is.
+    """
+    from app import generations
+
+    index = get_index(user_id, project_folder)
+    current = list(generations.version(user_id, project_folder))
+    if index.version() == current or (not current[2] and index.exists()):
+        return index
+    # One export per project at a time in this process; the rest wait for it
+    lock = _export_locks.setdefault((str(user_id), project_folder or "root"), threading.Lock())
+    with lock:
+        if index.version() != current:
+            export_project(client, user_id, project_folder or "root", debug, replace=True)
+    return index
+
+
+def record_update(user_id: str, project_folder: Optional[str], generation: int, changes: int):
+    """
+    After this host synced an update into its local index and bumped the
+    project's change counter to changes, advance the index's version, but
+    only if it matched the version just before that update.
+    """
+    index = get_index(user_id, project_folder)
+    previous = index.version()
+    if not previous or not index.exists():
+        return
+    index.set_version([generation, changes, previous[2]], expected=[generation, changes - 1, previous[2]])
+
+
+def _project_of(key: str) -> str:
+    parts = key.split("/")
+    return parts[2] if len(parts) > 3 else "root"
+
+
+def sync(client, user_id: str, chunks=(), vectors=None, deleted_sources=(), stale_ids: Dict[str, List] = None,
+         debug: bool = False):
+    """
+    Mirror a batch of Qdrant writes into the local indexes (no-op unless
+    LOCAL_INDEX_SYNC). chunks are app.chunking.Chunk records and vectors the
+    matching rows from embed_chunks. A project without a local index yet is
+    exported from Qdrant instead, which already includes the batch.
+    """
+    if not LOCAL_INDEX_SYNC:
+        return
+    changes = {}
+    for row, chunk in enumerate(chunks):
+        changes.setdefault(chunk.project_folder, {}).setdefault("rows", []).append(row)
+    for source in deleted_sources:
+        changes.setdefault(_project_of(source), {}).setdefault("sources", []).append(source)
+    for project, ids in (stale_ids or {}).items():
+        if ids:
+            changes.setdefault(project, {})["stale"] = ids
+
+    for project, change in changes.items():
+        index = get_index(user_id, project)
+        if not index.exists():
+            export_project(client, user_id, project, debug)
+            continue
+        if change.get("sources"):
+            index.delete_sources(change["sources"])
+        if change.get("stale"):
+            index.delete_ids(change["stale"])
+        rows = change.get("rows", [])
+        if rows:
+            index.upsert(
+                [chunks[row].id for row in rows],
+                vectors[rows],
+                [chunks[row].payload() for row in rows]
+            )
+        if debug:
+            print(f"📦 Local index {index.directory}: {index.count()} points")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage local vector indexes")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("export", help="Export a project from Qdrant into the local index")
+    p.add_argument("--user", required=True)
+    p.add_argument("--project", required=True)
+    args = parser.parse_args()
+
+    from app.clients import get_qdrant_client
+    export_project(get_qdrant_client(), args.user, args.project, debug=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
-from fastapi import FastAPI, Query, HTTPException
-from app.embed import embed_s3_markdown
+from fastapi import FastAPI, Query, HTTPException, Request, Body
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from app.chat import run_chat_query
+from app import singleflight
+from app import admission
+from app import profiling
+from app.admission import Overloaded
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -21,49 +24,176 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def warmup_worker():
+    # Runs in each worker before it accepts connections; opens clients only,
+    # route modules are preloaded in the gunicorn master (see gunicorn_conf)
+    from app.warmup import warmup
+    warmup()
+
+@app.on_event("shutdown")
+def flush_pending_events():
+    from app.ingest import get_batcher
+    get_batcher().flush_all()
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    logger.warning(f"Rejected {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": f"Service busy ({exc.upstream}: {exc.reason}), please retry"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "admission": admission.metrics(),
+        "singleflight": singleflight.metrics(),
+        "resilience": _resilience_metrics(),
+        "router": _router_metrics(),
+        "ingest": _ingest_metrics(),
+        "shm_cache": _shm_cache_metrics(),
+    }
+
+def _resilience_metrics():
+    from app import resilience
+    return resilience.metrics()
+
+def _router_metrics():
+    from app import query_router
+    return query_router.metrics()
+
+def _shm_cache_metrics():
+    from app import shm_cache
+    return shm_cache.metrics()
+
+def _ingest_metrics():
+    from app import ingest
+    return {**ingest.stats, "pending_keys": ingest.get_batcher().pending()}
+
+def _profile_requested(request: Request, profile: bool) -> bool:
+    if not (profile or request.headers.get("X-Profile") == "1"):
+        return False
+    if not profiling.authorized(request.headers.get("X-Profile-Token")):
+        raise HTTPException(status_code=403, detail="Profiling is restricted to admins")
+    return True
+
+@app.get("/profiles/{name}", response_class=PlainTextResponse)
+def profile_artifact(name: str, request: Request):
+    """Download a collapsed-stack profile written by a profile=true request."""
+    if not profiling.authorized(request.headers.get("X-Profile-Token")):
+        raise HTTPException(status_code=403, detail="Profiling is restricted to admins")
+    path = profiling.artifact_path(name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return path.read_text(encoding="utf-8")
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "message": "API is running"}
 
 @app.post("/embed")
 def embed_route(
+    request: Request,
     user_id: str = Query(...),
-    project_folder: str = Query(None)
+    project_folder: str = Query(None),
+    profile: bool = Query(False, description="Run under the sampling profiler (admins only)")
 ):
     try:
         if not user_id:
             raise HTTPException(status_code=400, detail="user_id is required")
-        return embed_s3_markdown(user_id, project_folder)
+        from app.embed import embed_s3_markdown
+
+        if _profile_requested(request, profile):
+            # Profiled runs execute on their own instead of joining an in-flight one
+            with profiling.profiled("embed") as report:
+                result = embed_s3_markdown(user_id, project_folder)
+            return {**result, "profile": report}
+
+        # Identical embed runs for the same project share one execution across workers
+        key = singleflight.make_key("embed", user_id, project_folder)
+        return singleflight.do(key, lambda: embed_s3_markdown(user_id, project_folder), shared=True)
+    except (HTTPException, Overloaded):
+        raise
     except Exception as e:
         logger.error(f"Embed error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post("/projects/rebuild")
+def rebuild_route(user_id: str = Query(...), project_folder: str = Query(...)):
+    """Rebuild a project's index into a new generation in the background and switch to it when done."""
+    from app import generations
+
+    try:
+        return generations.rebuild(user_id, project_folder, background=True)
+    except generations.RebuildInProgress as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/projects/generation")
+def generation_route(user_id: str = Query(...), project_folder: str = Query(...)):
+    from app import generations
+    return generations.status(user_id, project_folder)
+
+@app.post("/events/s3")
+def s3_events_route(payload: dict = Body(...)):
+    """Accept S3 object notifications and queue incremental reindexing of the affected files."""
+    from app.ingest import parse_s3_event, get_batcher
+
+    changes = parse_s3_event(payload)
+    get_batcher().add(changes)
+    return {"queued": len(changes)}
+
 @app.post("/chat")
-async def chat_route(
+def chat_route(
+    request: Request,
     user_id: str = Query(...),
     project_folder: str = Query(...),
     session_id: str = Query(...),
     question: str = Query(...),
     debug: bool = Query(False),
     system_prompt: str = Query(None),
-    score_threshold: float = Query(0.5, ge=0.0, le=1.0, description="Minimum similarity score for document retrieval (0.0-1.0)")
+    score_threshold: float = Query(0.5, ge=0.0, le=1.0, description="Minimum similarity score for document retrieval (0.0-1.0)"),
+    top_k: int = Query(5, ge=1, le=20, description="Number of chunks to retrieve"),
+    mmr: bool = Query(False, description="Rerank over-fetched candidates with Maximal Marginal Relevance"),
+    mmr_diversity: float = Query(0.3, ge=0.0, le=1.0, description="MMR trade-off: 0 = pure relevance, 1 = pure diversity"),
+    fetch_k: int = Query(20, ge=1, le=100, description="Candidates fetched before MMR reranking"),
+    retrieval: str = Query(None, pattern="^(auto|always|never)$", description="Retrieval routing: auto (default), always or never"),
+    profile: bool = Query(False, description="Run under the sampling profiler (admins only)")
 ):
     try:
         if not user_id or not project_folder or not question or not session_id:
             raise HTTPException(status_code=400, detail="All fields are required")
 
-        result = run_chat_query(user_id, project_folder, session_id, question, debug=debug, system_prompt=system_prompt, score_threshold=score_threshold)
+        from app.chat import run_chat_query
+
+        run = lambda: list(run_chat_query(user_id, project_folder, session_id, question, debug=debug, system_prompt=system_prompt, score_threshold=score_threshold,
+                                          top_k=top_k, mmr=mmr, mmr_diversity=mmr_diversity, fetch_k=fetch_k, retrieval=retrieval))
+        report = None
+        if _profile_requested(request, profile):
+            # Profiled runs execute on their own instead of joining an in-flight one
+            with profiling.profiled("chat") as report:
+                result = run()
+        else:
+            # Double-clicks, retries and duplicate tabs send the same question for the
+            # same session; coalesce them so memory and the LLM are only hit once
+            key = singleflight.make_key("chat", user_id, project_folder, session_id, question, debug, system_prompt, score_threshold, top_k, mmr, mmr_diversity, fetch_k, retrieval)
+            result = singleflight.do(key, run, shared=True)
         
-        # Handle the tuple return value (assistant_text, debug_output)
-        if isinstance(result, tuple) and len(result) == 2:
+        # Handle the (assistant_text, debug_output) pair
+        if isinstance(result, (tuple, list)) and len(result) == 2:
             assistant_text, debug_output = result
             response = {"answer": assistant_text}
             if debug and debug_output:
                 response["debug_output"] = debug_output
+            if report is not None:
+                response["profile"] = report
             return response
         else:
             # Fallback for non-tuple return (backward compatibility)
             return {"answer": result}
+    except (HTTPException, Overloaded):
+        raise
     except Exception as e:
         logger.error(f"Chat error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
\ No newline at end of file
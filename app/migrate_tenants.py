@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Move existing points from the original single `splitter` collection into the
+tenant-partitioned layout selected by TENANT_LAYOUT (or --layout).
+
+Usage:
+    python -m app.migrate_tenants --layout sharded [--user USER_ID] [--delete-source] [--dry-run]
+"""
+import argparse
+import os
+import sys
+from collections import defaultdict
+
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+from qdrant_client.models import PointStruct
+
+from app.tenancy import (
+    BASE_COLLECTION_NAME,
+    TENANT_LAYOUT,
+    route_tenant,
+    tenant_filter,
+    ensure_tenant_collection,
+)
+
+load_dotenv()
+
+BATCH_SIZE = 256
+
+
+def migrate(client, layout, user_id=None, delete_source=False, dry_run=False, debug=True):
+    """
+    Scroll the source collection (vectors + payloads) and upsert every point
+    into its tenant route under the target layout. Point IDs are kept, so the
+    migration can be re-run safely.
+    """
+    if layout == "filtered":
+        print("⚠️ Target layout is the source layout, nothing to do")
+        return {"migrated": 0, "deleted": 0}
+
+    scroll_filter = tenant_filter(user_id) if user_id else None
+    deleting = delete_source and not dry_run
+    migrated = 0
+    deleted = 0
+    next_page_offset = None
+
+    while True:
+        points, next_page_offset = client.scroll(
+            collection_name=BASE_COLLECTION_NAME,
+            scroll_filter=scroll_filter,
+            with_payload=True,
+            with_vectors=True,
+            limit=BATCH_SIZE,
+            offset=next_page_offset
+        )
+        if not points:
+            break
+
+        # Group the page by destination so each upsert targets one route
+        routed = defaultdict(list)
+        for point in points:
+            route = route_tenant(point.payload.get("user_id", ""), layout)
+            routed[route].append(point)
+
+        for (collection_name, shard_key), batch in routed.items():
+            if debug:
+                print(f"➡️ {len(batch)} points -> {collection_name} (shard key: {shard_key})")
+            if dry_run:
+                continue
+            ensure_tenant_collection(client, collection_name, shard_key, len(batch[0].vector), debug)
+            kwargs = {"shard_key_selector": shard_key} if shard_key is not None else {}
+            client.upsert(
+                collection_name=collection_name,
+                points=[PointStruct(id=p.id, vector=p.vector, payload=p.payload) for p in batch],
+                **kwargs
+            )
+        migrated += len(points)
+
+        if deleting:
+            client.delete(collection_name=BASE_COLLECTION_NAME, points_selector=[p.id for p in points])
+            deleted += len(points)
+            # Deleting shifts the scroll window, restart from the beginning
+            next_page_offset = None
+
+        if not next_page_offset and not deleting:
+            break
+
+    if debug:
+        print(f"✅ Migrated {migrated} points, deleted {deleted} from {BASE_COLLECTION_NAME}")
+    return {"migrated": migrated, "deleted": deleted}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate points into the tenant-partitioned layout")
+    parser.add_argument("--layout", default=TENANT_LAYOUT, choices=["filtered", "sharded", "grouped"])
+    parser.add_argument("--user", default=None, help="Only migrate this user's points")
+    parser.add_argument("--delete-source", action="store_true", help="Delete points from the source collection once copied")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    client = QdrantClient(url=os.getenv("QDRANT_HOST"), api_key=os.getenv("QDRANT_API_KEY"))
+    if not client.collection_exists(collection_name=BASE_COLLECTION_NAME):
+        print(f"❌ Source collection {BASE_COLLECTION_NAME} not found")
+        sys.exit(1)
+
+    migrate(client, args.layout, args.user, args.delete_source, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import logging
+from typing import List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def mmr_select(query_vector, candidate_vectors, k: int, diversity: float = 0.3) -> List[int]:
+    """
+    Maximal Marginal Relevance over candidate vectors.
+    Greedily picks k indices maximising
+        (1 - diversity) * sim(query, c) - diversity * max sim(c, already picked)
+    diversity=0 is plain top-k by similarity. All similarities are cosine and
+    computed as one matrix product up front.
+    """
+    candidates = np.asarray(candidate_vectors, dtype=np.float32)
+    n = candidates.shape[0]
+    if n == 0 or k <= 0:
+        return []
+    k = min(k, n)
+
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = candidates @ query
+    pairwise = candidates @ candidates.T
+
+    selected = [int(np.argmax(relevance))]
+    max_sim = pairwise[selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < k:
+        scores = (1.0 - diversity) * relevance - diversity * max_sim
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_sim, pairwise[best], out=max_sim)
+
+    return selected
+
+
+def mmr_rerank(query_vector, candidates, k: int, diversity: float = 0.3):
+    """
+    Pick k of the retrieved NodeWithScore candidates with MMR. Candidates
+    without node.embedding can't take part; if too few others remain, they
+    fill the rest of the k slots by score.
+    """
+    with_vectors = [c for c in candidates if c.node.embedding is not None]
+    without_vectors = [c for c in candidates if c.node.embedding is None]
+    if len(with_vectors) <= k:
+        picked = with_vectors
+    else:
+        order = mmr_select(query_vector, [c.node.embedding for c in with_vectors], k, diversity)
+        picked = [with_vectors[i] for i in order]
+    if without_vectors:
+        logger.warning(f"MMR: {len(without_vectors)} of {len(candidates)} candidates have no vector")
+        if len(picked) < k:
+            without_vectors.sort(key=lambda c: c.score or 0.0, reverse=True)
+            picked = picked + without_vectors[:k - len(picked)]
+    return picked
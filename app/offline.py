@@ -0,0 +1,258 @@
+"""
+Offline stand-ins for the upstream services, for load tests and local runs.
+
+STORYRAG_OFFLINE=true makes app.clients and app.redis_client hand out these
+instead of the real clients:
+    OpenAI  deterministic hashed bag-of-words embeddings and a canned chat
+            reply, after a simulated latency (OFFLINE_*_LATENCY_MS)
+    S3      a local directory laid out like the bucket: OFFLINE_S3_DIR/users/U/P/*.md
+    Qdrant  qdrant-client's in-process :memory: mode, one per worker, seeded
+            from OFFLINE_S3_DIR when the worker starts
+    Redis   fakeredis in-process, or REDIS_HOST as usual with OFFLINE_REDIS=server
+            (app.loadgen starts a fakeredis TCP server shared by all workers)
+
+Faults can be injected per stand-in (EMBED, CHAT, QDRANT searches):
+OFFLINE_<NAME>_ERROR_RATE of calls raise InjectedFault, and
+OFFLINE_<NAME>_SLOW_RATE of calls take an extra OFFLINE_<NAME>_SLOW_MS.
+"""
+import base64
+import logging
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from array import array
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("STORYRAG_OFFLINE", "false").lower() == "true"
+OFFLINE_S3_DIR = os.getenv("OFFLINE_S3_DIR", "offline_bucket")
+OFFLINE_REDIS = os.getenv("OFFLINE_REDIS", "fake")
+OFFLINE_SEED = os.getenv("OFFLINE_SEED", "true").lower() == "true"
+OFFLINE_EMBED_LATENCY_MS = float(os.getenv("OFFLINE_EMBED_LATENCY_MS", "40"))
+OFFLINE_CHAT_LATENCY_MS = float(os.getenv("OFFLINE_CHAT_LATENCY_MS", "600"))
+# Latencies are drawn uniformly from [1 - jitter, 1 + jitter] x the mean
+OFFLINE_LATENCY_JITTER = float(os.getenv("OFFLINE_LATENCY_JITTER", "0.3"))
+EMBEDDING_DIM = 1536
+
+
+def _faults_from_env(name: str) -> Dict[str, float]:
+    prefix = f"OFFLINE_{name}_"
+    return {
+        "error_rate": float(os.getenv(prefix + "ERROR_RATE", "0")),
+        "slow_rate": float(os.getenv(prefix + "SLOW_RATE", "0")),
+        "slow_ms": float(os.getenv(prefix + "SLOW_MS", "2000")),
+    }
+
+
+FAULTS = {name: _faults_from_env(name) for name in ("EMBED", "CHAT", "QDRANT")}
+
+_simulate_latency = True
+
+
+def _sleep(mean_ms: float):
+    if not _simulate_latency or mean_ms <= 0:
+        return
+    time.sleep(mean_ms * random.uniform(1 - OFFLINE_LATENCY_JITTER, 1 + OFFLINE_LATENCY_JITTER) / 1000)
+
+
+class InjectedFault(RuntimeError):
+    pass
+
+
+def inject(name: str):
+    """Fail or stall this call according to FAULTS[name] (never while seeding)."""
+    if not _simulate_latency:
+        return
+    faults = FAULTS[name]
+    roll = random.random()
+    if roll < faults["error_rate"]:
+        raise InjectedFault(f"injected {name.lower()} failure")
+    if roll < faults["error_rate"] + faults["slow_rate"]:
+        time.sleep(faults["slow_ms"] / 1000)
+
+
+# === OPENAI ===
+def fake_embedding(text: str, dim: int = EMBEDDING_DIM) -> List[float]:
+    """Hashed bag-of-words: texts sharing words get high cosine similarity."""
+    vector = [0.0] * dim
+    for word in re.findall(r"\w+", text.lower()):
+        h = zlib.crc32(word.encode("utf-8"))
+        vector[h % dim] += 1.0 if h & 0x80000000 else -1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def _encode_base64(vector: List[float]) -> str:
+    return base64.b64encode(array("f", vector).tobytes()).decode("ascii")
+
+
+class _Embeddings:
+    def create(self, input, model=None, encoding_format=None, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        inject("EMBED")
+        _sleep(OFFLINE_EMBED_LATENCY_MS)
+        encode = _encode_base64 if encoding_format == "base64" else (lambda vector: vector)
+        return SimpleNamespace(
+            data=[SimpleNamespace(embedding=encode(fake_embedding(t)), index=i) for i, t in enumerate(texts)],
+            model=model,
+        )
+
+
+class OfflineOpenAI:
+    """The slice of openai.OpenAI used by app.embed."""
+
+    def __init__(self):
+        self.embeddings = _Embeddings()
+
+
+def make_embed_model():
+    from llama_index.core.embeddings import BaseEmbedding
+
+    class OfflineEmbedding(BaseEmbedding):
+        def _get_query_embedding(self, query: str) -> List[float]:
+            inject("EMBED")
+            _sleep(OFFLINE_EMBED_LATENCY_MS)
+            return fake_embedding(query)
+
+        def _get_text_embedding(self, text: str) -> List[float]:
+            inject("EMBED")
+            _sleep(OFFLINE_EMBED_LATENCY_MS)
+            return fake_embedding(text)
+
+        async def _aget_query_embedding(self, query: str) -> List[float]:
+            return self._get_query_embedding(query)
+
+    return OfflineEmbedding(model_name="offline")
+
+
+def make_llm():
+    from llama_index.core.llms import CompletionResponse, CustomLLM, LLMMetadata
+
+    class OfflineLLM(CustomLLM):
+        @property
+        def metadata(self) -> LLMMetadata:
+            return LLMMetadata(model_name="offline")
+
+        def complete(self, prompt: str, formatted: bool = False, **kwargs) -> CompletionResponse:
+            inject("CHAT")
+            _sleep(OFFLINE_CHAT_LATENCY_MS)
+            question = prompt.rsplit("user:", 1)[-1].split("assistant:")[0].strip()
+            return CompletionResponse(text=f"(offline reply to {len(prompt)} prompt chars) {question[-200:]}")
+
+        def stream_complete(self, prompt: str, formatted: bool = False, **kwargs):
+            yield self.complete(prompt, formatted, **kwargs)
+
+    return OfflineLLM()
+
+
+# === S3 ===
+class LocalS3:
+    """The slice of the boto3 S3 client used by app.embed, over a local directory."""
+
+    def __init__(self, root: str = None):
+        self.root = Path(root or OFFLINE_S3_DIR)
+
+    def get_object(self, Bucket: str, Key: str):
+        from botocore.exceptions import ClientError
+        path = self.root / Key
+        if not path.is_file():
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}}, "GetObject")
+        return {"Body": BytesIO(path.read_bytes())}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = "", **kwargs):
+        paths = sorted(p for p in self.root.rglob("*") if p.is_file())
+        keys = [p.relative_to(self.root).as_posix() for p in paths]
+        contents = [{"Key": k, "Size": p.stat().st_size} for k, p in zip(keys, paths) if k.startswith(Prefix)]
+        return {"Contents": contents, "KeyCount": len(contents)} if contents else {"KeyCount": 0}
+
+
+# === QDRANT / REDIS ===
+class FaultyQdrant:
+    """An in-memory QdrantClient whose searches go through inject("QDRANT")."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def query_points(self, *args, **kwargs):
+        inject("QDRANT")
+        return self._client.query_points(*args, **kwargs)
+
+
+def make_qdrant_client():
+    from qdrant_client import QdrantClient
+    return FaultyQdrant(QdrantClient(":memory:"))
+
+
+_fake_server = None
+_fake_server_lock = threading.Lock()
+
+
+def make_redis():
+    global _fake_server
+    try:
+        import fakeredis
+    except ImportError as e:
+        raise RuntimeError("Offline Redis needs fakeredis: pip install fakeredis") from e
+    if _fake_server is None:
+        # Threads racing here must not end up on separate servers
+        with _fake_server_lock:
+            if _fake_server is None:
+                _fake_server = fakeredis.FakeServer()
+    return fakeredis.FakeRedis(server=_fake_server)
+
+
+# === CORPUS ===
+def projects(root: str = None):
+    """(user_id, project_folder) for every project directory in the offline bucket."""
+    users = Path(root or OFFLINE_S3_DIR) / "users"
+    if not users.is_dir():
+        return []
+    return sorted((u.name, p.name) for u in users.iterdir() if u.is_dir() for p in u.iterdir() if p.is_dir())
+
+
+def ensure_corpus(root: str = None, users: int = 8, projects_per_user: int = 2, files: int = 5, seed: int = 7):
+    """Write synthetic chapters into an empty offline bucket."""
+    from app.bench import synthetic_chapter
+
+    root_path = Path(root or OFFLINE_S3_DIR)
+    if projects(root_path):
+        return
+    rng = random.Random(seed)
+    for u in range(users):
+        for p in range(projects_per_user):
+            folder = root_path / "users" / f"user{u}" / f"project{p}"
+            folder.mkdir(parents=True, exist_ok=True)
+            for f in range(files):
+                (folder / f"chapter{f + 1}.md").write_text(synthetic_chapter(rng), encoding="utf-8")
+    logger.info(f"Wrote a synthetic corpus to {root_path}")
+
+
+def seed():
+    """Embed every offline project into this worker's in-memory Qdrant (latency simulation off)."""
+    if not OFFLINE_SEED:
+        return
+    from app.embed import embed_s3_markdown
+    global _simulate_latency
+
+    started = time.perf_counter()
+    _simulate_latency = False
+    try:
+        for user_id, project_folder in projects():
+            embed_s3_markdown(user_id, project_folder)
+    finally:
+        _simulate_latency = True
+    logger.info(f"Seeded offline Qdrant with {len(projects())} projects in {(time.perf_counter() - started) * 1000:.0f}ms")
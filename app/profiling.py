@@ -0,0 +1,183 @@
+"""
+Opt-in per-request sampling profiler.
+
+A request sent with profile=true (or an X-Profile: 1 header) and an
+X-Profile-Token matching PROFILE_ADMIN_TOKEN runs with a sampler thread. Every
+PROFILE_INTERVAL_MS the sampler records the handling thread's stack from
+sys._current_frames(). The stacks are written to PROFILE_DIR in collapsed format
+(one "frame;frame;frame count" line per stack, readable by flamegraph.pl and
+speedscope), and the response carries the top self/total hotspots.
+Requests without the flag never start the sampler.
+
+Work the request hands to a thread pool (app.resilience runs embedding and
+search calls on pool threads) is wrapped with follow(). While it runs, each
+sample records the pool thread's stack grafted onto the request thread's
+stack instead of the request thread just waiting. Hedged attempts are
+sampled side by side.
+"""
+import functools
+import hmac
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "15"))
+
+_REPO_ROOT = str(Path(__file__).resolve().parent.parent) + os.sep
+
+
+def authorized(token: Optional[str]) -> bool:
+    """Profiling is disabled unless PROFILE_ADMIN_TOKEN is set, and then needs that token."""
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(token or "", PROFILE_ADMIN_TOKEN)
+
+
+def _frame_label(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(_REPO_ROOT):
+        filename = filename[len(_REPO_ROOT):]
+    elif "site-packages" + os.sep in filename:
+        filename = filename.split("site-packages" + os.sep, 1)[1]
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+class Sampler:
+    """Samples one thread's stack on a background thread."""
+
+    def __init__(self, thread_id: int, interval_ms: float = PROFILE_INTERVAL_MS, skip: int = 0):
+        self.thread_id = thread_id
+        # Outermost frames to drop (the server machinery below the profiled call)
+        self.skip = skip
+        self.interval = interval_ms / 1000
+        self.stacks = Counter()
+        self._helpers = set()
+        self._helpers_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def add_helper(self, thread_id: int):
+        with self._helpers_lock:
+            self._helpers.add(thread_id)
+
+    def remove_helper(self, thread_id: int):
+        with self._helpers_lock:
+            self._helpers.discard(thread_id)
+
+    def _run(self):
+        labels = {}
+
+        def walk(frame, stop_code=None):
+            stack = []
+            while frame is not None and frame.f_code is not stop_code:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = _frame_label(code)
+                stack.append(label)
+                frame = frame.f_back
+            return stack[::-1]
+
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            stack = walk(frames.get(self.thread_id))[self.skip:]
+            if not stack:
+                continue
+            with self._helpers_lock:
+                helpers = [frames.get(t) for t in self._helpers]
+            # Pool threads working for the request stand in for its wait
+            helper_stacks = [walk(f, _run_followed.__code__) for f in helpers if f is not None]
+            for helper in helper_stacks or [[]]:
+                self.stacks[";".join(stack + helper)] += 1
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.wall_ms = (time.perf_counter() - self.started) * 1000
+
+    def hotspots(self, top: int = PROFILE_TOP) -> Dict:
+        """Self time = samples where the frame is on top; total = samples where it is anywhere on the stack."""
+        samples = sum(self.stacks.values()) or 1
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        return {
+            "self": [{"frame": f, "pct": round(100 * n / samples, 1)} for f, n in own.most_common(top)],
+            "total": [{"frame": f, "pct": round(100 * n / samples, 1)} for f, n in total.most_common(top)],
+        }
+
+    def write_collapsed(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+_samplers: Dict[int, Sampler] = {}
+
+
+def _run_followed(sampler: Sampler, fn: Callable[[], Any]) -> Any:
+    sampler.add_helper(threading.get_ident())
+    try:
+        return fn()
+    finally:
+        sampler.remove_helper(threading.get_ident())
+
+
+def follow(fn: Callable[[], Any]) -> Callable[[], Any]:
+    """fn, wrapped so the calling thread's profile (if one is running) samples it on whatever thread runs it."""
+    sampler = _samplers.get(threading.get_ident())
+    if sampler is None:
+        return fn
+    return functools.partial(_run_followed, sampler, fn)
+
+
+@contextmanager
+def profiled(name: str):
+    """Profile the calling thread for the duration of the block; the yielded dict is filled in on exit."""
+    report = {}
+    # Root the stacks at the caller: frame 0 is this generator, 1 is __enter__
+    depth, frame = 0, sys._getframe(2)
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    sampler = Sampler(threading.get_ident(), skip=depth - 1)
+    _samplers[sampler.thread_id] = sampler
+    sampler.start()
+    try:
+        yield report
+    finally:
+        _samplers.pop(sampler.thread_id, None)
+        sampler.stop()
+        artifact = f"{time.strftime('%Y%m%dT%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}.collapsed"
+        sampler.write_collapsed(Path(PROFILE_DIR) / artifact)
+        report.update({
+            "artifact": artifact,
+            "samples": sum(sampler.stacks.values()),
+            "interval_ms": PROFILE_INTERVAL_MS,
+            "wall_ms": round(sampler.wall_ms, 1),
+            "hotspots": sampler.hotspots(),
+        })
+
+
+def artifact_path(name: str) -> Optional[Path]:
+    """Resolve a stored artifact by file name, refusing anything outside PROFILE_DIR."""
+    root = Path(PROFILE_DIR).resolve()
+    path = (root / name).resolve()
+    if path.parent != root or not path.is_file():
+        return None
+    return path
@@ -0,0 +1,165 @@
+"""
+Decides before retrieval whether a chat message needs project context.
+
+Acknowledgements ("thanks!", "ok") and edits of the previous answer ("make it
+shorter", "rewrite that in first person") are answered from chat memory
+alone, saving the query embedding and the Qdrant search. Everything else is
+retrieved as before: the router only skips when it is confident.
+
+Signals, all local and sub-millisecond:
+    - the message text: acknowledgement / rewrite patterns, length,
+      anaphora ("it", "that", "your answer"), story-lookup words ("chapter",
+      "who is", "according to my notes")
+    - the session history: there must be a previous assistant answer to
+      edit, and every content word of a rewrite request must already appear
+      in it ("make it about the dragon oath instead" needs new facts), and
+      a "yes"/"sure" to an answer ending in a question accepts an offer,
+      which needs retrieval like the question it answers
+
+The mode comes from the request (retrieval=auto|always|never) or QUERY_ROUTER.
+Decisions are counted in `stats`; skipped requests are credited with the
+recent average retrieval time as latency saved.
+"""
+import os
+import re
+import threading
+from typing import List, NamedTuple, Optional
+
+QUERY_ROUTER = os.getenv("QUERY_ROUTER", "auto")
+# Rewrite requests longer than this usually carry new content; retrieve for them
+ROUTER_MAX_SKIP_WORDS = int(os.getenv("ROUTER_MAX_SKIP_WORDS", "14"))
+# Weight of the newest sample in the retrieval latency average
+RETRIEVAL_EWMA_ALPHA = 0.1
+
+MODES = ("auto", "always", "never")
+_LANGUAGES = {"english", "spanish", "french", "german", "italian", "portuguese", "japanese"}
+
+_ACKNOWLEDGEMENT_PHRASE = (
+    r"(?:ok(?:ay)?|k|kk|thanks?(?: you)?(?: (?:so|very) much| a lot)?|thx|ty|cheers|cool|great|nice|perfect|"
+    r"awesome|amazing|(?:i )?love it|got it|sounds good|that works|makes sense|yes|yep|yeah|no|nope|nah|sure|"
+    r"lol|haha|hi|hello|hey|bye|good (?:morning|night)|never ?mind|nvm|that(?:'s| is) (?:great|perfect|good))"
+)
+# One or more acknowledgement phrases and nothing else ("haha love it, thanks")
+_ACKNOWLEDGEMENT = re.compile(rf"^{_ACKNOWLEDGEMENT_PHRASE}(?: {_ACKNOWLEDGEMENT_PHRASE})*$")
+# Acknowledgements that turn down an offer rather than accept it
+_DECLINE = re.compile(r"\b(?:no|nope|nah|never ?mind|nvm)\b")
+_REWRITE_VERB = re.compile(
+    r"^(?:(?:can|could|would|will) you |please |now |ok(?:ay)?,? |and )*"
+    r"(?:make|rewrite|rephrase|reword|shorten|lengthen|expand|condense|summari[sz]e|simplify|translate|"
+    r"format|turn|change|convert|redo|edit|polish|tighten|trim|continue|put|write|say|try)\b"
+)
+_ANAPHORA = re.compile(
+    r"\b(?:it|that|this|those|these|them|again|above|(?:the|your) (?:last |previous )?"
+    r"(?:answer|reply|response|version|paragraph|text|list|one|draft))\b"
+)
+_STYLE = re.compile(
+    r"\b(?:shorter|longer|briefer|simpler|clearer|funnier|darker|punchier|more|less|first person|"
+    r"second person|third person|past tense|present tense|bullet points|bullets?|a list|a table|formal|"
+    r"casual|tone|voice|point of view|perspective|pov|rhym\w*|poem|haiku|in (?:" + "|".join(sorted(_LANGUAGES)) + r"))\b"
+)
+# The message asks about the story itself: retrieve even if it looks like an edit
+_LOOKUP = re.compile(
+    r"\b(?:chapter|notes?|lore|wiki|outline|draft of|my (?:story|book|novel|world|project|files?)|"
+    r"according to|in the (?:book|story)|who (?:is|was|are)|where (?:is|was|does|did)|when (?:does|did)|"
+    r"what (?:happens|happened|does|did)|remind me|look up)\b"
+)
+_WORD = re.compile(r"\w+")
+# Words that carry no story content in a rewrite request; words of two letters or fewer are ignored too
+_FILLER = {
+    "the", "and", "but", "for", "from", "into", "onto", "with", "without", "about", "instead", "please",
+    "just", "bit", "little", "some", "very", "much", "than", "also", "too", "now", "then", "way", "can",
+    "could", "would", "will", "you", "your", "its", "her", "his", "him", "she", "they", "their", "our",
+    "what", "whole", "all", "same", "keep", "make", "sure", "one", "ones", "words", "sentences", "lines",
+    "paragraphs", "points",
+}
+
+
+class Route(NamedTuple):
+    retrieve: bool
+    reason: str
+
+
+stats = {"retrieve": 0, "skip": 0, "saved_ms": 0.0}
+_stats_lock = threading.Lock()
+_retrieval_ms: Optional[float] = None
+
+
+def _content(message) -> str:
+    return getattr(message, "content", None) or ""
+
+
+def _role(message) -> str:
+    role = getattr(message, "role", "")
+    return str(getattr(role, "value", role)).lower()
+
+
+def classify(question: str, history: List) -> Route:
+    """Heuristic decision for one message given the session history before it."""
+    text = question.strip()
+    normalized = re.sub(r"[^\w\s']", " ", text.lower())
+    normalized = " ".join(normalized.split())
+    words = normalized.split()
+    if not words:
+        return Route(False, "empty message")
+
+    last_answer = next((_content(m) for m in reversed(history) if _role(m) == "assistant"), "")
+
+    if _ACKNOWLEDGEMENT.match(normalized):
+        if last_answer.rstrip().endswith("?") and not _DECLINE.search(normalized):
+            return Route(True, "accepts an offer in the previous answer")
+        return Route(False, "acknowledgement")
+
+    if _LOOKUP.search(normalized):
+        return Route(True, "asks about the story")
+
+    if not last_answer:
+        return Route(True, "no previous answer to work from")
+
+    verb = _REWRITE_VERB.match(normalized)
+    if verb and (_ANAPHORA.search(normalized) or _STYLE.search(normalized)):
+        if len(words) > ROUTER_MAX_SKIP_WORDS:
+            return Route(True, "long rewrite request")
+        answer_words = set(_WORD.findall(last_answer.lower()))
+        rest = _STYLE.sub(" ", _ANAPHORA.sub(" ", normalized[verb.end():]))
+        new_words = [w for w in _WORD.findall(rest)
+                     if len(w) > 2 and w not in _FILLER and w not in _LANGUAGES and w not in answer_words]
+        if new_words:
+            return Route(True, f"mentions {new_words[0]!r}, not in the previous answer")
+        return Route(False, "rewrite of the previous answer")
+
+    return Route(True, "default")
+
+
+def route(question: str, history: List, mode: str = None) -> Route:
+    """The router's decision, honouring an always/never override."""
+    mode = mode or QUERY_ROUTER
+    if mode == "always":
+        return Route(True, "override: always")
+    if mode == "never":
+        return Route(False, "override: never")
+    return classify(question, history)
+
+
+def record(decision: Route, retrieval_seconds: Optional[float] = None) -> float:
+    """
+    Count a decision. Pass how long retrieval took when it ran (and
+    succeeded); returns the latency credited as saved (ms) when it was skipped.
+    """
+    global _retrieval_ms
+    with _stats_lock:
+        if decision.retrieve:
+            stats["retrieve"] += 1
+            if retrieval_seconds is not None:
+                ms = retrieval_seconds * 1000
+                _retrieval_ms = ms if _retrieval_ms is None else (1 - RETRIEVAL_EWMA_ALPHA) * _retrieval_ms + RETRIEVAL_EWMA_ALPHA * ms
+            return 0.0
+        stats["skip"] += 1
+        saved = _retrieval_ms or 0.0
+        stats["saved_ms"] += saved
+        return saved
+
+
+def metrics():
+    with _stats_lock:
+        return {**stats, "saved_ms": round(stats["saved_ms"], 1),
+                "avg_retrieval_ms": round(_retrieval_ms, 1) if _retrieval_ms is not None else None}
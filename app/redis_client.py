@@ -0,0 +1,77 @@
+import os
+import threading
+
+import redis
+from dotenv import load_dotenv
+
+from app import offline
+
+load_dotenv()
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_PASSWORD = os.getenv("REDIS_PASSWORD2", "")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def redis_url() -> str:
+    return f"redis://default:{REDIS_PASSWORD}@{REDIS_HOST}:{REDIS_PORT}"
+
+
+def get_redis() -> redis.Redis:
+    """
+    Shared Redis client backed by one connection pool per process.
+    Clients are cheap; the pool is what gets reused across requests.
+    """
+    global _pool
+    if offline.ENABLED and offline.OFFLINE_REDIS == "fake":
+        return offline.make_redis()
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = redis.ConnectionPool.from_url(
+                    redis_url(),
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    socket_timeout=5,
+                    socket_connect_timeout=2,
+                )
+    return redis.Redis(connection_pool=_pool)
+
+
+def release_lock(r: redis.Redis, key: str, token: str) -> bool:
+    """
+    Delete a token lock only if it still holds our token (it may have expired
+    and been taken by someone else). WATCH/MULTI rather than a Lua script, so
+    it also works on fakeredis.
+    """
+    try:
+        with r.pipeline() as pipe:
+            pipe.watch(key)
+            if pipe.get(key) != token.encode():
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.delete(key)
+            pipe.execute()
+            return True
+    except (redis.RedisError, redis.WatchError):
+        return False
+
+
+def extend_lock(r: redis.Redis, key: str, token: str, ttl_seconds: float) -> bool:
+    """Push a token lock's expiry out if we still hold it."""
+    with r.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.get(key) != token.encode():
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            pipe.pexpire(key, int(ttl_seconds * 1000))
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
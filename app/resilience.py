@@ -0,0 +1,284 @@
+"""
+Hedged requests, timeouts and circuit breaking for idempotent upstream calls
+(query embeddings and Qdrant searches).
+
+call(upstream, fn) runs fn on a worker thread. If it hasn't returned after
+the upstream's recent latency percentile (HEDGE_PERCENTILE, never less than
+HEDGE_MIN_MS), an identical second attempt is started and whichever finishes
+first wins. A call that doesn't finish within TIMEOUT seconds raises
+Unavailable; the slow attempt keeps running in the background and its result
+is discarded.
+
+An attempt that is abandoned (timed out, or lost to its hedge) still holds
+its pool thread until the upstream returns. Each upstream may have at most
+MAX_IN_FLIGHT attempts running. Past that, calls fail fast with Unavailable
+and no hedge is started, so a hung upstream can't take every thread. The pool
+has one thread per in-flight slot, so accepted attempts never queue.
+
+Profiled requests (app.profiling) see the attempts' stacks.
+
+Admission (app.admission) belongs around call(), not inside fn: queueing for
+a slot then doesn't eat into TIMEOUT, and a hedge doesn't take a second
+per-user slot. An Overloaded raised by an attempt never counts against the
+breaker.
+
+After BREAKER_FAILURES consecutive failures the upstream's breaker opens and
+calls fail fast with Unavailable for BREAKER_COOLDOWN seconds. After that, one
+trial call is let through, and its success closes the breaker. run_chat_query
+answers from chat memory alone while retrieval is unavailable.
+
+Configured per upstream with environment variables, e.g.
+RESILIENCE_QDRANT_TIMEOUT, RESILIENCE_QDRANT_HEDGE_PERCENTILE (0 disables
+hedging), RESILIENCE_QDRANT_HEDGE_MIN_MS, RESILIENCE_QDRANT_BREAKER_FAILURES,
+RESILIENCE_QDRANT_BREAKER_COOLDOWN, RESILIENCE_QDRANT_MAX_IN_FLIGHT.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Optional
+
+from app import profiling
+from app.admission import Overloaded
+
+RESILIENCE_ENABLED = os.getenv("RESILIENCE_ENABLED", "true").lower() == "true"
+
+DEFAULT_POLICIES = {
+    # upstream: (timeout_seconds, hedge_percentile, hedge_min_ms, breaker_failures, breaker_cooldown_seconds, max_in_flight)
+    "openai_embed": (5.0, 95, 150, 5, 30.0, 16),
+    "qdrant": (2.0, 95, 30, 5, 30.0, 16),
+}
+# Hedge delay until an upstream has this many latency samples
+WARMUP_SAMPLES = 20
+
+
+class Unavailable(Exception):
+    """The upstream timed out, failed, or its circuit breaker is open."""
+
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream} unavailable: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+
+class Policy:
+    def __init__(self, name: str, timeout: float, hedge_percentile: float, hedge_min_ms: float,
+                 breaker_failures: int, breaker_cooldown: float, max_in_flight: int):
+        self.name = name
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min = hedge_min_ms / 1000
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.max_in_flight = max_in_flight
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._latencies = deque(maxlen=200)
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+        self.metrics = {
+            "calls": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "timeouts": 0,
+            "failures": 0,
+            "short_circuited": 0,
+            "breaker_opened": 0,
+            "rejected": 0,
+            "abandoned": 0,
+        }
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Recent successful call latency in seconds, or None until WARMUP_SAMPLES calls have been seen."""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < WARMUP_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+    def hedge_delay(self) -> float:
+        latency = self.latency_percentile(self.hedge_percentile)
+        if latency is None:
+            return max(self.hedge_min, self.timeout / 4)
+        return max(self.hedge_min, latency)
+
+    # --- in-flight bound ---
+    def _try_start(self) -> bool:
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                return False
+            self._in_flight += 1
+            return True
+
+    def _finished(self, _future=None):
+        with self._lock:
+            self._in_flight -= 1
+
+    # --- circuit breaker ---
+    def _before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.breaker_cooldown or self._trial_in_flight:
+                self.metrics["short_circuited"] += 1
+                raise Unavailable(self.name, "circuit open")
+            # Half-open: let one trial call through
+            self._trial_in_flight = True
+
+    def _on_success(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def _on_failure(self):
+        with self._lock:
+            self.metrics["failures"] += 1
+            self._consecutive_failures += 1
+            reopen = self._trial_in_flight or (self._opened_at is None and self._consecutive_failures >= self.breaker_failures)
+            self._trial_in_flight = False
+            if reopen:
+                self._opened_at = time.monotonic()
+                self.metrics["breaker_opened"] += 1
+
+    def _release_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            return "half_open" if self._trial_in_flight or time.monotonic() - self._opened_at >= self.breaker_cooldown else "open"
+
+    def snapshot(self) -> Dict:
+        return {
+            "state": self.state(),
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 1),
+            "timeout_seconds": self.timeout,
+            "in_flight": self._in_flight,
+            **self.metrics,
+        }
+
+
+def _policy_from_env(name: str) -> Policy:
+    timeout, percentile, hedge_min_ms, failures, cooldown, max_in_flight = DEFAULT_POLICIES[name]
+    prefix = f"RESILIENCE_{name.upper()}_"
+    return Policy(
+        name,
+        timeout=float(os.getenv(prefix + "TIMEOUT", timeout)),
+        hedge_percentile=float(os.getenv(prefix + "HEDGE_PERCENTILE", percentile)),
+        hedge_min_ms=float(os.getenv(prefix + "HEDGE_MIN_MS", hedge_min_ms)),
+        breaker_failures=int(os.getenv(prefix + "BREAKER_FAILURES", failures)),
+        breaker_cooldown=float(os.getenv(prefix + "BREAKER_COOLDOWN", cooldown)),
+        max_in_flight=int(os.getenv(prefix + "MAX_IN_FLIGHT", max_in_flight)),
+    )
+
+
+policies: Dict[str, Policy] = {name: _policy_from_env(name) for name in DEFAULT_POLICIES}
+# One thread per in-flight slot: an accepted attempt never waits for a thread
+RESILIENCE_THREADS = sum(policy.max_in_flight for policy in policies.values())
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_pid = None
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ThreadPoolExecutor(max_workers=RESILIENCE_THREADS, thread_name_prefix="resilience")
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _submit(policy: Policy, fn: Callable[[], Any]):
+    """Start an attempt on the pool, or return None if the upstream is at max_in_flight."""
+    if not policy._try_start():
+        return None
+    try:
+        attempt = _executor().submit(fn)
+    except BaseException:
+        policy._finished()
+        raise
+    attempt.add_done_callback(policy._finished)
+    return attempt
+
+
+def call(upstream: str, fn: Callable[[], Any]) -> Any:
+    """
+    Run an idempotent upstream call with hedging, a timeout and the upstream's
+    circuit breaker. Overloaded (admission control) from any attempt doesn't
+    count against the breaker; if no attempt got further, it is re-raised.
+    """
+    if not RESILIENCE_ENABLED:
+        return fn()
+    policy = policies[upstream]
+    policy._before_call()
+    policy.metrics["calls"] += 1
+    fn = profiling.follow(fn)
+
+    started = time.monotonic()
+    deadline = started + policy.timeout
+    primary = _submit(policy, fn)
+    if primary is None:
+        policy.metrics["rejected"] += 1
+        policy._release_trial()
+        raise Unavailable(upstream, f"{policy.max_in_flight} calls already in flight")
+    attempts = [primary]
+    attempt_started = {primary: started}
+    hedge_at = started + policy.hedge_delay() if policy.hedge_percentile > 0 else None
+    last_error = None
+    overloaded = None
+
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            policy.metrics["timeouts"] += 1
+            policy.metrics["abandoned"] += len(attempts)
+            policy._on_failure()
+            raise Unavailable(upstream, f"timed out after {policy.timeout:.1f}s")
+        wait_until = min(deadline, hedge_at) if hedge_at else deadline
+        wait(attempts, timeout=max(0.0, wait_until - now), return_when=FIRST_COMPLETED)
+
+        for attempt in [a for a in attempts if a.done()]:
+            error = attempt.exception()
+            if error is None:
+                # The winner's own latency, so hedge wins don't inflate the percentile
+                policy._on_success(time.monotonic() - attempt_started[attempt])
+                if attempt is not primary:
+                    policy.metrics["hedge_wins"] += 1
+                policy.metrics["abandoned"] += sum(1 for a in attempts if not a.done())
+                return attempt.result()
+            if isinstance(error, Overloaded):
+                overloaded = error
+            else:
+                last_error = error
+            attempts.remove(attempt)
+
+        if not attempts and last_error is None:
+            policy._release_trial()
+            raise overloaded
+        if not attempts:
+            policy._on_failure()
+            raise Unavailable(upstream, f"{type(last_error).__name__}: {last_error}") from last_error
+
+        if hedge_at and time.monotonic() >= hedge_at:
+            # One hedge per call, and only if the upstream has a free slot
+            hedge_at = None
+            hedge = _submit(policy, fn)
+            if hedge is not None:
+                policy.metrics["hedged"] += 1
+                attempts.append(hedge)
+                attempt_started[hedge] = time.monotonic()
+
+
+def metrics() -> Dict[str, Dict]:
+    return {name: policy.snapshot() for name, policy in policies.items()}
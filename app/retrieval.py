@@ -0,0 +1,62 @@
+import json
+from typing import List
+
+from llama_index.core.schema import NodeWithScore, TextNode
+
+from app import generations
+from app import local_index
+from app.tenancy import route_tenant, tenant_filter, tenant_size, search_params_for
+
+
+def hit_to_node(hit) -> NodeWithScore:
+    """Convert a Qdrant scored point (payload = text + metadata) into a llama_index node."""
+    payload = dict(hit.payload or {})
+    text = payload.pop("text", "")
+    node = TextNode(id_=str(hit.id), text=text, metadata=payload)
+    if hit.vector is not None:
+        node.embedding = list(hit.vector)
+    return NodeWithScore(node=node, score=hit.score)
+
+
+def nodes_to_json(nodes: List[NodeWithScore]) -> bytes:
+    """Compact encoding of search results (without vectors) for the shared-memory cache."""
+    return json.dumps([{"id": n.node.id_, "score": n.score, "text": n.node.get_content(), "metadata": n.node.metadata}
+                       for n in nodes], separators=(",", ":")).encode("utf-8")
+
+
+def nodes_from_json(raw: bytes) -> List[NodeWithScore]:
+    return [NodeWithScore(node=TextNode(id_=n["id"], text=n["text"], metadata=n["metadata"]), score=n["score"])
+            for n in json.loads(raw)]
+
+
+def search_project(qdrant_client, query_vector, user_id: str, project_folder: str, top_k: int = 5,
+                   with_vectors: bool = False) -> List[NodeWithScore]:
+    """
+    Tenant-routed similarity search for one project.
+    Resolves the collection / shard key for the user and picks an exact scan
+    for small tenants and HNSW for large ones. with_vectors attaches each
+    point's vector as node.embedding (needed for MMR). Only the project's
+    active index generation is searched.
+    With RETRIEVAL_BACKEND=local the project's local index is scanned instead.
+    """
+    if local_index.RETRIEVAL_BACKEND == "local":
+        hits = local_index.ensure_exported(qdrant_client, user_id, project_folder).search(query_vector, top_k, with_vectors)
+        return [hit_to_node(hit) for hit in hits]
+
+    collection_name, shard_key = route_tenant(user_id)
+    kwargs = {"shard_key_selector": shard_key} if shard_key is not None else {}
+    # Only the project's active generation; a rebuild in progress stays invisible
+    generation = generations.active(user_id, project_folder)
+
+    points = tenant_size(qdrant_client, collection_name, shard_key, user_id, project_folder, generation)
+    hits = qdrant_client.query_points(
+        collection_name=collection_name,
+        query=query_vector,
+        query_filter=tenant_filter(user_id, project_folder, generation=generation),
+        search_params=search_params_for(points),
+        limit=top_k,
+        with_payload=True,
+        with_vectors=with_vectors,
+        **kwargs
+    ).points
+    return [hit_to_node(hit) for hit in hits]
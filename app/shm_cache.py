@@ -0,0 +1,238 @@
+"""
+Host-wide cache tier in shared memory, shared by every worker on the host.
+
+Each cache is one memory-mapped file under SHM_CACHE_DIR (/dev/shm when it
+exists, so it lives in RAM):
+    header   magic, sets, ways, slot size
+    meta     (sets, ways) records: key hash, seqlock counter, value length,
+             last-use and write times
+    slab     (sets, ways, slot_bytes) value bytes
+A key hashes to one set of SHM_CACHE_WAYS slots; a write takes the key's
+slot, an empty slot, or evicts the least recently used one. Writers lock
+their set with an fcntl byte-range lock; readers take no lock and check the
+slot's seqlock counter before and after copying the value out, so a torn
+read is a miss.
+
+Two caches are used by app.chat:
+    query_vectors  float32 query embeddings keyed by model + question
+    results        search results (chunk text + metadata, no vectors) keyed
+                   by project, question, top_k and generations.version(), so
+                   an update, rebuild or Redis flush on any host is seen
+                   within GENERATION_CACHE_SECONDS; SHM_RESULT_TTL is a
+                   backstop
+Hit/miss counters are per worker (see metrics()).
+"""
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SHM_CACHE_ENABLED = os.getenv("SHM_CACHE_ENABLED", "true").lower() == "true"
+SHM_CACHE_DIR = os.getenv("SHM_CACHE_DIR", "/dev/shm/storyrag" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "storyrag-shm"))
+SHM_CACHE_WAYS = int(os.getenv("SHM_CACHE_WAYS", "8"))
+# Defaults take ~40 MB, well inside Docker's 64 MB /dev/shm
+SHM_VECTOR_SLOTS = int(os.getenv("SHM_VECTOR_SLOTS", "4096"))
+SHM_VECTOR_DIM = int(os.getenv("SHM_VECTOR_DIM", "1536"))
+SHM_RESULT_SLOTS = int(os.getenv("SHM_RESULT_SLOTS", "512"))
+SHM_RESULT_SLOT_BYTES = int(os.getenv("SHM_RESULT_SLOT_BYTES", str(32 * 1024)))
+SHM_RESULT_TTL = float(os.getenv("SHM_RESULT_TTL", "300"))
+
+_MAGIC = b"SRCACHE1"
+_HEADER_BYTES = 64
+_META = np.dtype([("key", "<u8"), ("seq", "<u4"), ("length", "<u4"), ("used", "<f8"), ("written", "<f8")])
+
+
+def _hash(key: str) -> int:
+    # Never 0: a zero key marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+class SharedCache:
+    def __init__(self, name: str, slots: int, slot_bytes: int, ttl: float = None,
+                 ways: int = SHM_CACHE_WAYS, directory: str = None):
+        self.name = name
+        self.ways = ways
+        self.sets = max(1, slots // ways)
+        self.slot_bytes = slot_bytes
+        self.ttl = ttl
+        self.path = Path(directory or SHM_CACHE_DIR) / f"{name}.cache"
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "too_large": 0}
+        self._pid = None
+        self._open_lock = threading.Lock()
+
+    # --- mapping ---
+    def _create(self):
+        """Write a zeroed file next to the target and link it in; the first process to link wins."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        size = _HEADER_BYTES + self.sets * self.ways * (_META.itemsize + self.slot_bytes)
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.name}.")
+        try:
+            os.ftruncate(fd, size)
+            header = _MAGIC + np.array([self.sets, self.ways, self.slot_bytes], dtype="<i8").tobytes()
+            os.pwrite(fd, header, 0)
+            try:
+                os.link(tmp, self.path)
+            except FileExistsError:
+                pass
+        finally:
+            os.close(fd)
+            os.unlink(tmp)
+
+    def _matches(self) -> bool:
+        with open(self.path, "rb") as f:
+            header = f.read(_HEADER_BYTES)
+        if header[:8] != _MAGIC:
+            return False
+        return np.frombuffer(header[8:32], dtype="<i8").tolist() == [self.sets, self.ways, self.slot_bytes]
+
+    def _map(self):
+        # Fork-safe: every worker maps the file (and opens its lock file) itself
+        if self._pid == os.getpid():
+            return
+        with self._open_lock:
+            if self._pid == os.getpid():
+                return
+            if not self.path.exists():
+                self._create()
+            if not self._matches():
+                # Sized by an older configuration: replace it, old mappings keep the old file
+                self.path.unlink(missing_ok=True)
+                self._create()
+            with open(self.path, "r+b") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0)
+            meta_bytes = self.sets * self.ways * _META.itemsize
+            meta = np.frombuffer(self._mmap, dtype=_META, count=self.sets * self.ways, offset=_HEADER_BYTES)
+            meta = meta.reshape(self.sets, self.ways)
+            # Plain ndarray views per field: indexing them is far cheaper than a structured memmap
+            self.keys, self.seqs, self.lengths = meta["key"], meta["seq"], meta["length"]
+            self.used, self.written = meta["used"], meta["written"]
+            self.slab = np.frombuffer(self._mmap, dtype=np.uint8, offset=_HEADER_BYTES + meta_bytes)
+            self.slab = self.slab.reshape(self.sets, self.ways, self.slot_bytes)
+            self._lock_fd = os.open(str(self.path) + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+            self._pid = os.getpid()
+
+    # --- operations ---
+    def get(self, key: str) -> Optional[bytes]:
+        """The cached value (a private copy), or None."""
+        self._map()
+        h = _hash(key)
+        index = h % self.sets
+        for way, slot_key in enumerate(self.keys[index].tolist()):
+            if slot_key != h:
+                continue
+            seq = int(self.seqs[index, way])
+            if seq & 1:
+                continue
+            value = self.slab[index, way, :int(self.lengths[index, way])].tobytes()
+            written = float(self.written[index, way])
+            if int(self.seqs[index, way]) != seq or int(self.keys[index, way]) != h:
+                continue
+            now = time.time()
+            if self.ttl is not None and now - written > self.ttl:
+                break
+            # Unlocked LRU touch; a lost update only makes eviction slightly less exact
+            self.used[index, way] = now
+            self.stats["hits"] += 1
+            return value
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.slot_bytes:
+            self.stats["too_large"] += 1
+            return
+        self._map()
+        h = _hash(key)
+        index = h % self.sets
+        fcntl.lockf(self._lock_fd, fcntl.LOCK_EX, 1, index)
+        try:
+            keys = self.keys[index].tolist()
+            if h in keys:
+                way = keys.index(h)
+            elif 0 in keys:
+                way = keys.index(0)
+            else:
+                way = int(np.argmin(self.used[index]))
+                self.stats["evictions"] += 1
+            now = time.time()
+            self.seqs[index, way] += 1
+            self.slab[index, way, :len(value)] = np.frombuffer(value, dtype=np.uint8)
+            self.lengths[index, way] = len(value)
+            self.keys[index, way] = h
+            self.written[index, way] = now
+            self.used[index, way] = now
+            self.seqs[index, way] += 1
+        finally:
+            fcntl.lockf(self._lock_fd, fcntl.LOCK_UN, 1, index)
+        self.stats["stores"] += 1
+
+    def snapshot(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        snapshot = {**self.stats, "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else None}
+        if self._pid == os.getpid():
+            snapshot["occupied_slots"] = int(np.count_nonzero(self.keys))
+            snapshot["capacity"] = self.sets * self.ways
+        return snapshot
+
+
+_caches: Dict[str, SharedCache] = {}
+_disabled = set()
+
+
+def _cache(name: str) -> Optional[SharedCache]:
+    if not SHM_CACHE_ENABLED or name in _disabled:
+        return None
+    cache = _caches.get(name)
+    if cache is None:
+        if name == "query_vectors":
+            cache = SharedCache(name, SHM_VECTOR_SLOTS, SHM_VECTOR_DIM * 4)
+        else:
+            cache = SharedCache(name, SHM_RESULT_SLOTS, SHM_RESULT_SLOT_BYTES, ttl=SHM_RESULT_TTL)
+        _caches[name] = cache
+    return cache
+
+
+def _guarded(name: str, op):
+    cache = _cache(name)
+    if cache is None:
+        return None
+    try:
+        return op(cache)
+    except OSError as e:
+        # e.g. /dev/shm full or read-only: run without this tier
+        logger.warning(f"Shared-memory cache {name} disabled: {e}")
+        _disabled.add(name)
+        return None
+
+
+def get_vector(model: str, text: str) -> Optional[np.ndarray]:
+    raw = _guarded("query_vectors", lambda c: c.get(f"{model}|{text}"))
+    return np.frombuffer(raw, dtype=np.float32) if raw else None
+
+
+def put_vector(model: str, text: str, vector):
+    value = np.asarray(vector, dtype=np.float32).tobytes()
+    _guarded("query_vectors", lambda c: c.put(f"{model}|{text}", value))
+
+
+def get_result(key: str) -> Optional[bytes]:
+    return _guarded("results", lambda c: c.get(key))
+
+
+def put_result(key: str, value: bytes):
+    _guarded("results", lambda c: c.put(key, value))
+
+
+def metrics() -> Dict:
+    """This worker's hit rates plus host-wide occupancy of each cache."""
+    return {"pid": os.getpid(), **{name: cache.snapshot() for name, cache in _caches.items()}}
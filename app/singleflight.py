@@ -0,0 +1,140 @@
+"""
+Single-flight request coalescing.
+
+Identical operations that are in flight at the same time share one execution
+and its result. Within a process callers wait on the leader's threading.Event;
+across gunicorn workers the leader holds a Redis lock and publishes its result
+under a per-run key that followers poll for. Shared results must be
+JSON-serializable.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+SINGLEFLIGHT_SHARED = os.getenv("SINGLEFLIGHT_SHARED", "true").lower() == "true"
+LOCK_TTL_MS = int(os.getenv("SINGLEFLIGHT_LOCK_TTL_MS", "120000"))
+RESULT_TTL_MS = int(os.getenv("SINGLEFLIGHT_RESULT_TTL_MS", "5000"))
+POLL_INTERVAL = 0.02
+
+stats = {"leader": 0, "local_follower": 0, "remote_follower": 0}
+_stats_lock = threading.Lock()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight: Dict[str, _Call] = {}
+_lock = threading.Lock()
+
+
+def _count(role: str):
+    with _stats_lock:
+        stats[role] += 1
+
+
+def metrics() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(stats)
+
+
+def make_key(*parts) -> str:
+    """Build a short, stable coalescing key from arbitrary request parts."""
+    raw = "|".join("" if p is None else str(p) for p in parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def do(key: str, fn: Callable[[], Any], shared: bool = False) -> Any:
+    """
+    Run fn once for all concurrent callers using the same key.
+    With shared=True, identical calls in other workers are coalesced via Redis.
+    """
+    with _lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _inflight[key] = call
+
+    if not leader:
+        _count("local_follower")
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        if shared and SINGLEFLIGHT_SHARED:
+            call.result = _do_shared(key, fn)
+        else:
+            _count("leader")
+            call.result = fn()
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(key, None)
+        call.event.set()
+
+
+def _do_shared(key: str, fn: Callable[[], Any]) -> Any:
+    # redis is imported here so app.main stays cheap to import
+    from redis.exceptions import RedisError
+    from app.redis_client import get_redis, release_lock
+
+    lock_key = f"sf:lock:{key}"
+    token = uuid.uuid4().hex
+    try:
+        r = get_redis()
+        acquired = r.set(lock_key, token, nx=True, px=LOCK_TTL_MS)
+    except RedisError as e:
+        logger.warning(f"Single-flight Redis unavailable, running locally: {e}")
+        _count("leader")
+        return fn()
+
+    if acquired:
+        _count("leader")
+        try:
+            result = fn()
+        except Exception:
+            release_lock(r, lock_key, token)
+            raise
+        try:
+            r.set(f"sf:result:{key}:{token}", json.dumps(result), px=RESULT_TTL_MS)
+        except (RedisError, TypeError) as e:
+            logger.warning(f"Single-flight could not publish result: {e}")
+        release_lock(r, lock_key, token)
+        return result
+
+    # Another worker is running it; wait for that run's result
+    try:
+        leader_token = r.get(lock_key)
+        deadline = time.monotonic() + LOCK_TTL_MS / 1000
+        while leader_token and time.monotonic() < deadline:
+            lock_held = r.get(lock_key) == leader_token
+            # Read the result after the lock so a publish in between isn't missed
+            raw = r.get(f"sf:result:{key}:{leader_token.decode()}")
+            if raw is not None:
+                _count("remote_follower")
+                return json.loads(raw)
+            if not lock_held:
+                # Leader failed or expired without publishing
+                break
+            time.sleep(POLL_INTERVAL)
+    except RedisError as e:
+        logger.warning(f"Single-flight wait failed, running locally: {e}")
+
+    _count("leader")
+    return fn()
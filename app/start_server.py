@@ -95,19 +95,18 @@ def start_server(host="0.0.0.0", port=8000, production=False):
             print("Installing gunicorn...")
             subprocess.run([sys.executable, "-m", "pip", "install", "gunicorn"])
         
-        # Start with gunicorn
+        # Start with gunicorn; worker count, preload and warmup live in gunicorn_conf.py
         cmd = [
             "gunicorn",
-            "-w", "2",  # 2 workers for small instance
-            "-k", "uvicorn.workers.UvicornWorker",
+            "-c", "app/gunicorn_conf.py",
             "-b", f"{host}:{port}",
-            "main:app"
+            "app.main:app"
         ]
     else:
         print("🔧 Development mode (uvicorn)")
         cmd = [
             "uvicorn",
-            "main:app",
+            "app.main:app",
             "--host", host,
             "--port", str(port),
             "--reload"
@@ -116,7 +115,8 @@ def start_server(host="0.0.0.0", port=8000, production=False):
     try:
         print(f"📝 Running: {' '.join(cmd)}")
         print("Press Ctrl+C to stop")
-        subprocess.run(cmd)
+        # Run from the repo root so the `app` package is importable
+        subprocess.run(cmd, cwd=Path(__file__).resolve().parent.parent)
     except KeyboardInterrupt:
         print("\n👋 Server stopped")
     except FileNotFoundError as e:
@@ -0,0 +1,161 @@
+import os
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from qdrant_client.models import (
+    Distance,
+    VectorParams,
+    PayloadSchemaType,
+    HnswConfigDiff,
+    KeywordIndexParams,
+    KeywordIndexType,
+    SearchParams,
+    ShardingMethod,
+)
+from qdrant_client.http.exceptions import UnexpectedResponse
+from qdrant_client.http.models import Filter, FieldCondition, MatchValue, Range
+
+load_dotenv()
+
+# "filtered" keeps everything in one collection (the original layout),
+# "sharded" routes each tenant group to its own custom shard key in a
+# dedicated collection, "grouped" gives each tenant group its own collection.
+TENANT_LAYOUT = os.getenv("TENANT_LAYOUT", "filtered")
+BASE_COLLECTION_NAME = "splitter"
+# Custom sharding can't be turned on for an existing collection, so the
+# sharded layout lives in its own collection next to the original one.
+SHARDED_COLLECTION_NAME = os.getenv("SHARDED_COLLECTION_NAME", "splitter_tenants")
+TENANT_GROUPS = int(os.getenv("TENANT_GROUPS", "16"))
+EXACT_SCAN_MAX_POINTS = int(os.getenv("EXACT_SCAN_MAX_POINTS", "5000"))
+TENANT_SIZE_TTL = int(os.getenv("TENANT_SIZE_TTL", "300"))
+
+_tenant_sizes: Dict[Tuple[str, str, str, Optional[int]], Tuple[float, int]] = {}
+_known_shard_keys = set()
+
+
+def tenant_group(user_id: str) -> int:
+    """Stable group number for a user (crc32 so it matches across processes)."""
+    return zlib.crc32(str(user_id).encode("utf-8")) % TENANT_GROUPS
+
+
+def route_tenant(user_id: str, layout: str = None) -> Tuple[str, Optional[str]]:
+    """
+    Return (collection_name, shard_key) for a user under the given layout.
+    shard_key is None unless the layout uses custom sharding.
+    """
+    layout = layout or TENANT_LAYOUT
+    group = tenant_group(user_id)
+    if layout == "sharded":
+        return SHARDED_COLLECTION_NAME, f"g{group}"
+    if layout == "grouped":
+        return f"{BASE_COLLECTION_NAME}_g{group}", None
+    return BASE_COLLECTION_NAME, None
+
+
+def tenant_filter(user_id: str, project_folder: str = None, source: str = None, generation: int = None) -> Filter:
+    """
+    Payload filter selecting one user's (and optionally one project's or one file's) points.
+    With a generation, only that index generation's points (see app.generations).
+    """
+    conditions = [FieldCondition(key="user_id", match=MatchValue(value=str(user_id)))]
+    must_not = None
+    if project_folder:
+        conditions.append(
+            FieldCondition(key="project_folder", match=MatchValue(value=project_folder))
+        )
+    if source:
+        conditions.append(FieldCondition(key="source", match=MatchValue(value=source)))
+    if generation:
+        conditions.append(FieldCondition(key="generation", match=MatchValue(value=generation)))
+    elif generation == 0:
+        # Points written before generations existed have no generation field
+        must_not = [FieldCondition(key="generation", range=Range(gt=0))]
+    return Filter(must=conditions, must_not=must_not)
+
+
+def ensure_tenant_collection(client, collection_name, shard_key, vector_dim, debug=False):
+    """
+    Create the collection (and shard key) for a route if they don't exist yet.
+    Tenant-partitioned layouts disable the global HNSW graph (m=0) and build
+    per-tenant graphs instead (payload_m), since every search is tenant-scoped.
+    """
+    if not client.collection_exists(collection_name=collection_name):
+        if debug:
+            print(f"🔧 Creating collection: {collection_name}")
+        kwargs = {}
+        if collection_name != BASE_COLLECTION_NAME:
+            kwargs["hnsw_config"] = HnswConfigDiff(payload_m=16, m=0)
+        if shard_key is not None:
+            kwargs["sharding_method"] = ShardingMethod.CUSTOM
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(size=vector_dim, distance=Distance.COSINE),
+            **kwargs
+        )
+
+    if shard_key is not None and (collection_name, shard_key) not in _known_shard_keys:
+        try:
+            client.create_shard_key(collection_name=collection_name, shard_key=shard_key)
+            if debug:
+                print(f"🔧 Created shard key: {shard_key}")
+        except UnexpectedResponse as e:
+            if not _already_exists(e):
+                raise
+        _known_shard_keys.add((collection_name, shard_key))
+
+    ensure_metadata_indexes(client, collection_name, debug)
+
+
+def _already_exists(error: UnexpectedResponse) -> bool:
+    """Qdrant answers creating an existing shard key with 400 or 409 and says so in the body."""
+    content = (error.content or b"").decode("utf-8", "replace").lower()
+    return error.status_code in (400, 409) and "already exists" in content
+
+
+def ensure_metadata_indexes(client, collection_name, debug=False):
+    required_indexes = {
+        # is_tenant lets Qdrant store each user's points together, matching the payload_m HNSW layout
+        "user_id": KeywordIndexParams(type=KeywordIndexType.KEYWORD, is_tenant=True),
+        "project_folder": PayloadSchemaType.KEYWORD,
+        "filename": PayloadSchemaType.KEYWORD,
+        "source": PayloadSchemaType.KEYWORD,
+        "generation": PayloadSchemaType.INTEGER,
+    }
+
+    existing_indexes = client.get_collection(collection_name).payload_schema
+
+    for field, schema in required_indexes.items():
+        if field not in existing_indexes:
+            if debug:
+                print(f"🔧 Creating index on: {field}")
+            client.create_payload_index(
+                collection_name=collection_name,
+                field_name=field,
+                field_schema=schema
+            )
+
+
+def tenant_size(client, collection_name, shard_key, user_id, project_folder=None, generation=None) -> int:
+    """Approximate point count for a tenant, cached for TENANT_SIZE_TTL seconds."""
+    cache_key = (collection_name, str(user_id), project_folder or "", generation)
+    cached = _tenant_sizes.get(cache_key)
+    now = time.monotonic()
+    if cached and now - cached[0] < TENANT_SIZE_TTL:
+        return cached[1]
+
+    kwargs = {"shard_key_selector": shard_key} if shard_key is not None else {}
+    count = client.count(
+        collection_name=collection_name,
+        count_filter=tenant_filter(user_id, project_folder, generation=generation),
+        exact=False,
+        **kwargs
+    ).count
+    _tenant_sizes[cache_key] = (now, count)
+    return count
+
+
+def search_params_for(tenant_points: int) -> SearchParams:
+    """Small tenants get an exact scan, large ones go through HNSW."""
+    return SearchParams(exact=tenant_points <= EXACT_SCAN_MAX_POINTS)
@@ -0,0 +1,56 @@
+"""
+Worker warmup.
+
+preload_modules() imports the route modules (llama_index, qdrant_client,
+openai, boto3, ...). It runs only once in the gunicorn master under
+preload_app (gunicorn_conf.when_ready), so workers inherit the modules
+copy-on-write. Without preload the route modules stay lazy, loaded by the
+first request that needs them.
+
+warmup() runs in each worker before it takes traffic. It only opens the
+per-process clients and connections.
+"""
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+
+
+def preload_modules():
+    started = time.perf_counter()
+    import app.chat  # noqa: F401
+    import app.embed  # noqa: F401
+    logger.info(f"Preloaded route modules in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+
+def open_connections():
+    """Open upstream connections so the first request doesn't pay for them. Failures are logged, not fatal."""
+    if not WARMUP_ENABLED:
+        return
+
+    from app.clients import get_qdrant_client, get_openai_client, get_s3_client, get_llm, get_embed_model
+    from app.redis_client import get_redis
+
+    steps = {
+        "qdrant": lambda: get_qdrant_client().get_collections(),
+        "redis": lambda: get_redis().ping(),
+        "openai": lambda: (get_openai_client(), get_llm(), get_embed_model()),
+        "s3": get_s3_client,
+    }
+    for name, step in steps.items():
+        started = time.perf_counter()
+        try:
+            step()
+            logger.info(f"Warmup {name}: {(time.perf_counter() - started) * 1000:.0f}ms")
+        except Exception as e:
+            logger.warning(f"Warmup {name} failed: {e}")
+
+
+def warmup():
+    open_connections()
+    from app import offline
+    if offline.ENABLED:
+        offline.seed()